@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import datetime
+import tracemalloc
+from itertools import islice
+from collections import namedtuple
+from playhouse.shortcuts import model_to_dict
+from models.automatic import (
+    TransmissionLog,
+    Vehicle,
+    VehicleType,
+    GearChangeConfig,
+    get_vehicle,
+    get_vehicle_type,
+    get_vehicle_type_ref,
+    get_gear_config_by_vtid_gearto,
+    use_database,
+    check_existance,
+    shift_log_add,
+    shift_log_add_many,
+    average_speed_to_fourth_gear,
+    error_frequency_previous_last_week,
+    PRELOAD_VEHICLE_TYPES,
+)
+from models.ingest import percentile
+from benchmarks.fleet import make_fleet, register_fleet, iter_events
+
+# Benchmarks for the ingest and query hot paths, written as JSON so runs can
+# be compared over time.
+#
+# Example:
+# python -m benchmarks.bench_automatic --vehicles 1000 --sizes 10000 100000 1000000 --output bench.json
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    return {
+        "p50_us": round(percentile(latencies, 50) * 1e6, 1),
+        "p95_us": round(percentile(latencies, 95) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 99) * 1e6, 1),
+        "max_us": round(max(latencies, default=0.0) * 1e6, 1),
+    }
+
+
+def bench_single_ingest(events: list[tuple]) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for vin, speed, gear_from, gear_to, _ in events:
+        begin = time.perf_counter()
+        shift_log_add(vin, speed, gear_from, gear_to)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - started
+    return {
+        "events": len(events),
+        "seconds": round(elapsed, 4),
+        "events_per_second": round(len(events) / elapsed, 1),
+        "latency": latency_summary(latencies),
+    }
+
+
+def bench_batched_ingest(events: list[tuple], batch_size: int) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for start in range(0, len(events), batch_size):
+        begin = time.perf_counter()
+        shift_log_add_many(events[start : start + batch_size])
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - started
+    return {
+        "events": len(events),
+        "batch_size": batch_size,
+        "seconds": round(elapsed, 4),
+        "events_per_second": round(len(events) / elapsed, 1),
+        "batch_latency": latency_summary(latencies),
+    }
+
+
+def time_query(query, repeat: int = 5) -> dict:
+    timings = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        query()
+        timings.append(time.perf_counter() - begin)
+    return {
+        "median_ms": round(percentile(timings, 50) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+    }
+
+
+def bench_queries(fleet, sizes, days, late_ratio, seed, repeat) -> list[dict]:
+    results = []
+    events = iter_events(fleet, max(sizes), days, late_ratio, seed)
+    for size in sorted(sizes):
+        missing = size - TransmissionLog.select().count()
+        while missing > 0:
+            batch = list(islice(events, min(missing, 10000)))
+            shift_log_add_many(batch)
+            missing -= len(batch)
+        results.append(
+            {
+                "rows": size,
+                "average_speed_to_fourth_gear": time_query(
+                    average_speed_to_fourth_gear, repeat
+                ),
+                "error_frequency_previous_last_week": time_query(
+                    error_frequency_previous_last_week, repeat
+                ),
+            }
+        )
+    return results
+
+
+# Lookups as they were before the module-level records, a namedtuple class
+# per call and model_to_dict over a hydrated model, kept as the baseline.
+def legacy_get_vehicle(vin: str) -> object:
+    vehicle = Vehicle.select().where(Vehicle.vin == vin).get()
+    VehicleObj = namedtuple(
+        "VehicleObj", ["pk", "vin", "type_make", "type_year", "type_ref"]
+    )
+    return VehicleObj(**model_to_dict(vehicle))
+
+
+def legacy_get_vehicle_type(vtype: str) -> object:
+    VehicleTypeObj = namedtuple("VehicleTypeObj", ["pk", "type_name", "fuel_type"])
+    typex = VehicleType.select().where(VehicleType.type_name == vtype.capitalize())
+    if not typex.exists():
+        return False
+    for types in typex:
+        VehicleTypeData = VehicleTypeObj(**model_to_dict(types))
+    return VehicleTypeData
+
+
+def legacy_get_vehicle_type_ref(vtype_id: int) -> object:
+    VehicleTypeObj = namedtuple("VehicleTypeObj", ["pk", "type_name", "fuel_type"])
+    vehicle_type = VehicleType.select().where(VehicleType.pk == vtype_id).get()
+    return VehicleTypeObj(**model_to_dict(vehicle_type))
+
+
+def legacy_get_gear_config_by_vtid_gearto(vtid: int, gear_to: int) -> object:
+    gearChangeData = None
+    gearChangeObj = namedtuple(
+        "gearChangeObj", ["pk", "vehicle_type_ref", "speed", "gear_from", "gear_to"]
+    )
+    configs = GearChangeConfig.select().where(
+        GearChangeConfig.vehicle_type_ref == vtid, GearChangeConfig.gear_to == gear_to
+    )
+    for config in configs:
+        gearChangeData = gearChangeObj(**model_to_dict(config))
+    return gearChangeData
+
+
+def measure_lookup(lookup, args: list[tuple]) -> dict:
+    # Mean time per call, then the mean peak of memory allocated during a call
+    started = time.perf_counter()
+    for call_args in args:
+        lookup(*call_args)
+    elapsed = time.perf_counter() - started
+    peaks = 0
+    tracemalloc.start()
+    try:
+        for call_args in args:
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            lookup(*call_args)
+            peaks += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return {
+        "us_per_lookup": round(elapsed / len(args) * 1e6, 2),
+        "peak_bytes_per_lookup": round(peaks / len(args)),
+    }
+
+
+def bench_lookups(fleet, count: int) -> list[dict]:
+    vins = [vehicle[0] for vehicle in fleet]
+    type_refs = [1, 2, 3, 4]
+    lookups = [
+        (
+            "get_vehicle",
+            legacy_get_vehicle,
+            get_vehicle,
+            [(vins[i % len(vins)],) for i in range(count)],
+        ),
+        (
+            "get_vehicle_type",
+            legacy_get_vehicle_type,
+            get_vehicle_type,
+            [(("car", "van", "truck", "suv")[i % 4],) for i in range(count)],
+        ),
+        (
+            "get_vehicle_type_ref",
+            legacy_get_vehicle_type_ref,
+            get_vehicle_type_ref,
+            [(type_refs[i % 4],) for i in range(count)],
+        ),
+        (
+            "get_gear_config_by_vtid_gearto",
+            legacy_get_gear_config_by_vtid_gearto,
+            get_gear_config_by_vtid_gearto,
+            [(type_refs[i % 4], 2 + i % 5) for i in range(count)],
+        ),
+    ]
+    results = []
+    for name, legacy, current, args in lookups:
+        before = measure_lookup(legacy, args)
+        after = measure_lookup(current, args)
+        results.append(
+            {
+                "lookup": name,
+                "lookups": count,
+                "legacy": before,
+                "current": after,
+                "speedup": round(before["us_per_lookup"] / after["us_per_lookup"], 2),
+            }
+        )
+    return results
+
+
+def run(options) -> dict:
+    directory = tempfile.mkdtemp(prefix="automatic-bench-")
+    report = {
+        "started": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "options": vars(options),
+    }
+    fleet = make_fleet(options.vehicles, options.type_mix, seed=options.seed)
+
+    def fresh_database(name):
+        database = use_database(os.path.join(directory, name), options.profile)
+        check_existance()
+        register_fleet(fleet)
+        return database
+
+    try:
+        report.update(bench_all(options, fleet, fresh_database))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    report["finished"] = datetime.datetime.now().isoformat()
+    return report
+
+
+def bench_all(options, fleet, fresh_database) -> dict:
+    report = {}
+    database = fresh_database("ingest.db")
+    events = list(
+        iter_events(
+            fleet, options.events, options.days, options.late_ratio, options.seed
+        )
+    )
+    report["single_ingest"] = bench_single_ingest(events)
+    report["batched_ingest"] = []
+    for batch_size in options.batch_sizes:
+        database.close()
+        database = fresh_database(f"ingest-{batch_size}.db")
+        report["batched_ingest"].append(bench_batched_ingest(events, batch_size))
+    database.close()
+
+    database = fresh_database("lookups.db")
+    report["lookups"] = bench_lookups(fleet, options.lookups)
+    database.close()
+
+    database = fresh_database("queries.db")
+    report["queries"] = bench_queries(
+        fleet,
+        options.sizes,
+        options.days,
+        options.late_ratio,
+        options.seed,
+        options.repeat,
+    )
+    database.close()
+    return report
+
+
+def parse_type_mix(values) -> dict:
+    # ["car=0.6", "suv=0.4"] -> {"Car": 0.6, "SUV": 0.4}, the names resolved
+    # case-insensitively against the preloaded vehicle types
+    type_names = {name.lower(): name for name, _ in PRELOAD_VEHICLE_TYPES}
+    mix = {}
+    for value in values:
+        try:
+            name, weight = value.split("=")
+            weight = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError("Type mix must be given as Type=weight")
+        if name.lower() not in type_names:
+            raise argparse.ArgumentTypeError(
+                f"Unknown vehicle type {name}, please use {list(type_names.values())}"
+            )
+        if not weight >= 0:
+            raise argparse.ArgumentTypeError("Type mix weights must not be negative")
+        mix[type_names[name.lower()]] = weight
+    if not sum(mix.values()) > 0:
+        raise argparse.ArgumentTypeError("Type mix weights must add up to more than 0")
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--type-mix", type=str, nargs="+", default=None)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--late-ratio", type=float, default=0.05)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[100, 1000, 10000]
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--profile", type=str, default="balanced")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None)
+    options = parser.parse_args(argv)
+    if options.type_mix:
+        try:
+            options.type_mix = parse_type_mix(options.type_mix)
+        except argparse.ArgumentTypeError as exc:
+            parser.error(f"argument --type-mix: {exc}")
+    return options
+
+
+def main(argv=None) -> dict:
+    options = parse_args(argv)
+    report = run(options)
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import random
+import datetime
+from peewee import chunked
+from models.automatic import (
+    Vehicle,
+    VehicleType,
+    get_database,
+    load_gear_configs,
+)
+
+# Synthetic fleets for the benchmarks. Shift speeds are drawn around the
+# thresholds loaded by preload_config, with late_ratio of the shifts pushed
+# past the threshold so they are logged as errors.
+
+DEFAULT_TYPE_MIX = {"Truck": 0.25, "Car": 0.4, "SUV": 0.25, "Van": 0.1}
+
+
+def make_fleet(vehicles: int, type_mix: dict = None, seed: int = 0) -> list[tuple]:
+    # Returns (vin, make, year, type_name) per vehicle
+    rng = random.Random(seed)
+    type_mix = type_mix or DEFAULT_TYPE_MIX
+    names = list(type_mix)
+    weights = [type_mix[name] for name in names]
+    makes = ["Toyota", "Honda", "Ford", "Chevrolet", "Nissan"]
+    return [
+        (
+            f"VIN{i:010d}",
+            rng.choice(makes),
+            rng.randint(2000, 2024),
+            rng.choices(names, weights)[0],
+        )
+        for i in range(vehicles)
+    ]
+
+
+def register_fleet(fleet: list[tuple]) -> None:
+    type_refs = dict(VehicleType.select(VehicleType.type_name, VehicleType.pk).tuples())
+    rows = [
+        {"vin": vin, "type_make": make, "type_year": year, "type_ref": type_refs[vtype]}
+        for vin, make, year, vtype in fleet
+    ]
+    with get_database().atomic():
+        for chunk in chunked(rows, 100):
+            Vehicle.insert_many(chunk).execute()
+
+
+def iter_events(
+    fleet: list[tuple],
+    count: int,
+    days: int = 30,
+    late_ratio: float = 0.05,
+    seed: int = 0,
+    end: datetime.datetime = None,
+):
+    # Yields count (vin, speed, gear_from, gear_to, timestamp) records spread
+    # over the last `days` days.
+    rng = random.Random(seed)
+    end = end or datetime.datetime.now()
+    span = days * 86400
+    type_refs = dict(VehicleType.select(VehicleType.type_name, VehicleType.pk).tuples())
+    thresholds = {}
+    for (type_ref, gear_to), config in load_gear_configs().items():
+        thresholds.setdefault(type_ref, []).append((gear_to, config.speed))
+    for _ in range(count):
+        vin, _, _, vtype = fleet[rng.randrange(len(fleet))]
+        gear_to, speed = rng.choice(thresholds[type_refs[vtype]])
+        if rng.random() < late_ratio:
+            speed += rng.randint(1, 10)
+        else:
+            speed -= rng.randint(0, 5)
+        timestamp = end - datetime.timedelta(seconds=rng.randrange(span))
+        yield (vin, speed, gear_to - 1, gear_to, timestamp)
@@ -1,11 +1,6 @@
+import sys
 import json
 import argparse
-from models.automatic import (
-    check_existance,
-    add_vehicle,
-    shift_log_add,
-    average_speed_to_fourth_gear,
-)
 
 # Some questions that were not provided when recieving this assessment.
 # 1. What type of input is expected. Currerntly this accepts CLI arguments.
@@ -21,56 +16,588 @@ from models.automatic import (
 # {"vin": "1G1ZZ8F", "speed": 15, "gear_to": 2, "gear_from": 1}
 # --vin 1G1ZZ8F --speed 15 --gear_to 2 --gear_from 1
 
-parser = argparse.ArgumentParser()
+# Only argparse is imported up front. peewee, the models and the schema
+# check are loaded once the arguments are valid and a command needs them.
 
-# Primary usage for entering shift details
-parser.add_argument("--shift-log", action="store_true")
-parser.add_argument(
-    "--vin", type=str, default=None, help="VIN must exist in the database."
+# Arguments that select a command, in the order the commands run
+COMMANDS = (
+    "shift_log",
+    "vehicle_add",
+    "onboard",
+    "average_speed",
+    "shift_stats",
+    "rebuild_aggregates",
+    "error_recurrence",
+    "error_vehicles",
+    "import_path",
+    "rotate_partitions",
+    "retention",
+    "export_columnar",
+    "explain",
+    "serve",
+    "serve_async",
+    "serve_queries",
+    "simulate",
 )
-parser.add_argument("--speed", type=int, default=0)
-parser.add_argument("--gear_to", type=int, default=0)
-parser.add_argument("--gear_from", type=int, default=0)
 
-# Adding a vehicle
-parser.add_argument(
-    "--vehicle-add", default=None, action="store_true", help="Add a vehicle"
+# Commands that run against a sharded fleet (--shards)
+SHARDED_COMMANDS = (
+    "shift_log",
+    "vehicle_add",
+    "onboard",
+    "average_speed",
+    "shift_stats",
+    "error_recurrence",
+    "serve",
+    "simulate",
 )
-parser.add_argument("--vehicle", action="store", default=None)
-
-# Average speed to fourth gear
-parser.add_argument("--average-speed", action="store_true")
-
-args = parser.parse_args()
-db = check_existance()
-
-if args.shift_log:
-    # Example:
-    # python main.py --shift-log --vin 1G1ZZ8F --speed 15 --gear_to 2 --gear_from 1
-    # python main.py --shift-log --vin ABC1234 --speed 48 --gear_to 3 --gear_from 4
-    # python main.py --shift-log --vin ABC1234 --speed 48 --gear_to 3 --gear_from 4 --vehicle-add --vehicle '{"vin": "ABC1234", "make": "Honda", "year": 2020, "type": "car"}'
-    if not args.vin or not args.speed or not args.gear_to or not args.gear_from:
-        print("Missing required arguments")
-        exit(1)
-    shift_log_add(args.vin, args.speed, args.gear_from, args.gear_to)
-
-
-if args.vehicle_add:
-    # Example:
-    # python main.py --vehicle-add --vehicle '{"vin": "ABC123", "make": "Honda", "year": 2020, "type": "car"}'
-    if not args.vehicle:
-        print("Missing required arguments")
-        exit(1)
-    vehicle = json.loads(args.vehicle)
-    try:
-        add_vehicle(vehicle["vin"], vehicle["make"], vehicle["year"], vehicle["type"])
-    except AttributeError:
-        print("Invalid vehicle details, please use {'vin', 'make', 'year', 'type'}")
-
-if args.average_speed:
-    # Example:
-    # python main.py --average-speed
-    print(average_speed_to_fourth_gear())
+
+
+def int_at_least(minimum: int):
+    # argparse type for day and month counts, --error-vehicles 0 is today
+    # while partitions keep at least the current month
+    def parse(value: str) -> int:
+        try:
+            number = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+        if number < minimum:
+            raise argparse.ArgumentTypeError(f"must be {minimum} or more, not {number}")
+        return number
+
+    return parse
+
+
+def selected_commands(args) -> list:
+    # Commands given on the command line. The int valued ones are selected
+    # by any value, 0 included
+    return [
+        command
+        for command in COMMANDS
+        if getattr(args, command) is not None and getattr(args, command) is not False
+    ]
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+
+    # Database file and pragma profile (durable, balanced, bulk-load), default
+    # to AUTOMATIC_DB and AUTOMATIC_DB_PROFILE, see models/automatic.py
+    parser.add_argument("--db", type=str, default=None)
+    parser.add_argument("--profile", type=str, default=None)
+
+    # Split the fleet over N database files next to --db, keyed by a hash of
+    # the VIN or by vehicle type. Shifts are written by one process per shard
+    # and queries are merged from all of them, see models/sharding.py
+    parser.add_argument("--shards", type=int, default=None)
+    parser.add_argument("--shard-key", choices=("vin", "type"), default="vin")
+
+    # Primary usage for entering shift details
+    parser.add_argument("--shift-log", action="store_true")
+    parser.add_argument(
+        "--vin", type=str, default=None, help="VIN must exist in the database."
+    )
+    parser.add_argument("--speed", type=int, default=0)
+    parser.add_argument("--gear_to", type=int, default=0)
+    parser.add_argument("--gear_from", type=int, default=0)
+
+    # Adding a vehicle
+    parser.add_argument(
+        "--vehicle-add", default=None, action="store_true", help="Add a vehicle"
+    )
+    parser.add_argument("--vehicle", action="store", default=None)
+
+    # Register or update a fleet from a CSV (vin,make,year,type) or NDJSON file
+    parser.add_argument("--onboard", type=str, default=None, metavar="PATH")
+
+    # Average speed to fourth gear
+    parser.add_argument("--average-speed", action="store_true")
+
+    # Speed statistics per vehicle type for a gear transition, from the aggregates
+    parser.add_argument("--shift-stats", action="store_true")
+    parser.add_argument("--rebuild-aggregates", action="store_true")
+
+    # Vehicles with errors before last month that also had errors in the last 7 days
+    parser.add_argument("--error-recurrence", action="store_true")
+
+    # Answer --average-speed and --shift-stats from the sketches, and estimate the
+    # distinct vehicles with errors in the last N days, see models/sketches.py
+    parser.add_argument("--approximate", action="store_true")
+    parser.add_argument(
+        "--error-vehicles", type=int_at_least(0), default=None, metavar="DAYS"
+    )
+
+    # Move months older than N months out of the hot log into monthly partitions
+    parser.add_argument(
+        "--rotate-partitions", type=int_at_least(1), default=None, metavar="MONTHS"
+    )
+
+    # Retire partitions older than N months, optionally copying them to --archive-dir
+    parser.add_argument(
+        "--retention", type=int_at_least(1), default=None, metavar="MONTHS"
+    )
+    parser.add_argument("--archive-dir", type=str, default=None)
+
+    # Export the log as memory-mappable column files, see models/columnar.py
+    parser.add_argument("--export-columnar", type=str, default=None, metavar="DIR")
+
+    # Print EXPLAIN QUERY PLAN for the built-in queries
+    parser.add_argument("--explain", action="store_true")
+
+    # Instrumentation: print stage timers, counters and query counts on exit,
+    # periodically while serving, and optionally profile the run with cProfile
+    parser.add_argument("--stats", action="store_true")
+    parser.add_argument("--stats-interval", type=float, default=None)
+    parser.add_argument("--cprofile", type=str, default=None, help="pstats output path")
+
+    # Resident ingest of newline-delimited JSON shift events
+    parser.add_argument(
+        "--serve", action="store_true", help="Read shift events from stdin or --socket"
+    )
+    parser.add_argument("--socket", type=str, default=None, help="Unix socket path")
+    parser.add_argument("--flush-size", type=int, default=500)
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+
+    # Where logged shifts go: sqlite commits every batch, buffered acknowledges
+    # once they are appended to the --segment-dir log and commits them in the
+    # background every --commit-interval seconds, see models/storage.py
+    parser.add_argument("--storage", choices=("sqlite", "buffered"), default="sqlite")
+    parser.add_argument(
+        "--segment-dir", type=str, default=None, help="defaults to <db>.segments"
+    )
+    parser.add_argument("--commit-interval", type=float, default=0.2)
+
+    # Track gear and speed per VIN while serving, accept speed-only samples and
+    # print anomalies as JSON lines on stdout, see models/state.py
+    parser.add_argument("--track-state", action="store_true")
+    parser.add_argument("--idle-timeout", type=float, default=900.0)
+    parser.add_argument("--max-tracked", type=int, default=100000)
+
+    # Simulated fleet of N vehicles per type, registered in the database. The
+    # events are printed as NDJSON, or ingested in-process with --serve. --rate
+    # caps events per second, --duration is in simulated seconds
+    parser.add_argument("--simulate", type=int, default=None, metavar="VEHICLES")
+    parser.add_argument("--late-ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=None)
+    parser.add_argument("--duration", type=float, default=3600.0)
+    parser.add_argument("--samples", action="store_true")
+
+    # asyncio ingest for concurrent producers over TCP and/or a Unix socket
+    parser.add_argument("--serve-async", action="store_true")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--queue-size", type=int, default=10000)
+
+    # Cached dashboard queries over HTTP on read-only connections, on --host and
+    # --port (default 9600), see models/query_service.py
+    parser.add_argument("--serve-queries", action="store_true")
+    parser.add_argument("--cache-ttl", type=float, default=5.0)
+
+    # Parallel import of a CSV/NDJSON shift export, always under the bulk-load profile
+    parser.add_argument("--import", dest="import_path", type=str, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-bytes", type=int, default=8 * 1024 * 1024)
+    parser.add_argument(
+        "--checkpoint", type=str, default=None, help="defaults to <import>.checkpoint"
+    )
+    return parser
+
+
+def validate(args) -> str:
+    # Returns an error message for arguments that cannot run, before any
+    # database work
+    if args.shift_log:
+        if not args.vin or not args.speed or not args.gear_to or not args.gear_from:
+            return "Missing required arguments"
+    if args.vehicle_add:
+        if not args.vehicle:
+            return "Missing required arguments"
+    if args.simulate is not None:
+        if args.simulate < 1 or not 0 <= args.late_ratio <= 1:
+            return "--simulate needs at least 1 vehicle and a late ratio from 0 to 1"
+        if args.samples and args.serve and not args.track_state:
+            return "Speed samples can only be served with --track-state"
+    if args.shards is not None:
+        if args.shards < 1:
+            return "--shards needs at least 1 shard"
+        unsupported = [
+            command
+            for command in selected_commands(args)
+            if command not in SHARDED_COMMANDS
+        ]
+        if unsupported or args.approximate or args.storage != "sqlite":
+            return "--shards supports " + ", ".join(SHARDED_COMMANDS)
+    return None
+
+
+def open_database(args):
+    from models.automatic import use_database, check_existance
+
+    options = {}
+    if args.db:
+        options["path"] = args.db
+    if args.import_path:
+        options["profile"] = "bulk-load"
+    elif args.profile:
+        options["profile"] = args.profile
+    database = use_database(**options)
+    if args.stats:
+        from models.instrumentation import install_query_hook
+
+        install_query_hook(database)
+    check_existance()
+    if args.storage == "buffered":
+        # Replays the segment log of an earlier run before anything is logged
+        from models.automatic import set_storage_backend
+        from models.storage import BufferedBackend
+
+        backend = BufferedBackend(
+            args.segment_dir or database.database + ".segments",
+            commit_interval=args.commit_interval,
+        )
+        if backend.recovered:
+            print(f"Recovered {backend.recovered} shift logs", file=sys.stderr)
+        set_storage_backend(backend)
+    return database
+
+
+def open_shards(args):
+    from models.automatic import DATABASE_PATH, DATABASE_PROFILE
+    from models.sharding import ShardedFleet
+
+    fleet = ShardedFleet(
+        args.db or DATABASE_PATH,
+        args.shards,
+        args.shard_key,
+        args.profile or DATABASE_PROFILE,
+    )
+    fleet.create()
+    return fleet
+
+
+def profiled_run(args, function):
+    if not args.cprofile:
+        return function()
+    from models.instrumentation import profiled
+
+    with profiled(args.cprofile):
+        return function()
+
+
+def simulated_events(args, fleet=None):
+    from models.simulator import (
+        TransmissionSimulator,
+        paced,
+        register_simulated_fleet,
+    )
+
+    if fleet is None:
+        simulator = TransmissionSimulator(
+            args.simulate, args.late_ratio, args.seed, samples=args.samples
+        )
+        register_simulated_fleet(simulator)
+    else:
+        from models.automatic import lookup_cache
+
+        # Every shard holds the same configs
+        with fleet.shard(0):
+            simulator = TransmissionSimulator(
+                args.simulate, args.late_ratio, args.seed, samples=args.samples
+            )
+            type_names = {
+                pk: name for name, pk in lookup_cache.vehicle_type_refs().items()
+            }
+        fleet.add_vehicles_many(
+            (vin, "Simulated", 2024, type_names[type_ref])
+            for vin, type_ref in simulator.fleet()
+        )
+    return paced(simulator.events(duration=args.duration), args.rate)
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    error = validate(args)
+    if error:
+        print(error)
+        return 1
+    if not selected_commands(args):
+        build_parser().print_help()
+        return 0
+    fleet = None
+    if args.shards:
+        fleet = open_shards(args)
+    else:
+        open_database(args)
+
+    if args.shift_log:
+        # Example:
+        # python main.py --shift-log --vin 1G1ZZ8F --speed 15 --gear_to 2 --gear_from 1
+        # python main.py --shift-log --vin ABC1234 --speed 48 --gear_to 3 --gear_from 4
+        # python main.py --shift-log --vin ABC1234 --speed 48 --gear_to 3 --gear_from 4 --vehicle-add --vehicle '{"vin": "ABC1234", "make": "Honda", "year": 2020, "type": "car"}'
+        from models.automatic import shift_log_add
+
+        if fleet is not None:
+            shift_log_add = fleet.shift_log_add
+        shift_log_add(args.vin, args.speed, args.gear_from, args.gear_to)
+
+    if args.vehicle_add:
+        # Example:
+        # python main.py --vehicle-add --vehicle '{"vin": "ABC123", "make": "Honda", "year": 2020, "type": "car"}'
+        from models.automatic import add_vehicle
+
+        if fleet is not None:
+            add_vehicle = fleet.add_vehicle
+        vehicle = json.loads(args.vehicle)
+        try:
+            add_vehicle(
+                vehicle["vin"], vehicle["make"], vehicle["year"], vehicle["type"]
+            )
+        except AttributeError:
+            print("Invalid vehicle details, please use {'vin', 'make', 'year', 'type'}")
+        except ValueError as exc:
+            print(exc)
+
+    if args.onboard:
+        # Example:
+        # python main.py --onboard fleet.csv
+        from models.automatic import add_vehicles_many
+        from models.bulk_import import read_vehicles
+
+        if fleet is not None:
+            add_vehicles_many = fleet.add_vehicles_many
+        print(json.dumps(add_vehicles_many(read_vehicles(args.onboard))))
+
+    if args.average_speed:
+        # Example:
+        # python main.py --average-speed
+        # python main.py --average-speed --approximate
+        if args.approximate:
+            from models.automatic import approximate_average_speed_to_fourth_gear
+
+            print(json.dumps(approximate_average_speed_to_fourth_gear()))
+        else:
+            from models.automatic import average_speed_to_fourth_gear
+
+            if fleet is not None:
+                average_speed_to_fourth_gear = fleet.average_speed_to_fourth_gear
+            print(average_speed_to_fourth_gear())
+
+    if args.shift_stats:
+        # Example:
+        # python main.py --shift-stats --gear_from 3 --gear_to 4
+        # python main.py --shift-stats --approximate
+        from models.automatic import shift_speed_stats, approximate_shift_speed_stats
+
+        stats_function = shift_speed_stats
+        if args.approximate:
+            stats_function = approximate_shift_speed_stats
+        elif fleet is not None:
+            stats_function = fleet.shift_speed_stats
+        for stats in stats_function(args.gear_from or 3, args.gear_to or 4):
+            print(json.dumps(stats))
+
+    if args.rebuild_aggregates:
+        # Example:
+        # python main.py --rebuild-aggregates
+        from models.automatic import (
+            rebuild_shift_speed_aggregates,
+            rebuild_vehicle_error_rollups,
+        )
+
+        print(rebuild_shift_speed_aggregates())
+        print(rebuild_vehicle_error_rollups())
+
+    if args.error_recurrence:
+        # Example:
+        # python main.py --error-recurrence
+        from models.automatic import error_frequency_previous_last_week
+
+        if fleet is not None:
+            error_frequency_previous_last_week = (
+                fleet.error_frequency_previous_last_week
+            )
+        for vehicle in error_frequency_previous_last_week():
+            print(json.dumps(vehicle))
+
+    if args.error_vehicles is not None:
+        # Example:
+        # python main.py --error-vehicles 7
+        import datetime
+        from models.automatic import approximate_error_vehicles
+
+        start = datetime.date.today() - datetime.timedelta(days=args.error_vehicles)
+        print(json.dumps(approximate_error_vehicles(start)))
+
+    if args.import_path:
+        # Example:
+        # python main.py --import depot.csv --workers 4
+        from models.bulk_import import import_file
+
+        def report(state):
+            done = state["bytes_done"] / (state["bytes_total"] or 1)
+            print(
+                f"{done:.1%} logged={state['logged']} rejected={state['rejected']}",
+                file=sys.stderr,
+            )
+
+        result = import_file(
+            args.import_path,
+            workers=args.workers,
+            chunk_bytes=args.chunk_bytes,
+            checkpoint=args.checkpoint or args.import_path + ".checkpoint",
+            progress=report,
+        )
+        print(json.dumps(result))
+
+    if args.rotate_partitions is not None:
+        # Example:
+        # python main.py --rotate-partitions 3
+        from models.partitions import rotate_partitions
+
+        for table_name, rows in rotate_partitions(args.rotate_partitions).items():
+            print(f"{table_name} {rows}")
+
+    if args.retention is not None:
+        # Example:
+        # python main.py --retention 12 --archive-dir archive/
+        from models.partitions import apply_retention
+
+        for table_name in apply_retention(
+            args.retention, args.archive_dir, vacuum=True
+        ):
+            print(table_name)
+
+    if args.export_columnar:
+        # Example:
+        # python main.py --export-columnar exports/2024
+        from models.columnar import export_columnar
+
+        print(export_columnar(args.export_columnar))
+
+    if args.explain:
+        # Example:
+        # python main.py --explain
+        from models.automatic import explain_queries
+
+        for name, plan in explain_queries().items():
+            print(name)
+            for detail in plan:
+                print(f"  {detail}")
+
+    if args.serve:
+        # Example:
+        # python main.py --serve < shifts.ndjson
+        # python main.py --serve --socket /tmp/automatic.sock
+        import signal
+        from models.ingest import IngestServer, ShiftEventBuffer
+
+        tracker = None
+        if args.track_state:
+            from models.state import ShiftStateTracker, describe
+
+            tracker = ShiftStateTracker(args.max_tracked, args.idle_timeout)
+            tracker.subscribe(
+                lambda anomaly: print(json.dumps(describe(anomaly)), flush=True)
+            )
+        options = {"tracker": tracker}
+        if fleet is not None:
+            fleet.start_writers()
+            options["writer"] = fleet.shift_log_add_many
+        buffer = ShiftEventBuffer(args.flush_size, args.flush_interval, **options)
+        if args.simulate:
+            from models.simulator import feed
+
+            events = simulated_events(args, fleet)
+            report = profiled_run(args, lambda: feed(buffer, events))
+        else:
+            stream = None if args.socket else sys.stdin
+            server = IngestServer(
+                buffer,
+                stream=stream,
+                socket_path=args.socket,
+                stats_interval=args.stats_interval,
+            )
+            signal.signal(signal.SIGTERM, server.stop)
+            report = profiled_run(args, server.serve)
+        if tracker is not None:
+            report["state"] = tracker.stats()
+        print(json.dumps(report), file=sys.stderr)
+
+    if args.serve_async:
+        # Example:
+        # python main.py --serve-async --port 9500
+        # python main.py --serve-async --socket /tmp/automatic.sock
+        import signal
+        import asyncio
+        from models.async_ingest import serve
+
+        async def run_async_service():
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, stop_event.set)
+            return await serve(
+                host=args.host,
+                port=args.port,
+                path=args.socket,
+                stop_event=stop_event,
+                queue_size=args.queue_size,
+                batch_size=args.flush_size,
+            )
+
+        report = profiled_run(args, lambda: asyncio.run(run_async_service()))
+        print(json.dumps(report), file=sys.stderr)
+
+    if args.serve_queries:
+        # Example:
+        # python main.py --serve-queries --port 9600
+        # curl localhost:9600/average_speed_to_fourth_gear
+        import signal
+        from models.query_service import QueryService, serve_http
+
+        service = QueryService(args.db, ttl=args.cache_ttl)
+        server = serve_http(service, args.host, args.port or 9600)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print(json.dumps(service.stats()), file=sys.stderr)
+
+    if args.simulate and not args.serve:
+        # Example:
+        # python main.py --simulate 100 --late-ratio 0.1 --rate 5000 | python main.py --serve
+        from models.simulator import to_ndjson
+
+        for record in simulated_events(args, fleet):
+            print(to_ndjson(record))
+
+    # Buffered shift logs and sketch updates still pending in this process
+    from models.automatic import (
+        flush_shift_sketches,
+        get_storage_backend,
+        set_storage_backend,
+    )
+
+    backend = get_storage_backend()
+    if backend is not None:
+        set_storage_backend(None)
+        backend.close()
+    if fleet is not None:
+        fleet.close()
+    flush_shift_sketches()
+
+    if args.stats:
+        # Example:
+        # python main.py --stats --serve < shifts.ndjson
+        from models.instrumentation import instrumentation
+
+        instrumentation.dump(sys.stdout)
+    return 0
+
 
 if __name__ == "__main__":
-    shift_log_add("ABC1234", 15, 1, 2)
+    sys.exit(main())
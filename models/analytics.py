@@ -0,0 +1,184 @@
+from models.automatic import Vehicle, VehicleType, get_database, log_models
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is an optional dependency
+    np = None
+
+# Offline analytics over the transmission log. Rows are streamed from SQLite
+# with cursor.fetchmany into columnar NumPy arrays and every statistic is
+# computed with vectorized grouping instead of iterating over model objects.
+# The hot table and the live monthly partitions are read as one log.
+
+CHUNK_SIZE = 100000
+
+LOG_COLUMNS = (
+    "vehicle_ref",
+    "type_ref",
+    "gear_speed",
+    "gear_from",
+    "gear_to",
+    "error",
+    "timestamp",
+)
+
+# SQL - SELECT t.vehicle_ref, v.type_ref, t.gear_speed, t.gear_from, t.gear_to, t.error,
+#              CAST(strftime('%s', t.date_timestamp) AS INTEGER)
+#       FROM transmissionlog t JOIN vehicle v ON v.pk = t.vehicle_ref
+#       UNION ALL SELECT ... FROM transmissionlog_YYYYMM t JOIN vehicle v ON v.pk = t.vehicle_ref ...;
+LOG_SQL = (
+    "SELECT t.vehicle_ref, v.type_ref, t.gear_speed, t.gear_from, t.gear_to, "
+    "t.error, CAST(strftime('%s', t.date_timestamp) AS INTEGER) "
+    "FROM {log} AS t JOIN {vehicle} AS v ON v.pk = t.vehicle_ref"
+)
+
+
+def require_numpy() -> None:
+    if np is None:
+        raise ImportError(
+            "numpy is required for analytics, install with pip install numpy"
+        )
+
+
+def iter_log_chunks(chunk_size: int = CHUNK_SIZE, where: str = "", params=()):
+    # Yields {column: ndarray} for every chunk_size rows of the joined log
+    require_numpy()
+    database = get_database()
+    selects = []
+    for Log in log_models():
+        sql = LOG_SQL.format(log=Log._meta.table_name, vehicle=Vehicle._meta.table_name)
+        if where:
+            sql += " WHERE " + where
+        selects.append(sql)
+    # The where clause and its params repeat for every table
+    cursor = database.execute_sql(
+        " UNION ALL ".join(selects), tuple(params) * len(selects)
+    )
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            block = np.array(rows, dtype=np.int64)
+            yield {name: block[:, i] for i, name in enumerate(LOG_COLUMNS)}
+    finally:
+        cursor.close()
+
+
+def load_log(chunk_size: int = CHUNK_SIZE, where: str = "", params=()) -> dict:
+    require_numpy()
+    chunks = list(iter_log_chunks(chunk_size, where, params))
+    if not chunks:
+        return {name: np.empty(0, dtype=np.int64) for name in LOG_COLUMNS}
+    return {
+        name: np.concatenate([chunk[name] for chunk in chunks]) for name in LOG_COLUMNS
+    }
+
+
+def load_vehicles() -> dict:
+    # Vehicle attributes indexed by pk, so log["vehicle_ref"] can index them
+    require_numpy()
+    rows = list(
+        Vehicle.select(Vehicle.pk, Vehicle.vin, Vehicle.type_make, Vehicle.type_year)
+        .tuples()
+        .iterator()
+    )
+    size = max((row[0] for row in rows), default=0) + 1
+    vehicles = {
+        "vin": np.full(size, "", dtype=object),
+        "make": np.full(size, "", dtype=object),
+        "year": np.zeros(size, dtype=np.int64),
+    }
+    for pk, vin, make, year in rows:
+        vehicles["vin"][pk] = vin
+        vehicles["make"][pk] = make
+        vehicles["year"][pk] = year
+    return vehicles
+
+
+def load_type_names() -> dict:
+    return dict(VehicleType.select(VehicleType.pk, VehicleType.type_name).tuples())
+
+
+def _group(keys):
+    # Unique keys, the group index of each row, and rows-per-group counts
+    axis = 0 if keys.ndim > 1 else None
+    unique, inverse, counts = np.unique(
+        keys, return_inverse=True, return_counts=True, axis=axis
+    )
+    return unique, inverse.reshape(-1), counts
+
+
+def shift_speed_summary(
+    log: dict, percentiles=(50, 90, 99), bins=None, type_names: dict = None
+) -> list[dict]:
+    # Mean, percentiles and histogram of shift speed per type and transition
+    require_numpy()
+    if len(log["gear_speed"]) == 0:
+        return []
+    type_names = type_names if type_names is not None else load_type_names()
+    speeds = log["gear_speed"]
+    keys = np.stack([log["type_ref"], log["gear_from"], log["gear_to"]], axis=1)
+    unique, inverse, counts = _group(keys)
+    groups = len(unique)
+    sums = np.bincount(inverse, weights=speeds, minlength=groups)
+    means = sums / counts
+
+    # Sort by (group, speed), then every percentile is an index into its group
+    order = np.lexsort((speeds, inverse))
+    sorted_speeds = speeds[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    quantiles = {}
+    for pct in percentiles:
+        offsets = np.floor((counts - 1) * pct / 100.0).astype(np.int64)
+        quantiles[pct] = sorted_speeds[starts + offsets]
+
+    if bins is None:
+        bins = np.arange(0, int(speeds.max()) + 6, 5)
+    bins = np.asarray(bins)
+    bin_index = np.clip(
+        np.searchsorted(bins, speeds, side="right") - 1, 0, len(bins) - 2
+    )
+    histogram = np.bincount(
+        inverse * (len(bins) - 1) + bin_index, minlength=groups * (len(bins) - 1)
+    ).reshape(groups, len(bins) - 1)
+
+    summary = []
+    for i, (type_ref, gear_from, gear_to) in enumerate(unique.tolist()):
+        summary.append(
+            {
+                "type_name": type_names.get(type_ref, type_ref),
+                "gear_from": gear_from,
+                "gear_to": gear_to,
+                "count": int(counts[i]),
+                "mean": float(means[i]),
+                "percentiles": {pct: int(quantiles[pct][i]) for pct in percentiles},
+                "histogram": {
+                    "bins": bins.tolist(),
+                    "counts": histogram[i].tolist(),
+                },
+            }
+        )
+    return summary
+
+
+def error_rates(log: dict, by: str = "vin", vehicles: dict = None) -> list[dict]:
+    # Shift count, error count and error rate grouped by vin, make or year
+    require_numpy()
+    if by not in ("vin", "make", "year"):
+        raise ValueError("Error rates can be grouped by 'vin', 'make' or 'year'")
+    if len(log["vehicle_ref"]) == 0:
+        return []
+    vehicles = vehicles if vehicles is not None else load_vehicles()
+    unique, inverse, counts = _group(vehicles[by][log["vehicle_ref"]])
+    errors = np.bincount(inverse, weights=log["error"], minlength=len(unique))
+    rates = errors / counts
+    return [
+        {
+            by: key,
+            "shifts": int(counts[i]),
+            "errors": int(errors[i]),
+            "error_rate": float(rates[i]),
+        }
+        for i, key in enumerate(unique.tolist())
+    ]
@@ -0,0 +1,157 @@
+import time
+import asyncio
+from models.automatic import shift_log_add_many
+from models.ingest import IngestStats, parse_event
+
+
+class AsyncIngestService:
+    # asyncio front end for concurrent producers. Connections push parsed
+    # events into a bounded queue, so a full queue stops reading from the
+    # producer sockets (backpressure), and a single writer task drains the
+    # queue into SQLite in batches since SQLite only allows one writer.
+    def __init__(
+        self,
+        queue_size=10000,
+        batch_size=500,
+        writer=shift_log_add_many,
+        executor=None,
+        clock=time.monotonic,
+    ):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.writer = writer
+        # None runs the writer on the event loop thread, which keeps peewee's
+        # per-thread connection; pass a single-thread executor for file dbs.
+        self.executor = executor
+        self.clock = clock
+        self.stats = IngestStats(clock=clock)
+        self._servers = []
+        self._connections = set()
+        self._writer_task = None
+        # Task of the batch being written, see _drain
+        self._in_flight = None
+        self._stopping = False
+
+    async def submit(self, record: tuple) -> None:
+        if self._stopping:
+            raise ValueError("Ingest service is shutting down")
+        self.stats.received += 1
+        await self.queue.put((record, self.clock()))
+
+    def start_writer(self) -> None:
+        if self._writer_task is None:
+            self._writer_task = asyncio.ensure_future(self._drain())
+
+    async def start(self, host=None, port=None, path=None) -> None:
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle, path=path)
+            self._servers.append(server)
+        if port is not None:
+            server = await asyncio.start_server(self._handle, host, port)
+            self._servers.append(server)
+        self.start_writer()
+
+    async def _handle(self, reader, writer) -> None:
+        self._connections.add(writer)
+        try:
+            while not self._stopping:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    record = parse_event(line)
+                except ValueError as exc:
+                    self.stats.received += 1
+                    self.stats.reject(str(exc))
+                    continue
+                await self.submit(record)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _write(self, batch) -> None:
+        records = [record for record, _ in batch]
+        if self.executor is None:
+            results = self.writer(records)
+        else:
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(self.executor, self.writer, records)
+        done = self.clock()
+        self.stats.flushes += 1
+        for result, (_, enqueued_at) in zip(results, batch):
+            if result["logged"]:
+                self.stats.logged += 1
+                self.stats.errors += result["error"]
+                self.stats.latencies.append(done - enqueued_at)
+            else:
+                self.stats.reject(result["message"])
+
+    async def _write_batch(self, batch) -> None:
+        try:
+            await self._write(batch)
+        except Exception as exc:
+            # e.g. "database is locked": the batch is rejected and the
+            # writer carries on with the rest of the queue
+            self.stats.write_failures += 1
+            for _ in batch:
+                self.stats.reject(f"Write failed: {exc}")
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _drain(self) -> None:
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # Shielded, so cancelling the writer while an executor commits a
+            # batch still counts the batch and marks its items done
+            self._in_flight = asyncio.ensure_future(self._write_batch(batch))
+            await asyncio.shield(self._in_flight)
+
+    def _discard_queued(self, message: str) -> None:
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.stats.reject(message)
+            self.queue.task_done()
+
+    async def stop(self) -> dict:
+        # Stop accepting, let in-flight puts land, then drain everything queued
+        self._stopping = True
+        for server in self._servers:
+            server.close()
+        for connection in list(self._connections):
+            connection.close()
+        for server in self._servers:
+            await server.wait_closed()
+        self.start_writer()
+        joined = asyncio.ensure_future(self.queue.join())
+        await asyncio.wait(
+            [joined, self._writer_task], return_when=asyncio.FIRST_COMPLETED
+        )
+        if not joined.done():
+            # The writer task died, nothing queued will be written anymore
+            self._discard_queued("Ingest writer stopped")
+            await joined
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.stats.write_failures += 1
+        if self._in_flight is not None:
+            await self._in_flight
+        return self.stats.report()
+
+
+async def serve(host=None, port=None, path=None, stop_event=None, **options) -> dict:
+    service = AsyncIngestService(**options)
+    await service.start(host=host, port=port, path=path)
+    stop_event = stop_event or asyncio.Event()
+    await stop_event.wait()
+    return await service.stop()
@@ -1,26 +1,110 @@
-from unittest import mock
-from unittest.mock import patch
+import os
+import time
 import datetime
 from collections import namedtuple
-from playhouse.shortcuts import model_to_dict
 from peewee import (
     Model,
     IntegerField,
+    SmallIntegerField,
     CharField,
     AutoField,
     SqliteDatabase,
     BooleanField,
     DateTimeField,
+    DateField,
+    BlobField,
+    Case,
     fn,
+    chunked,
+    EXCLUDED,
+    Value,
+    IntegrityError,
     OperationalError,
 )
+from models.cache import LookupCache
+from models.instrumentation import instrumentation
+from models.sketches import (
+    SketchBuffer,
+    SKETCH_TYPES,
+    SPEED_SAMPLE,
+    SPEED_DIGEST,
+    ERROR_VEHICLES,
+    speed_key,
+)
+from models.rules import (
+    ShiftRuleEngine,
+    DEFAULT_RULES,
+    NO_ERROR,
+    LATE_SHIFT,
+    NO_ERROR_MESSAGE,
+    render_error_message,
+)
+
+# Named pragma profiles for the SQLite connection:
+#   durable   - rollback journal, fsync on every commit (SQLite defaults)
+#   balanced  - WAL, fsync at checkpoints only, readers do not block the writer
+#   bulk-load - WAL without fsync and a large cache, for imports and backfills
+PROFILES = {
+    "durable": {
+        "journal_mode": "delete",
+        "synchronous": "full",
+        "cache_size": -16000,
+        "busy_timeout": 5000,
+    },
+    "balanced": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "busy_timeout": 5000,
+    },
+    "bulk-load": {
+        "journal_mode": "wal",
+        "synchronous": "off",
+        "cache_size": -512000,
+        "mmap_size": 1024 * 1024 * 1024,
+        "temp_store": "memory",
+        "busy_timeout": 30000,
+    },
+}
+
+DATABASE_PATH = os.environ.get("AUTOMATIC_DB", "automatic.db")
+DATABASE_PROFILE = os.environ.get("AUTOMATIC_DB_PROFILE", "balanced")
+
+
+def make_database(
+    path: str = DATABASE_PATH, profile: str = DATABASE_PROFILE
+) -> SqliteDatabase:
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown database profile, please use {sorted(PROFILES)}")
+    return SqliteDatabase(path, pragmas=dict(PROFILES[profile]))
+
+
+db = make_database()
 
-db = SqliteDatabase("automatic.db")
+# TransmissionLog has 8 columns, keep each INSERT below SQLite's 999 variable limit
+BATCH_CHUNK_SIZE = 100
+
+# Vehicles upserted per transaction by add_vehicles_many
+VEHICLE_BATCH_SIZE = 5000
+
+# Attempts, and the first backoff in seconds, for write transactions that find
+# another writer holding the lock once busy_timeout has run out
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.05
+
+# (type_name, fuel_type) of the vehicle types created by preload_config
+PRELOAD_VEHICLE_TYPES = (
+    ("Truck", "Gasoline"),
+    ("Car", "Gasoline"),
+    ("SUV", "Gasoline"),
+    ("Van", "Diesel"),
+)
 
 
 class Vehicle(Model):
     pk = AutoField()
-    vin = CharField()
+    vin = CharField(unique=True)
     type_make = CharField()
     type_year = IntegerField()
     type_ref = IntegerField()
@@ -56,24 +140,262 @@ class TransmissionLog(Model):
     gear_from = IntegerField()
     gear_to = IntegerField()
     error = BooleanField()
-    error_message = CharField()
+    # Error details as a models.rules code plus the threshold speed, the
+    # message is rendered on read by error_message
+    error_code = SmallIntegerField(default=0)
+    expected_speed = SmallIntegerField(null=True)
     date_timestamp = DateTimeField(default=datetime.datetime.now)
 
     class Meta:
         database = db
+        # Composite indexes matching the built-in query shapes, see QUERIES
+        indexes = (
+            (("gear_to", "gear_from", "gear_speed"), False),
+            (("error", "date_timestamp"), False),
+            (("vehicle_ref", "date_timestamp"), False),
+        )
+
+    @property
+    def error_message(self) -> str:
+        return render_error_message(
+            self.error_code,
+            self.gear_speed,
+            self.expected_speed,
+            self.gear_from,
+            self.gear_to,
+        )
+
+
+class ShiftSpeedAggregate(Model):
+    # Running shift speed totals per vehicle type and transition, maintained
+    # in the same transaction as the TransmissionLog inserts.
+    pk = AutoField()
+    vehicle_type_ref = IntegerField()
+    gear_from = IntegerField()
+    gear_to = IntegerField()
+    shift_count = IntegerField(default=0)
+    speed_sum = IntegerField(default=0)
+    speed_min = IntegerField()
+    speed_max = IntegerField()
+    speed_sum_squares = IntegerField(default=0)
+
+    class Meta:
+        database = db
+        indexes = ((("vehicle_type_ref", "gear_from", "gear_to"), True),)
+
+
+class RetiredShiftSpeedAggregate(ShiftSpeedAggregate):
+    # Shift speed totals of the log partitions dropped by retention, so the
+    # aggregates can still be rebuilt once their raw rows are gone.
+    class Meta:
+        table_name = "shiftspeedaggregate_retired"
+
+
+class VehicleErrorRollup(Model):
+    # Shift errors per vehicle per day, maintained alongside TransmissionLog
+    pk = AutoField()
+    vehicle_ref = IntegerField()
+    day = DateField()
+    error_count = IntegerField(default=0)
+
+    class Meta:
+        database = db
+        indexes = (
+            (("vehicle_ref", "day"), True),
+            (("day", "vehicle_ref"), False),
+        )
+
+
+class LogPartition(Model):
+    # Monthly TransmissionLog partitions moved out of the hot table, see
+    # models.partitions. Dropped partitions stay listed with their archive path.
+    pk = AutoField()
+    table_name = CharField(unique=True)
+    month = DateField()
+    row_count = IntegerField(default=0)
+    archived_path = CharField(null=True)
+    dropped = BooleanField(default=False)
+
+    class Meta:
+        database = db
+
+
+class ShiftSketch(Model):
+    # Approximate statistics of the whole log, see models.sketches: a speed
+    # sample and digest per vehicle type and transition ("type:from:to") and
+    # a distinct count of vehicles with errors per day. They outlive the raw
+    # rows of partitions dropped by retention.
+    pk = AutoField()
+    kind = CharField()
+    key = CharField()
+    data = BlobField()
+
+    class Meta:
+        database = db
+        indexes = ((("kind", "key"), True),)
+
+
+class StorageCheckpoint(Model):
+    # Last segment log sequence a buffered storage backend has committed,
+    # written in the same transaction as its rows, see models.storage
+    name = CharField(primary_key=True)
+    sequence = IntegerField(default=0)
+
+    class Meta:
+        database = db
+
+
+class ImportChunk(Model):
+    # Byte range of a bulk import committed so far, keyed by the checkpoint
+    # file of the import and written in the same transaction as its rows,
+    # see models.bulk_import
+    pk = AutoField()
+    checkpoint = CharField()
+    start = IntegerField()
+    logged = IntegerField()
+    rejected = IntegerField()
+
+    class Meta:
+        database = db
+        indexes = ((("checkpoint", "start"), True),)
+
+
+# Records returned by the lookups, built from .tuples() rows instead of model
+# instances. namedtuples have no per-instance __dict__; the *_FIELDS lists are
+# the columns to select, in record order.
+VehicleRecord = namedtuple(
+    "VehicleRecord", ["pk", "vin", "type_make", "type_year", "type_ref"]
+)
+VehicleTypeRecord = namedtuple("VehicleTypeRecord", ["pk", "type_name", "fuel_type"])
+GearChangeRecord = namedtuple(
+    "GearChangeRecord", ["pk", "vehicle_type_ref", "speed", "gear_from", "gear_to"]
+)
+VEHICLE_FIELDS = [getattr(Vehicle, name) for name in VehicleRecord._fields]
+VEHICLE_TYPE_FIELDS = [getattr(VehicleType, name) for name in VehicleTypeRecord._fields]
+GEAR_CHANGE_FIELDS = [
+    getattr(GearChangeConfig, name) for name in GearChangeRecord._fields
+]
+
+
+MODELS = [
+    Vehicle,
+    VehicleType,
+    GearChangeConfig,
+    TransmissionLog,
+    ShiftSpeedAggregate,
+    RetiredShiftSpeedAggregate,
+    VehicleErrorRollup,
+    LogPartition,
+    ShiftSketch,
+    StorageCheckpoint,
+    ImportChunk,
+]
+
+_partition_models = {}
+
+
+def month_start(value) -> datetime.date:
+    return datetime.date(value.year, value.month, 1)
+
+
+def next_month(month: datetime.date) -> datetime.date:
+    return (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def partition_model(month: datetime.date):
+    # TransmissionLog subclass stored in the monthly table transmissionlog_YYYYMM
+    month = month_start(month)
+    table_name = f"{TransmissionLog._meta.table_name}_{month:%Y%m}"
+    model = _partition_models.get(table_name)
+    if model is None:
+        meta = type("Meta", (), {"table_name": table_name})
+        model = type(
+            f"TransmissionLog{month:%Y%m}",
+            (TransmissionLog,),
+            {"Meta": meta, "__module__": __name__},
+        )
+        _partition_models[table_name] = model
+    database = get_database()
+    if model._meta.database is not database:
+        model.bind(database, bind_refs=False, bind_backrefs=False)
+    return model
+
+
+def as_datetime(value) -> datetime.datetime:
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.combine(value, datetime.time())
+
+
+def log_models(
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+    database: SqliteDatabase = None,
+):
+    # The hot TransmissionLog plus every live partition overlapping [start, end),
+    # optionally listed through another connection to the same file
+    models = [TransmissionLog]
+    try:
+        partitions = list(
+            LogPartition.select()
+            .where(LogPartition.dropped == False)
+            .order_by(LogPartition.month)
+            .bind(database or LogPartition._meta.database)
+        )
+    except OperationalError:
+        return models
+    for partition in partitions:
+        first = as_datetime(partition.month)
+        last = as_datetime(next_month(partition.month))
+        if end is not None and first >= as_datetime(end):
+            continue
+        if start is not None and last <= as_datetime(start):
+            continue
+        models.append(partition_model(partition.month))
+    return models
+
+
+def retained_since():
+    # First day still backed by raw log rows, or None if nothing was dropped
+    try:
+        last = (
+            LogPartition.select()
+            .where(LogPartition.dropped == True)
+            .order_by(LogPartition.month.desc())
+            .first()
+        )
+    except OperationalError:
+        return None
+    return next_month(last.month) if last else None
+
+
+def get_database() -> SqliteDatabase:
+    # The database the models are currently bound to
+    return TransmissionLog._meta.database
+
+
+def use_database(
+    path: str = DATABASE_PATH, profile: str = DATABASE_PROFILE
+) -> SqliteDatabase:
+    # Rebinds every model to a new database opened with the given profile
+    global db
+    database = make_database(path, profile)
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    db = database
+    lookup_cache.clear()
+    return database
 
 
 def create_tables() -> None:
-    db.create_tables([Vehicle, VehicleType, GearChangeConfig, TransmissionLog])
+    get_database().create_tables(MODELS)
+    lookup_cache.clear()
 
 
 def preload_config() -> None:
-    with db.atomic():
+    with get_database().atomic():
         if VehicleType.select().count() == 0:
-            VehicleType.create(type_name="Truck", fuel_type="Gasoline")
-            VehicleType.create(type_name="Car", fuel_type="Gasoline")
-            VehicleType.create(type_name="SUV", fuel_type="Gasoline")
-            VehicleType.create(type_name="Van", fuel_type="Diesel")
+            for type_name, fuel_type in PRELOAD_VEHICLE_TYPES:
+                VehicleType.create(type_name=type_name, fuel_type=fuel_type)
         if GearChangeConfig.select().count() == 0:
             for i in range(1, 4):
                 GearChangeConfig.create(
@@ -106,6 +428,7 @@ def preload_config() -> None:
             GearChangeConfig.create(
                 vehicle_type_ref=4, speed=46, gear_from=5, gear_to=6
             )
+    lookup_cache.invalidate_configs()
 
 
 def configs_loaded() -> bool:
@@ -118,65 +441,276 @@ def configs_loaded() -> bool:
 
 
 def tables_exists() -> bool:
-    tables = db.get_tables()
+    tables = get_database().get_tables()
     if len(tables) > 0:
         return True
     return False
 
 
+def migration_transmission_log_indexes() -> None:
+    TransmissionLog._schema.create_indexes(safe=True)
+
+
+def migration_shift_speed_aggregates() -> None:
+    ShiftSpeedAggregate.create_table(safe=True)
+    # The rebuild starts from the retired totals, a table that only
+    # migration_log_partitions used to create
+    RetiredShiftSpeedAggregate.create_table(safe=True)
+    rebuild_shift_speed_aggregates()
+
+
+def migration_vehicle_error_rollups() -> None:
+    VehicleErrorRollup.create_table(safe=True)
+    rebuild_vehicle_error_rollups()
+
+
+def migration_compact_error_codes() -> None:
+    # Replaces the per-row error_message text with error_code/expected_speed.
+    # Rows logged before the rule engine only knew the late shift case.
+    database = get_database()
+    table = TransmissionLog._meta.table_name
+    columns = {column.name for column in database.get_columns(table)}
+    if "error_message" not in columns:
+        return
+    # playhouse.migrate is only needed by databases this old
+    from playhouse.migrate import SqliteMigrator, migrate as apply_operations
+
+    migrator = SqliteMigrator(database)
+    apply_operations(
+        migrator.add_column(table, "error_code", TransmissionLog.error_code),
+        migrator.add_column(table, "expected_speed", TransmissionLog.expected_speed),
+    )
+    # SQL - UPDATE transmissionlog SET error_code = CASE WHEN error THEN 1 ELSE 0 END,
+    #       expected_speed = (SELECT speed FROM gearchangeconfig JOIN vehicle ON type_ref = vehicle_type_ref
+    #                         WHERE vehicle.pk = vehicle_ref AND gearchangeconfig.gear_to = transmissionlog.gear_to);
+    expected = (
+        GearChangeConfig.select(GearChangeConfig.speed)
+        .join(Vehicle, on=(Vehicle.type_ref == GearChangeConfig.vehicle_type_ref))
+        .where(
+            Vehicle.pk == TransmissionLog.vehicle_ref,
+            GearChangeConfig.gear_to == TransmissionLog.gear_to,
+        )
+        .order_by(GearChangeConfig.pk.desc())
+        .limit(1)
+    )
+    TransmissionLog.update(
+        error_code=Case(None, [(TransmissionLog.error == True, LATE_SHIFT)], NO_ERROR),
+        expected_speed=expected,
+    ).execute()
+    apply_operations(migrator.drop_column(table, "error_message"))
+
+
+def migration_log_partitions() -> None:
+    LogPartition.create_table(safe=True)
+    RetiredShiftSpeedAggregate.create_table(safe=True)
+
+
+def migration_shift_sketches() -> None:
+    ShiftSketch.create_table(safe=True)
+    rebuild_shift_sketches()
+
+
+def migration_storage_checkpoints() -> None:
+    StorageCheckpoint.create_table(safe=True)
+
+
+def migration_import_chunks() -> None:
+    ImportChunk.create_table(safe=True)
+
+
+def migration_unique_vehicle_vin() -> None:
+    # Merges vehicles registered more than once into the first registration,
+    # the one the lookups resolved to, then adds the unique index on vin.
+    # SQL - SELECT vehicle.pk, first.keep FROM vehicle
+    #       JOIN (SELECT vin, MIN(pk) AS keep FROM vehicle GROUP BY vin HAVING COUNT(pk) > 1) AS first
+    #       ON first.vin = vehicle.vin WHERE vehicle.pk != first.keep;
+    first = (
+        Vehicle.select(Vehicle.vin, fn.MIN(Vehicle.pk).alias("keep"))
+        .group_by(Vehicle.vin)
+        .having(fn.COUNT(Vehicle.pk) > 1)
+        .alias("first")
+    )
+    duplicates = {}
+    query = (
+        Vehicle.select(Vehicle.pk, first.c.keep)
+        .join(first, on=(first.c.vin == Vehicle.vin))
+        .where(Vehicle.pk != first.c.keep)
+    )
+    for pk, keep in query.tuples():
+        duplicates.setdefault(keep, []).append(pk)
+    Rollup = VehicleErrorRollup
+    for keep, pks in duplicates.items():
+        for Log in log_models():
+            Log.update(vehicle_ref=keep).where(Log.vehicle_ref.in_(pks)).execute()
+        # SQL - INSERT INTO vehicleerrorrollup (vehicle_ref, day, error_count)
+        #       SELECT keep, day, error_count FROM vehicleerrorrollup WHERE vehicle_ref IN (...)
+        #       ON CONFLICT (vehicle_ref, day) DO UPDATE SET error_count = error_count + excluded.error_count;
+        Rollup.insert_from(
+            Rollup.select(Value(keep), Rollup.day, Rollup.error_count).where(
+                Rollup.vehicle_ref.in_(pks)
+            ),
+            [Rollup.vehicle_ref, Rollup.day, Rollup.error_count],
+        ).on_conflict(**vehicle_error_rollup_conflict()).execute()
+        Rollup.delete().where(Rollup.vehicle_ref.in_(pks)).execute()
+        Vehicle.delete().where(Vehicle.pk.in_(pks)).execute()
+    Vehicle._schema.create_indexes(safe=True)
+
+
+# Schema migrations, applied in order. The position in this list is the schema
+# version stored in PRAGMA user_version, so only ever append to it.
+MIGRATIONS = [
+    migration_transmission_log_indexes,
+    migration_shift_speed_aggregates,
+    migration_vehicle_error_rollups,
+    migration_compact_error_codes,
+    migration_log_partitions,
+    migration_unique_vehicle_vin,
+    migration_shift_sketches,
+    migration_storage_checkpoints,
+    migration_import_chunks,
+]
+
+
+def schema_version() -> int:
+    return get_database().pragma("user_version")
+
+
+def migrate() -> int:
+    database = get_database()
+    version = schema_version()
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with database.atomic():
+            migration()
+            database.pragma("user_version", number)
+    # Give back the pages freed by migrations that rewrote or dropped data
+    if version < len(MIGRATIONS) and database.pragma("freelist_count"):
+        database.execute_sql("VACUUM")
+    return len(MIGRATIONS)
+
+
 def check_existance() -> SqliteDatabase:
+    # An up to date schema is recognised from PRAGMA user_version alone,
+    # without listing the tables
+    if schema_version() == len(MIGRATIONS):
+        return get_database()
     if not tables_exists():
         create_tables()
         if not configs_loaded():
             preload_config()
-        return db
-    return db
+    migrate()
+    return get_database()
 
 
 def get_vehicle_type(vtype: str) -> list[str]:
     vtype_name = vtype.capitalize()
-    VehicleTypeObj = namedtuple("VehicleTypeObj", ["pk", "type_name", "fuel_type"])
-    typex = VehicleType.select().where(VehicleType.type_name == vtype_name)
-    if not typex.exists():
+    row = (
+        VehicleType.select(*VEHICLE_TYPE_FIELDS)
+        .where(VehicleType.type_name == vtype_name)
+        .order_by(VehicleType.pk.desc())
+        .tuples()
+        .first()
+    )
+    if row is None:
         return False
-    for types in typex:
-        VehicleTypeData = VehicleTypeObj(**model_to_dict(types))
-    return VehicleTypeData
+    return VehicleTypeRecord._make(row)
 
 
 def get_vehicle(vin: str) -> object:
-    try:
-        vehicle = Vehicle.select().where(Vehicle.vin == vin).get()
-        VehicleObj = namedtuple(
-            "VehicleObj", ["pk", "vin", "type_make", "type_year", "type_ref"]
-        )
-        VehicleData = VehicleObj(**model_to_dict(vehicle))
-        return VehicleData
-    except Vehicle.DoesNotExist:
+    row = vehicle_lookup_query(vin).tuples().first()
+    if row is None:
         raise ValueError("Vehicle does not exist")
+    return VehicleRecord._make(row)
 
 
 def get_gear_config_by_vtid_gearto(vtid: int, gear_to: int) -> object:
-    gearChangeData = None
-    gearChangeObj = namedtuple(
-        "gearChangeObj", ["pk", "vehicle_type_ref", "speed", "gear_from", "gear_to"]
-    )
-    configs = GearChangeConfig.select().where(
-        GearChangeConfig.vehicle_type_ref == vtid, GearChangeConfig.gear_to == gear_to
+    row = (
+        GearChangeConfig.select(*GEAR_CHANGE_FIELDS)
+        .where(
+            GearChangeConfig.vehicle_type_ref == vtid,
+            GearChangeConfig.gear_to == gear_to,
+        )
+        .order_by(GearChangeConfig.pk.desc())
+        .tuples()
+        .first()
     )
-    for config in configs:
-        gearChangeData = gearChangeObj(**model_to_dict(config))
-    return gearChangeData
+    return GearChangeRecord._make(row) if row is not None else None
 
 
 def get_vehicle_type_ref(vtype_id: str) -> object:
-    VehicleTypeObj = namedtuple("VehicleTypeObj", ["pk", "type_name", "fuel_type"])
-    try:
-        vehicle_type = VehicleType.select().where(VehicleType.pk == vtype_id).get()
-        VehicleTypeData = VehicleTypeObj(**model_to_dict(vehicle_type))
-        return VehicleTypeData
-    except VehicleType.DoesNotExist:
+    row = (
+        VehicleType.select(*VEHICLE_TYPE_FIELDS)
+        .where(VehicleType.pk == vtype_id)
+        .tuples()
+        .first()
+    )
+    if row is None:
         raise ValueError("Vehicle type does not exist")
+    return VehicleTypeRecord._make(row)
+
+
+def load_gear_configs() -> dict:
+    # Later configs for the same (vehicle_type_ref, gear_to) win
+    query = GearChangeConfig.select(*GEAR_CHANGE_FIELDS).order_by(GearChangeConfig.pk)
+    configs = {}
+    for config in map(GearChangeRecord._make, query.tuples()):
+        configs[(config.vehicle_type_ref, config.gear_to)] = config
+    return configs
+
+
+def load_vehicle_types() -> dict:
+    query = VehicleType.select(*VEHICLE_TYPE_FIELDS)
+    return {row[0]: VehicleTypeRecord._make(row) for row in query.tuples()}
+
+
+def load_vehicles(vins: list[str]) -> dict:
+    # One indexed lookup per VIN, chunked below SQLite's variable limit
+    vehicles = {}
+    for chunk in chunked(vins, 500):
+        query = Vehicle.select(*VEHICLE_FIELDS).where(Vehicle.vin.in_(chunk))
+        for row in query.tuples():
+            vehicles[row[1]] = VehicleRecord._make(row)
+    return vehicles
+
+
+lookup_cache = LookupCache(load_gear_configs, load_vehicle_types, load_vehicles)
+
+# Sketch updates of this process not merged into ShiftSketch yet
+shift_sketches = SketchBuffer()
+
+# Rules applied when logging shifts, see models.rules
+SHIFT_RULES = DEFAULT_RULES
+
+_rule_engine = None
+_rule_engine_configs = None
+
+# Backend that store_shift_logs hands logged rows to, see models.storage. With
+# none set the rows are committed by the calling thread.
+_storage_backend = None
+
+
+def set_shift_rules(rules) -> None:
+    global SHIFT_RULES, _rule_engine
+    SHIFT_RULES = frozenset(rules)
+    _rule_engine = None
+
+
+def set_storage_backend(backend) -> None:
+    global _storage_backend
+    _storage_backend = backend
+
+
+def get_storage_backend():
+    return _storage_backend
+
+
+def rule_engine() -> ShiftRuleEngine:
+    # Recompiled whenever lookup_cache reloads the gear configs
+    global _rule_engine, _rule_engine_configs
+    configs = lookup_cache.gear_configs()
+    if _rule_engine is None or configs is not _rule_engine_configs:
+        _rule_engine = ShiftRuleEngine.from_configs(configs, rules=SHIFT_RULES)
+        _rule_engine_configs = configs
+    return _rule_engine
 
 
 def is_error(gear_speed: int, actual_speed: int, gear_from: int, gear_to: int) -> bool:
@@ -202,23 +736,289 @@ def shift_log_add(
     gear_from: int,
     gear_to: int,
 ) -> None:
-    vehicle = get_vehicle(vin)
-    vtObj = VehicleType.get(VehicleType.pk == vehicle.type_ref)
-    vehicle_type = get_vehicle_type(vtObj.type_name)
-    config = get_gear_config_by_vtid_gearto(vehicle_type.pk, gear_to)
-    error = is_error(config.speed, gear_speed, gear_from, gear_to)
-    with db.atomic():
-        TransmissionLog.create(
-            vehicle_ref=vehicle.pk,
-            gear_speed=gear_speed,
-            gear_from=gear_from,
-            gear_to=gear_to,
-            error=error["error"],
-            error_message=error["message"],
+    started = instrumentation.clock()
+    vehicle = lookup_cache.vehicle(vin)
+    started = instrumentation.lap("vehicle_lookup", started)
+    engine = rule_engine()
+    started = instrumentation.lap("config_lookup", started)
+    code, expected = engine.evaluate(vehicle.type_ref, gear_speed, gear_from, gear_to)
+    instrumentation.lap("is_error", started)
+    instrumentation.incr("events")
+    if code < 0:
+        raise ValueError(
+            render_error_message(code, gear_speed, expected, gear_from, gear_to)
         )
+    row = {
+        "vehicle_ref": vehicle.pk,
+        "gear_speed": gear_speed,
+        "gear_from": gear_from,
+        "gear_to": gear_to,
+        "error": code != NO_ERROR,
+        "error_code": code,
+        "expected_speed": expected,
+        "date_timestamp": datetime.datetime.now(),
+    }
+    store_shift_logs([(vehicle.type_ref, row)])
     return None
 
 
+def classify_shift_records(records, vehicles: dict, engine: ShiftRuleEngine):
+    # records: list of (vin, speed, gear_from, gear_to, timestamp), vehicles:
+    # {vin: object with pk and type_ref}. Returns (results, entries) where
+    # entries are the rows to pass to write_shift_logs.
+    results = []
+    entries = []
+    events = []
+    for vin, gear_speed, gear_from, gear_to, _ in records:
+        vehicle = vehicles.get(vin)
+        type_ref = vehicle.type_ref if vehicle is not None else None
+        events.append((type_ref, gear_speed, gear_from, gear_to))
+    evaluated = engine.evaluate_many(events)
+    for record, (code, expected) in zip(records, evaluated):
+        vin, gear_speed, gear_from, gear_to, timestamp = record
+        result = {"vin": vin, "logged": False, "error": False, "message": ""}
+        results.append(result)
+        vehicle = vehicles.get(vin)
+        if vehicle is None:
+            result["message"] = "Vehicle does not exist"
+            continue
+        if code < 0:
+            result["message"] = render_error_message(
+                code, gear_speed, expected, gear_from, gear_to
+            )
+            continue
+        message = NO_ERROR_MESSAGE
+        if code != NO_ERROR:
+            message = render_error_message(
+                code, gear_speed, expected, gear_from, gear_to
+            )
+        result.update(logged=True, error=code != NO_ERROR, message=message, code=code)
+        row = {
+            "vehicle_ref": vehicle.pk,
+            "gear_speed": gear_speed,
+            "gear_from": gear_from,
+            "gear_to": gear_to,
+            "error": code != NO_ERROR,
+            "error_code": code,
+            "expected_speed": expected,
+            "date_timestamp": timestamp or datetime.datetime.now(),
+        }
+        entries.append((vehicle.type_ref, row))
+    return results, entries
+
+
+def shift_log_add_many(records, chunk_size: int = BATCH_CHUNK_SIZE) -> list[dict]:
+    # records: iterable of (vin, speed, gear_from, gear_to, timestamp)
+    # Returns one result per record, in order. Records that cannot be logged
+    # are reported with logged=False instead of aborting the batch.
+    records = list(records)
+    started = instrumentation.clock()
+    vehicles = lookup_cache.vehicles(record[0] for record in records)
+    started = instrumentation.lap("vehicle_lookup", started)
+    results, entries = classify_shift_records(records, vehicles, rule_engine())
+    # Rule evaluation for the whole batch
+    instrumentation.lap("classify", started)
+    instrumentation.incr("events", len(records))
+    instrumentation.incr("rejected", len(records) - len(entries))
+    store_shift_logs(entries, chunk_size)
+    return results
+
+
+def store_shift_logs(entries, chunk_size: int = BATCH_CHUNK_SIZE) -> None:
+    # entries as for write_shift_logs. A buffered backend acknowledges them
+    # before they are committed, so queries may not see them yet.
+    if _storage_backend is None:
+        write_shift_logs(entries, chunk_size)
+    else:
+        _storage_backend.write(entries)
+
+
+def write_shift_logs(entries, chunk_size: int = BATCH_CHUNK_SIZE) -> None:
+    # entries: list of (vehicle_type_ref, TransmissionLog row dict). The rows
+    # and the aggregates derived from them are written in one transaction,
+    # then the sketches are updated.
+    if not entries:
+        return
+    # "write" covers insert and commit, "insert" only the statements
+    write_started = instrumentation.clock()
+    write_transaction(lambda: insert_shift_logs(entries, chunk_size))
+    instrumentation.lap("write", write_started)
+    sketch_shift_logs(entries)
+
+
+def insert_shift_logs(entries, chunk_size: int = BATCH_CHUNK_SIZE) -> None:
+    # The statements of write_shift_logs, for callers committing them in a
+    # transaction of their own. sketch_shift_logs follows once that commits.
+    aggregates = {}
+    error_days = {}
+    for type_ref, row in entries:
+        if row["error"]:
+            day_key = (row["vehicle_ref"], row["date_timestamp"].date())
+            error_days[day_key] = error_days.get(day_key, 0) + 1
+        speed = row["gear_speed"]
+        key = (type_ref, row["gear_from"], row["gear_to"])
+        if key not in aggregates:
+            aggregates[key] = [0, 0, speed, speed, 0]
+        totals = aggregates[key]
+        totals[0] += 1
+        totals[1] += speed
+        totals[2] = min(totals[2], speed)
+        totals[3] = max(totals[3], speed)
+        totals[4] += speed * speed
+    started = instrumentation.clock()
+    for chunk in chunked([row for _, row in entries], chunk_size):
+        TransmissionLog.insert_many(chunk).execute()
+    for key, totals in aggregates.items():
+        upsert_shift_speed_aggregate(*key, *totals)
+    for (vehicle_ref, day), error_count in error_days.items():
+        upsert_vehicle_error_rollup(vehicle_ref, day, error_count)
+    instrumentation.lap("insert", started)
+
+
+def sketch_shift_logs(entries) -> None:
+    # Sketches are updated in memory once the rows are committed and merged
+    # into ShiftSketch when due, see models.sketches.SketchBuffer. Memory is
+    # not rolled back, so this never runs inside a transaction that may still
+    # fail and be retried.
+    started = instrumentation.clock()
+    instrumentation.incr("logged", len(entries))
+    add_sketch = shift_sketches.add
+    for type_ref, row in entries:
+        add_sketch(
+            type_ref,
+            row["vehicle_ref"],
+            row["gear_speed"],
+            row["gear_from"],
+            row["gear_to"],
+            row["error"],
+            row["date_timestamp"].date(),
+        )
+    if shift_sketches.due():
+        flush_shift_sketches()
+    instrumentation.lap("sketch", started)
+
+
+def is_busy(exc: OperationalError) -> bool:
+    message = str(exc)
+    return "database is locked" in message or "database is busy" in message
+
+
+def write_transaction(function):
+    # Runs function() in a BEGIN IMMEDIATE transaction, which takes the write
+    # lock up front: a deferred transaction that reads before it writes can
+    # fail to upgrade its lock without waiting for busy_timeout. Retried with
+    # exponential backoff while other writers hold the lock. Within an open
+    # transaction it just runs, the outer one holds the lock.
+    database = get_database()
+    if database.in_transaction():
+        return function()
+    for attempt in range(BUSY_RETRIES):
+        try:
+            with database.atomic("IMMEDIATE"):
+                return function()
+        except OperationalError as exc:
+            if not is_busy(exc) or attempt == BUSY_RETRIES - 1:
+                raise
+            instrumentation.incr("busy_retries")
+            time.sleep(BUSY_BACKOFF * 2**attempt)
+
+
+def vehicle_error_rollup_conflict() -> dict:
+    Rollup = VehicleErrorRollup
+    return {
+        "conflict_target": [Rollup.vehicle_ref, Rollup.day],
+        "update": {Rollup.error_count: Rollup.error_count + EXCLUDED.error_count},
+    }
+
+
+def upsert_vehicle_error_rollup(
+    vehicle_ref: int, day: datetime.date, error_count: int
+) -> None:
+    VehicleErrorRollup.insert(
+        vehicle_ref=vehicle_ref, day=day, error_count=error_count
+    ).on_conflict(**vehicle_error_rollup_conflict()).execute()
+
+
+def vehicle_error_rollup_query(Log, since: datetime.date = None):
+    # Errors per vehicle per day of one log table, on or after `since`
+    day = fn.DATE(Log.date_timestamp)
+    query = Log.select(Log.vehicle_ref, day, fn.COUNT(Log.pk)).where(Log.error == True)
+    if since is not None:
+        query = query.where(Log.date_timestamp >= as_datetime(since))
+    return query.group_by(Log.vehicle_ref, day)
+
+
+def shift_speed_aggregate_conflict(Aggregate=ShiftSpeedAggregate) -> dict:
+    return {
+        "conflict_target": [
+            Aggregate.vehicle_type_ref,
+            Aggregate.gear_from,
+            Aggregate.gear_to,
+        ],
+        "update": {
+            Aggregate.shift_count: Aggregate.shift_count + EXCLUDED.shift_count,
+            Aggregate.speed_sum: Aggregate.speed_sum + EXCLUDED.speed_sum,
+            Aggregate.speed_min: fn.MIN(Aggregate.speed_min, EXCLUDED.speed_min),
+            Aggregate.speed_max: fn.MAX(Aggregate.speed_max, EXCLUDED.speed_max),
+            Aggregate.speed_sum_squares: Aggregate.speed_sum_squares
+            + EXCLUDED.speed_sum_squares,
+        },
+    }
+
+
+def shift_speed_aggregate_fields(Aggregate=ShiftSpeedAggregate) -> list:
+    return [
+        Aggregate.vehicle_type_ref,
+        Aggregate.gear_from,
+        Aggregate.gear_to,
+        Aggregate.shift_count,
+        Aggregate.speed_sum,
+        Aggregate.speed_min,
+        Aggregate.speed_max,
+        Aggregate.speed_sum_squares,
+    ]
+
+
+def shift_speed_aggregate_query(Log):
+    # Shift speed totals of one log table, in shift_speed_aggregate_fields order
+    return (
+        Log.select(
+            Vehicle.type_ref,
+            Log.gear_from,
+            Log.gear_to,
+            fn.COUNT(Log.pk),
+            fn.SUM(Log.gear_speed),
+            fn.MIN(Log.gear_speed),
+            fn.MAX(Log.gear_speed),
+            fn.SUM(Log.gear_speed * Log.gear_speed),
+        )
+        .join(Vehicle, on=(Vehicle.pk == Log.vehicle_ref))
+        .group_by(Vehicle.type_ref, Log.gear_from, Log.gear_to)
+    )
+
+
+def upsert_shift_speed_aggregate(
+    vehicle_type_ref: int,
+    gear_from: int,
+    gear_to: int,
+    shift_count: int,
+    speed_sum: int,
+    speed_min: int,
+    speed_max: int,
+    speed_sum_squares: int,
+) -> None:
+    ShiftSpeedAggregate.insert(
+        vehicle_type_ref=vehicle_type_ref,
+        gear_from=gear_from,
+        gear_to=gear_to,
+        shift_count=shift_count,
+        speed_sum=speed_sum,
+        speed_min=speed_min,
+        speed_max=speed_max,
+        speed_sum_squares=speed_sum_squares,
+    ).on_conflict(**shift_speed_aggregate_conflict()).execute()
+
+
 def add_vehicle(vin: str, make: str, year: int, vtype: str) -> None:
     if type(make) != str or type(year) != int or type(vin) != str or type(vtype) != str:
         raise ValueError("Invalid vehicle data")
@@ -226,34 +1026,466 @@ def add_vehicle(vin: str, make: str, year: int, vtype: str) -> None:
     type_name = get_vehicle_type(vtype_proper)
     if type_name.type_name != vtype_proper:
         raise ValueError("Invalid vehicle type")
-    with db.atomic():
-        Vehicle.create(vin=vin, type_make=make, type_year=year, type_ref=type_name.pk)
+    try:
+        write_transaction(
+            lambda: Vehicle.create(
+                vin=vin, type_make=make, type_year=year, type_ref=type_name.pk
+            )
+        )
+    except IntegrityError:
+        raise ValueError("Vehicle already exists")
+    lookup_cache.invalidate_vehicle(vin)
+
+
+def add_vehicles_many(
+    vehicles, batch_size: int = VEHICLE_BATCH_SIZE, chunk_size: int = BATCH_CHUNK_SIZE
+) -> dict:
+    # Registers (vin, make, year, vtype) tuples, batch_size vehicles per
+    # transaction. Known VINs are updated in place (last one wins), invalid
+    # vehicles and type changes of vehicles with logged shifts are counted in
+    # rejections and skipped.
+    type_refs = {
+        name.lower(): pk for name, pk in lookup_cache.vehicle_type_refs().items()
+    }
+    result = {"added": 0, "updated": 0, "rejected": 0, "rejections": {}}
 
+    def reject(message):
+        result["rejected"] += 1
+        result["rejections"][message] = result["rejections"].get(message, 0) + 1
 
-def average_speed_to_fourth_gear():
+    for batch in chunked(vehicles, batch_size):
+        rows = {}
+        for vin, make, year, vtype in batch:
+            if type(make) != str or type(year) != int or type(vin) != str:
+                reject("Invalid vehicle data")
+                continue
+            type_ref = type_refs.get(vtype.lower()) if type(vtype) == str else None
+            if type_ref is None:
+                reject("Invalid vehicle type")
+                continue
+            if vin in rows:
+                result["updated"] += 1
+            rows[vin] = {
+                "vin": vin,
+                "type_make": make,
+                "type_year": year,
+                "type_ref": type_ref,
+            }
+        if not rows:
+            continue
+
+        def write(rows=rows) -> tuple:
+            # Known VINs are read under the write lock, so the added and
+            # updated counts match what the upsert did. The shift aggregates
+            # and sketches are keyed by vehicle type, so a vehicle with
+            # logged shifts keeps its type. Returns (existing, refused).
+            stored = {}
+            for chunk in chunked(rows, 500):
+                query = Vehicle.select(Vehicle.vin, Vehicle.pk, Vehicle.type_ref)
+                for vin, pk, type_ref in query.where(Vehicle.vin.in_(chunk)).tuples():
+                    stored[vin] = (pk, type_ref)
+            retyped = {
+                pk: vin
+                for vin, (pk, type_ref) in stored.items()
+                if rows[vin]["type_ref"] != type_ref
+            }
+            refused = set()
+            # SQL - SELECT DISTINCT vehicle_ref FROM transmissionlog WHERE vehicle_ref IN (...);
+            for Log in log_models() if retyped else ():
+                for chunk in chunked(retyped, 500):
+                    query = Log.select(Log.vehicle_ref).where(
+                        Log.vehicle_ref.in_(chunk)
+                    )
+                    refused.update(retyped[pk] for (pk,) in query.distinct().tuples())
+            # SQL - INSERT INTO vehicle (vin, type_make, type_year, type_ref) VALUES (...)
+            #       ON CONFLICT (vin) DO UPDATE SET type_make = excluded.type_make,
+            #       type_year = excluded.type_year, type_ref = excluded.type_ref;
+            written = [row for vin, row in rows.items() if vin not in refused]
+            for chunk in chunked(written, chunk_size):
+                Vehicle.insert_many(chunk).on_conflict(
+                    conflict_target=[Vehicle.vin],
+                    preserve=[Vehicle.type_make, Vehicle.type_year, Vehicle.type_ref],
+                ).execute()
+            return set(stored), refused
+
+        existing, refused = write_transaction(write)
+        result["added"] += len(rows) - len(existing)
+        result["updated"] += len(existing) - len(refused)
+        for vin in refused:
+            reject("Vehicle type cannot change once shifts are logged")
+        for vin in existing - refused:
+            lookup_cache.invalidate_vehicle(vin)
+    return result
+
+
+def average_speed_to_fourth_gear_query():
     # SQL - SELECT AVG(gear_speed) FROM transmissionlog WHERE (gear_to = 4);
-    average_speed = (
-        TransmissionLog.select(
-            fn.AVG(TransmissionLog.gear_speed).coerce(False).alias("average_speed")
+    return TransmissionLog.select(
+        fn.AVG(TransmissionLog.gear_speed).coerce(False).alias("average_speed")
+    ).where(TransmissionLog.gear_to == 4)
+
+
+def average_speed_to_fourth_gear(database: SqliteDatabase = None):
+    # `database` runs the queries on another connection, see models.query_service
+    database = database or get_database()
+    models = log_models(database=database)
+    if len(models) == 1:
+        average_speed = average_speed_to_fourth_gear_query().bind(database).scalar()
+        return average_speed
+    # Rotated partitions hold part of the log, combine their sums and counts
+    total, count = fourth_gear_speed_totals(database)
+    return total / count if count else None
+
+
+def fourth_gear_speed_totals(database: SqliteDatabase = None) -> tuple:
+    # (speed sum, shifts) into fourth gear over the hot table and the live
+    # partitions, the partial aggregate behind average_speed_to_fourth_gear
+    database = database or get_database()
+    total = count = 0
+    for Log in log_models(database=database):
+        speed_sum, shifts = (
+            Log.select(fn.SUM(Log.gear_speed), fn.COUNT(Log.pk))
+            .where(Log.gear_to == 4)
+            .bind(database)
+            .tuples()
+            .get()
         )
-        .where(TransmissionLog.gear_to == 4)
-        .scalar()
+        total += speed_sum or 0
+        count += shifts
+    return total, count
+
+
+def error_frequency_previous_last_week_query(
+    before: datetime.date = None, since: datetime.date = None
+):
+    # Vehicles with errors before `before` (default one month ago) that also
+    # had errors on or after `since` (default 7 days ago), from the rollups.
+    # SQL - SELECT vin, SUM(CASE WHEN day < DATE('now', '-30 day') THEN error_count END) AS errors_before,
+    #              SUM(CASE WHEN day >= DATE('now', '-7 day') THEN error_count END) AS errors_since
+    #       FROM vehicleerrorrollup JOIN vehicle ON vehicle.pk = vehicle_ref
+    #       GROUP BY vehicle_ref HAVING errors_before > 0 AND errors_since > 0;
+    today = datetime.date.today()
+    before = before or today - datetime.timedelta(days=30)
+    since = since or today - datetime.timedelta(days=7)
+    Rollup = VehicleErrorRollup
+    errors_before = fn.SUM(Case(None, [(Rollup.day < before, Rollup.error_count)], 0))
+    errors_since = fn.SUM(Case(None, [(Rollup.day >= since, Rollup.error_count)], 0))
+    return (
+        Rollup.select(
+            Vehicle.vin,
+            errors_before.alias("errors_before"),
+            errors_since.alias("errors_since"),
+        )
+        .join(Vehicle, on=(Vehicle.pk == Rollup.vehicle_ref))
+        .where((Rollup.day < before) | (Rollup.day >= since))
+        .group_by(Rollup.vehicle_ref)
+        .having((errors_before > 0) & (errors_since > 0))
+        .order_by(Vehicle.vin)
     )
-    return average_speed
 
 
-def error_frequency_previous_last_week():
-    # SQL - SELECT COUNT(error) FROM transmissionlog WHERE (date_timestamp BETWEEN DATE('now', '-7 day') AND DATE('now'));
-    # SQL - SELECT vin FROM transmissionlog WHERE (date_timestamp BETWEEN DATE('now', '-7 day') AND (date_timestamp > DATE('now', '-30 day') AND error = 1)
-    error_frequency = (
-        TransmissionLog.select(fn.COUNT(TransmissionLog.error).alias("error_frequency"))
-        .where(
-            TransmissionLog.date_timestamp
-            >= datetime.datetime.now() - datetime.timedelta(days=7),
-            TransmissionLog.date_timestamp
-            <= datetime.datetime.now() - datetime.timedelta(days=30),
-            TransmissionLog.error == 1,
+def error_frequency_previous_last_week(
+    before: datetime.date = None,
+    since: datetime.date = None,
+    database: SqliteDatabase = None,
+) -> list[dict]:
+    query = error_frequency_previous_last_week_query(before, since)
+    return list(query.bind(database or get_database()).dicts())
+
+
+def rebuild_vehicle_error_rollups() -> int:
+    # SQL - INSERT INTO vehicleerrorrollup (vehicle_ref, day, error_count)
+    #       SELECT vehicle_ref, DATE(date_timestamp), COUNT(*) FROM transmissionlog WHERE error = 1
+    #       GROUP BY vehicle_ref, DATE(date_timestamp);
+    # Live partitions are folded in after the hot table. Days of partitions
+    # dropped by retention have no raw rows left and are kept as they are.
+    Rollup = VehicleErrorRollup
+    since = retained_since()
+    with get_database().atomic():
+        if since is None:
+            Rollup.delete().execute()
+        else:
+            Rollup.delete().where(Rollup.day >= since).execute()
+        for Log in log_models(start=since):
+            Rollup.insert_from(
+                vehicle_error_rollup_query(Log, since),
+                [Rollup.vehicle_ref, Rollup.day, Rollup.error_count],
+            ).on_conflict(**vehicle_error_rollup_conflict()).execute()
+    return Rollup.select().count()
+
+
+def rebuild_shift_speed_aggregates() -> int:
+    # Recomputes ShiftSpeedAggregate from the raw log
+    # SQL - INSERT INTO shiftspeedaggregate (...) SELECT type_ref, gear_from, gear_to, COUNT(*), SUM(gear_speed), ...
+    #       FROM transmissionlog JOIN vehicle ON vehicle.pk = vehicle_ref GROUP BY type_ref, gear_from, gear_to;
+    # Starts from the totals retired with dropped partitions, then folds in
+    # the hot table and the live partitions.
+    Aggregate = ShiftSpeedAggregate
+    Retired = RetiredShiftSpeedAggregate
+    fields = shift_speed_aggregate_fields()
+    with get_database().atomic():
+        Aggregate.delete().execute()
+        Aggregate.insert_from(
+            Retired.select(*shift_speed_aggregate_fields(Retired)), fields
+        ).execute()
+        for Log in log_models():
+            Aggregate.insert_from(shift_speed_aggregate_query(Log), fields).on_conflict(
+                **shift_speed_aggregate_conflict()
+            ).execute()
+    return Aggregate.select().count()
+
+
+def shift_speed_totals(
+    gear_from: int = 3, gear_to: int = 4, database: SqliteDatabase = None
+) -> list[tuple]:
+    # (vehicle_type_ref, type_name, count, sum, sum of squares, min, max) per
+    # vehicle type from ShiftSpeedAggregate, the partial aggregates the stats
+    # are computed from
+    # SQL - SELECT vehicle_type_ref, type_name, shift_count, speed_sum, speed_sum_squares, speed_min, speed_max
+    #       FROM shiftspeedaggregate JOIN vehicletype ON vehicletype.pk = vehicle_type_ref
+    #       WHERE gear_from = ? AND gear_to = ? ORDER BY vehicle_type_ref;
+    Aggregate = ShiftSpeedAggregate
+    query = (
+        Aggregate.select(
+            Aggregate.vehicle_type_ref,
+            VehicleType.type_name,
+            Aggregate.shift_count,
+            Aggregate.speed_sum,
+            Aggregate.speed_sum_squares,
+            Aggregate.speed_min,
+            Aggregate.speed_max,
         )
-        .scalar()
+        .join(VehicleType, on=(VehicleType.pk == Aggregate.vehicle_type_ref))
+        .where(Aggregate.gear_from == gear_from, Aggregate.gear_to == gear_to)
+        .order_by(Aggregate.vehicle_type_ref)
     )
-    return error_frequency
+    return list(query.bind(database or get_database()).tuples())
+
+
+def speed_stats(
+    type_name: str,
+    gear_from: int,
+    gear_to: int,
+    count: int,
+    speed_sum: int,
+    sum_squares: int,
+    speed_min: int,
+    speed_max: int,
+) -> dict:
+    average = speed_sum / count
+    return {
+        "type_name": type_name,
+        "gear_from": gear_from,
+        "gear_to": gear_to,
+        "count": count,
+        "average": average,
+        "variance": max(0.0, sum_squares / count - average * average),
+        "min": speed_min,
+        "max": speed_max,
+    }
+
+
+def shift_speed_stats(
+    gear_from: int = 3, gear_to: int = 4, database: SqliteDatabase = None
+) -> list[dict]:
+    # Average speed that causes a gear to change from gear_from to gear_to by
+    # vehicle type, read from ShiftSpeedAggregate instead of the raw log.
+    return [
+        speed_stats(row[1], gear_from, gear_to, *row[2:])
+        for row in shift_speed_totals(gear_from, gear_to, database)
+    ]
+
+
+def load_shift_sketches(kind: str, keys=None) -> dict:
+    # {key: sketch} of one kind, every key by default
+    query = ShiftSketch.select(ShiftSketch.key, ShiftSketch.data).where(
+        ShiftSketch.kind == kind
+    )
+    if keys is not None:
+        query = query.where(ShiftSketch.key.in_(list(keys)))
+    from_blob = SKETCH_TYPES[kind].from_blob
+    return {key: from_blob(bytes(data)) for key, data in query.tuples()}
+
+
+def save_shift_sketches(sketches: dict) -> None:
+    # sketches: {(kind, key): sketch}, replacing the stored ones
+    # SQL - INSERT INTO shiftsketch (kind, key, data) VALUES (...)
+    #       ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data;
+    rows = [
+        {"kind": kind, "key": key, "data": sketch.to_blob()}
+        for (kind, key), sketch in sketches.items()
+    ]
+    for chunk in chunked(rows, BATCH_CHUNK_SIZE):
+        ShiftSketch.insert_many(chunk).on_conflict(
+            conflict_target=[ShiftSketch.kind, ShiftSketch.key],
+            preserve=[ShiftSketch.data],
+        ).execute()
+
+
+def flush_shift_sketches() -> int:
+    # Merges the pending sketch updates into ShiftSketch, returns the events
+    pending, events = shift_sketches.drain()
+    if not pending:
+        return 0
+    by_kind = {}
+    for kind, key in pending:
+        by_kind.setdefault(kind, []).append(key)
+
+    def merge() -> None:
+        # Merged into fresh copies of the stored sketches, so a retry does
+        # not count the pending updates twice
+        merged = dict(pending)
+        for kind, keys in by_kind.items():
+            for chunk in chunked(keys, 500):
+                for key, stored in load_shift_sketches(kind, chunk).items():
+                    stored.merge(pending[(kind, key)])
+                    merged[(kind, key)] = stored
+        save_shift_sketches(merged)
+
+    try:
+        write_transaction(merge)
+    except Exception:
+        # Kept for the next flush instead of lost
+        shift_sketches.restore(pending, events)
+        raise
+    return events
+
+
+def rebuild_shift_sketches() -> int:
+    # Recomputes the sketches from the raw rows still in the log. Rows of
+    # partitions dropped by retention are no longer represented afterwards.
+    buffer = SketchBuffer()
+    rows = 0
+    for Log in log_models():
+        # SQL - SELECT type_ref, vehicle_ref, gear_speed, gear_from, gear_to, error, date_timestamp
+        #       FROM transmissionlog JOIN vehicle ON vehicle.pk = vehicle_ref;
+        query = (
+            Log.select(
+                Vehicle.type_ref,
+                Log.vehicle_ref,
+                Log.gear_speed,
+                Log.gear_from,
+                Log.gear_to,
+                Log.error,
+                Log.date_timestamp,
+            )
+            .join(Vehicle, on=(Vehicle.pk == Log.vehicle_ref))
+            .tuples()
+        )
+        for (
+            type_ref,
+            vehicle_ref,
+            speed,
+            gear_from,
+            gear_to,
+            error,
+            timestamp,
+        ) in query.iterator():
+            buffer.add(
+                type_ref,
+                vehicle_ref,
+                speed,
+                gear_from,
+                gear_to,
+                error,
+                as_datetime(timestamp).date(),
+            )
+            rows += 1
+    with get_database().atomic():
+        ShiftSketch.delete().execute()
+        save_shift_sketches(buffer.take())
+    return rows
+
+
+def approximate_shift_speed_stats(
+    gear_from: int = 3, gear_to: int = 4, quantiles=(0.5, 0.9, 0.99)
+) -> list[dict]:
+    # shift_speed_stats from the sketches: the sampled average with its 95%
+    # confidence half-width and t-digest quantiles with their rank error
+    flush_shift_sketches()
+    stats = []
+    for type_ref, vehicle_type in sorted(load_vehicle_types().items()):
+        key = speed_key(type_ref, gear_from, gear_to)
+        sample = load_shift_sketches(SPEED_SAMPLE, [key]).get(key)
+        digest = load_shift_sketches(SPEED_DIGEST, [key]).get(key)
+        if sample is None or digest is None:
+            continue
+        average, error = sample.mean()
+        row = {
+            "type_name": vehicle_type.type_name,
+            "gear_from": gear_from,
+            "gear_to": gear_to,
+            "count": sample.count,
+            "average": average,
+            "average_error": error,
+            "quantiles": {},
+        }
+        for q in quantiles:
+            estimate, rank_error = digest.quantile(q)
+            row["quantiles"][f"p{q * 100:g}"] = {
+                "speed": estimate,
+                "rank_error": rank_error,
+            }
+        stats.append(row)
+    return stats
+
+
+def approximate_average_speed_to_fourth_gear() -> dict:
+    # Stratified estimate over the speed samples of every transition into
+    # fourth gear: {"average", "error" (95% half-width), "count"}
+    flush_shift_sketches()
+    count = total = variance = 0
+    samples = [
+        sample
+        for key, sample in load_shift_sketches(SPEED_SAMPLE).items()
+        if key.endswith(":4")
+    ]
+    for sample in samples:
+        count += sample.count
+    for sample in samples:
+        average, error = sample.mean()
+        weight = sample.count / count
+        total += weight * average
+        variance += (weight * error / 1.96) ** 2
+    if not count:
+        return {"average": None, "error": None, "count": 0}
+    return {"average": total, "error": 1.96 * variance**0.5, "count": count}
+
+
+def approximate_error_vehicles(
+    start: datetime.date = None, end: datetime.date = None
+) -> dict:
+    # Distinct vehicles with shift errors on days start <= day < end, from the
+    # union of the daily HyperLogLogs: {"vehicles", "relative_error"}
+    flush_shift_sketches()
+    union = SKETCH_TYPES[ERROR_VEHICLES]()
+    for day, sketch in load_shift_sketches(ERROR_VEHICLES).items():
+        if start is not None and day < start.isoformat():
+            continue
+        if end is not None and day >= end.isoformat():
+            continue
+        union.merge(sketch)
+    return {"vehicles": union.count(), "relative_error": union.relative_error}
+
+
+def vehicle_lookup_query(vin: str = ""):
+    # SQL - SELECT pk, vin, type_make, type_year, type_ref FROM vehicle WHERE (vin = ?);
+    return Vehicle.select(*VEHICLE_FIELDS).where(Vehicle.vin == vin)
+
+
+# Built-in queries by name, used to check their plans with explain_queries()
+QUERIES = {
+    "vehicle_lookup": vehicle_lookup_query,
+    "average_speed_to_fourth_gear": average_speed_to_fourth_gear_query,
+    "error_frequency_previous_last_week": error_frequency_previous_last_week_query,
+}
+
+
+def explain_query_plan(query) -> list[str]:
+    sql, params = query.sql()
+    cursor = query.model._meta.database.execute_sql("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def explain_queries() -> dict:
+    return {name: explain_query_plan(build()) for name, build in QUERIES.items()}
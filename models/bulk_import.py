@@ -0,0 +1,272 @@
+import os
+import csv
+import json
+import datetime
+import multiprocessing
+from collections import namedtuple
+from models.automatic import (
+    Vehicle,
+    ImportChunk,
+    BATCH_CHUNK_SIZE,
+    classify_shift_records,
+    configs_loaded,
+    get_database,
+    preload_config,
+    rule_engine,
+    insert_shift_logs,
+    sketch_shift_logs,
+    write_transaction,
+)
+from models.ingest import parse_event
+from models.query_service import make_read_database
+
+# Parallel backfill of historical shift exports. The file is split into
+# newline aligned byte ranges; worker processes parse, validate and classify
+# one range each with the rule engine compiled from the gear configs, and the
+# parent process is the only writer. Every range is committed together with
+# an ImportChunk row, so an interrupted import resumes where it stopped and
+# no range is imported twice. The JSON checkpoint file names the source; an
+# import started without it starts over.
+#
+# CSV files need a header with vin, speed, gear_from, gear_to and optionally
+# timestamp (ISO format). Any other extension is read as NDJSON, see
+# models.ingest.
+
+CHUNK_BYTES = 8 * 1024 * 1024
+
+ImportVehicle = namedtuple("ImportVehicle", ["pk", "type_ref"])
+
+# Per worker state, set once by _init_worker instead of pickled per chunk.
+# Workers load the vehicles from the database file themselves.
+_worker = {}
+
+
+def file_format(path: str) -> str:
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+def split_chunks(path: str, chunk_bytes: int = CHUNK_BYTES, skip_header=False):
+    # Returns [(start, end)] byte ranges ending on line boundaries
+    if type(chunk_bytes) != int or chunk_bytes < 1:
+        raise ValueError("chunk_bytes must be a positive integer")
+    size = os.path.getsize(path)
+    chunks = []
+    with open(path, "rb") as handle:
+        if skip_header:
+            handle.readline()
+        start = handle.tell()
+        while start < size:
+            handle.seek(min(start + chunk_bytes, size))
+            if handle.tell() < size:
+                handle.readline()
+            end = handle.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def read_header(path: str) -> list[str]:
+    with open(path, newline="") as handle:
+        return next(csv.reader(handle), [])
+
+
+def parse_csv_row(row: dict) -> tuple:
+    try:
+        timestamp = row.get("timestamp") or None
+        if timestamp is not None:
+            timestamp = datetime.datetime.fromisoformat(timestamp)
+        return (
+            row["vin"],
+            int(row["speed"]),
+            int(row["gear_from"]),
+            int(row["gear_to"]),
+            timestamp,
+        )
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(
+            "Invalid shift row, please use vin,speed,gear_from,gear_to[,timestamp]"
+        )
+
+
+def parse_chunk(
+    path: str, start: int, end: int, fmt: str, header: list = None
+) -> tuple:
+    # Returns (records, invalid line count)
+    with open(path, "rb") as handle:
+        handle.seek(start)
+        lines = handle.read(end - start).decode("utf-8").splitlines()
+    records = []
+    invalid = 0
+    parse = parse_event
+    if fmt == "csv":
+        parse, lines = parse_csv_row, csv.DictReader(lines, fieldnames=header)
+    for line in lines:
+        if not line:
+            continue
+        try:
+            records.append(parse(line))
+        except ValueError:
+            invalid += 1
+    return records, invalid
+
+
+def load_import_vehicles(database=None) -> dict:
+    # {vin: ImportVehicle} of every registered vehicle
+    query = Vehicle.select(Vehicle.vin, Vehicle.pk, Vehicle.type_ref).tuples()
+    if database is not None:
+        query = query.bind(database)
+    return {vin: ImportVehicle(pk, type_ref) for vin, pk, type_ref in query}
+
+
+def _init_worker(engine, database_path: str) -> None:
+    database = make_read_database(database_path)
+    try:
+        _worker["vehicles"] = load_import_vehicles(database)
+    finally:
+        database.close()
+    _worker["engine"] = engine
+
+
+def classify_chunk(task: tuple) -> tuple:
+    # task: (path, start, end, fmt, header), returns (start, end, entries, rejected)
+    path, start, end, fmt, header = task
+    records, invalid = parse_chunk(path, start, end, fmt, header)
+    _, entries = classify_shift_records(records, _worker["vehicles"], _worker["engine"])
+    return start, end, entries, invalid + len(records) - len(entries)
+
+
+def load_checkpoint(checkpoint: str, path: str, chunk_bytes: int) -> dict:
+    # The import state: the source, plus the ranges committed under this
+    # checkpoint with their totals. A missing checkpoint file starts a new
+    # import, dropping ranges recorded by an earlier one.
+    source = {
+        "path": os.path.abspath(path),
+        "size": os.path.getsize(path),
+        "chunk_bytes": chunk_bytes,
+    }
+    state = dict(source, done=[], logged=0, rejected=0)
+    if not checkpoint:
+        return state
+    key = os.path.abspath(checkpoint)
+    if not os.path.exists(checkpoint):
+        ImportChunk.delete().where(ImportChunk.checkpoint == key).execute()
+        save_checkpoint(checkpoint, source)
+        return state
+    with open(checkpoint) as handle:
+        saved = json.load(handle)
+    if any(saved.get(name) != value for name, value in source.items()):
+        raise ValueError("Checkpoint belongs to a different import")
+    # SQL - SELECT start, logged, rejected FROM importchunk WHERE checkpoint = ?;
+    query = ImportChunk.select(
+        ImportChunk.start, ImportChunk.logged, ImportChunk.rejected
+    ).where(ImportChunk.checkpoint == key)
+    for start, logged, rejected in query.tuples():
+        state["done"].append(start)
+        state["logged"] += logged
+        state["rejected"] += rejected
+    return state
+
+
+def save_checkpoint(checkpoint: str, state: dict) -> None:
+    # Written to a temporary file and renamed so a crash never leaves it torn
+    if not checkpoint:
+        return
+    temporary = checkpoint + ".tmp"
+    with open(temporary, "w") as handle:
+        json.dump(state, handle)
+    os.replace(temporary, checkpoint)
+
+
+def import_file(
+    path: str,
+    workers: int = None,
+    chunk_bytes: int = CHUNK_BYTES,
+    checkpoint: str = None,
+    progress=None,
+    chunk_size: int = BATCH_CHUNK_SIZE,
+) -> dict:
+    # Imports a CSV/NDJSON shift export. workers=0 classifies in this process.
+    # progress(state) is called after every committed chunk with the
+    # checkpoint state plus "bytes_done" and "bytes_total".
+    if not configs_loaded():
+        preload_config()
+    fmt = file_format(path)
+    header = read_header(path) if fmt == "csv" else None
+    state = load_checkpoint(checkpoint, path, chunk_bytes)
+    done = set(state["done"])
+    chunks = split_chunks(path, chunk_bytes, skip_header=fmt == "csv")
+    tasks = [
+        (path, start, end, fmt, header) for start, end in chunks if start not in done
+    ]
+    bytes_total = sum(end - start for start, end in chunks)
+    bytes_done = bytes_total - sum(end - start for _, start, end, _, _ in tasks)
+    engine = rule_engine()
+    key = os.path.abspath(checkpoint) if checkpoint else None
+
+    def apply(result) -> None:
+        nonlocal bytes_done
+        start, end, entries, rejected = result
+
+        def commit() -> None:
+            insert_shift_logs(entries, chunk_size)
+            if key is not None:
+                ImportChunk.insert(
+                    checkpoint=key,
+                    start=start,
+                    logged=len(entries),
+                    rejected=rejected,
+                ).execute()
+
+        write_transaction(commit)
+        sketch_shift_logs(entries)
+        state["done"].append(start)
+        state["logged"] += len(entries)
+        state["rejected"] += rejected
+        bytes_done += end - start
+        if progress is not None:
+            progress(dict(state, bytes_done=bytes_done, bytes_total=bytes_total))
+
+    if workers == 0:
+        _worker["engine"] = engine
+        _worker["vehicles"] = load_import_vehicles()
+        for task in tasks:
+            apply(classify_chunk(task))
+    else:
+        database_path = get_database().database
+        if not database_path or ":memory:" in database_path:
+            raise ValueError("A parallel import needs a database file, use workers=0")
+        with multiprocessing.Pool(
+            workers, initializer=_init_worker, initargs=(engine, database_path)
+        ) as pool:
+            for result in pool.imap_unordered(classify_chunk, tasks):
+                apply(result)
+    return {
+        "chunks": len(chunks),
+        "imported_chunks": len(tasks),
+        "logged": state["logged"],
+        "rejected": state["rejected"],
+    }
+
+
+def read_vehicles(path: str):
+    # Yields (vin, make, year, type) from a CSV with a vin,make,year,type
+    # header or NDJSON objects like --vehicle. Malformed rows are yielded with
+    # None values so add_vehicles_many counts them as rejected.
+    with open(path, newline="") as handle:
+        if file_format(path) == "csv":
+            rows = csv.DictReader(handle)
+        else:
+            rows = (json_object(line) for line in handle if line.strip())
+        for row in rows:
+            year = row.get("year")
+            if type(year) == str and year.strip().isdigit():
+                year = int(year)
+            yield row.get("vin"), row.get("make"), year, row.get("type")
+
+
+def json_object(line: str) -> dict:
+    try:
+        row = json.loads(line)
+    except ValueError:
+        return {}
+    return row if type(row) == dict else {}
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+
+
+class LookupCache:
+    # In-process cache for the static config tables and a bounded LRU of
+    # vehicles keyed by VIN. Loaders are injected so the cache does not depend
+    # on a particular database binding:
+    #   load_configs() -> {(vehicle_type_ref, gear_to): config}
+    #   load_vehicle_types() -> {pk: vehicle_type}
+    #   load_vehicles(vins) -> {vin: vehicle}
+    def __init__(
+        self, load_configs, load_vehicle_types, load_vehicles, max_vehicles=10000
+    ):
+        self._load_configs = load_configs
+        self._load_vehicle_types = load_vehicle_types
+        self._load_vehicles = load_vehicles
+        self.max_vehicles = max_vehicles
+        self._configs = None
+        self._vehicle_types = None
+        self._vehicles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _config_tables(self):
+        if self._configs is None:
+            self.misses += 1
+            self._configs = self._load_configs()
+            self._vehicle_types = self._load_vehicle_types()
+        else:
+            self.hits += 1
+        return self._configs, self._vehicle_types
+
+    def gear_configs(self) -> dict:
+        configs, _ = self._config_tables()
+        return configs
+
+    def gear_config(self, vehicle_type_ref: int, gear_to: int) -> object:
+        configs, _ = self._config_tables()
+        return configs.get((vehicle_type_ref, gear_to))
+
+    def vehicle_type(self, vehicle_type_ref: int) -> object:
+        _, vehicle_types = self._config_tables()
+        return vehicle_types.get(vehicle_type_ref)
+
+    def vehicle_type_refs(self) -> dict:
+        # {type_name: pk}, the newest type wins for a repeated name
+        _, vehicle_types = self._config_tables()
+        return {
+            vehicle_type.type_name: pk
+            for pk, vehicle_type in sorted(vehicle_types.items())
+        }
+
+    def vehicle(self, vin: str) -> object:
+        vehicle = self.vehicles([vin]).get(vin)
+        if vehicle is None:
+            raise ValueError("Vehicle does not exist")
+        return vehicle
+
+    def vehicles(self, vins) -> dict:
+        # Unknown VINs are left out of the result and are not cached, so a
+        # later add_vehicle is picked up without invalidation.
+        found = {}
+        missing = []
+        seen = set()
+        for vin in vins:
+            if vin in seen:
+                continue
+            seen.add(vin)
+            if vin in self._vehicles:
+                self.hits += 1
+                self._vehicles.move_to_end(vin)
+                found[vin] = self._vehicles[vin]
+            else:
+                self.misses += 1
+                missing.append(vin)
+        if missing:
+            loaded = self._load_vehicles(missing)
+            for vin, vehicle in loaded.items():
+                self._vehicles[vin] = vehicle
+            while len(self._vehicles) > self.max_vehicles:
+                self._vehicles.popitem(last=False)
+            found.update(loaded)
+        return found
+
+    def invalidate_vehicle(self, vin: str = None) -> None:
+        if vin is None:
+            self._vehicles.clear()
+        else:
+            self._vehicles.pop(vin, None)
+
+    def invalidate_configs(self) -> None:
+        self._configs = None
+        self._vehicle_types = None
+
+    def clear(self) -> None:
+        self.invalidate_configs()
+        self.invalidate_vehicle()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "vehicles": len(self._vehicles),
+            "configs_loaded": self._configs is not None,
+        }
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import mmap
+import array
+import bisect
+import calendar
+import datetime
+from models.automatic import (
+    Vehicle,
+    VehicleType,
+    get_database,
+    log_models,
+    as_datetime,
+)
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is an optional dependency
+    np = None
+
+# Binary columnar export of the transmission log. Every column is a packed
+# little-endian array in its own file, rows sorted by timestamp, so a reader
+# maps the files and slices them without parsing. meta.json describes the
+# columns and maps vehicle_ref to VIN and type_ref to the type name:
+#
+#   <dir>/timestamp.bin    int64  seconds since the epoch (UTC)
+#   <dir>/vehicle_ref.bin  int32
+#   <dir>/type_ref.bin     int16
+#   <dir>/gear_speed.bin   int16
+#   <dir>/gear_from.bin    int8
+#   <dir>/gear_to.bin      int8
+#   <dir>/error_code.bin   int8   models.rules code, 0 is no error
+#   <dir>/meta.json
+#
+# The files can also be opened with numpy.memmap(path, dtype="<i8") etc.
+
+FORMAT_VERSION = 1
+CHUNK_SIZE = 100000
+
+# (column, array typecode, numpy dtype)
+COLUMNS = (
+    ("timestamp", "q", "<i8"),
+    ("vehicle_ref", "i", "<i4"),
+    ("type_ref", "h", "<i2"),
+    ("gear_speed", "h", "<i2"),
+    ("gear_from", "b", "<i1"),
+    ("gear_to", "b", "<i1"),
+    ("error_code", "b", "<i1"),
+)
+DTYPES = {name: dtype for name, _, dtype in COLUMNS}
+
+# SQL - SELECT CAST(strftime('%s', t.date_timestamp) AS INTEGER), t.vehicle_ref, v.type_ref,
+#              t.gear_speed, t.gear_from, t.gear_to, t.error_code
+#       FROM transmissionlog t JOIN vehicle v ON v.pk = t.vehicle_ref
+#       [UNION ALL ... per partition] ORDER BY 1;
+SOURCE_SQL = (
+    "SELECT CAST(strftime('%s', t.date_timestamp) AS INTEGER), t.vehicle_ref, "
+    "v.type_ref, t.gear_speed, t.gear_from, t.gear_to, t.error_code "
+    'FROM "{log}" AS t JOIN "{vehicle}" AS v ON v.pk = t.vehicle_ref'
+)
+
+
+def epoch_seconds(value) -> int:
+    # Naive datetimes are stored and compared as UTC, like strftime('%s')
+    return calendar.timegm(as_datetime(value).timetuple())
+
+
+def export_columnar(
+    directory: str,
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    # Writes the log rows with start <= date_timestamp < end, from the hot
+    # table and the overlapping partitions, and returns the row count.
+    # meta.json is written last, a directory without it is incomplete.
+    os.makedirs(directory, exist_ok=True)
+    selects = []
+    params = []
+    for Log in log_models(start, end):
+        sql = SOURCE_SQL.format(
+            log=Log._meta.table_name, vehicle=Vehicle._meta.table_name
+        )
+        conditions = []
+        if start is not None:
+            conditions.append("t.date_timestamp >= ?")
+            params.append(str(as_datetime(start)))
+        if end is not None:
+            conditions.append("t.date_timestamp < ?")
+            params.append(str(as_datetime(end)))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        selects.append(sql)
+    sql = " UNION ALL ".join(selects) + " ORDER BY 1"
+    handles = [
+        open(os.path.join(directory, f"{name}.bin"), "wb") for name, _, _ in COLUMNS
+    ]
+    rows = 0
+    cursor = get_database().execute_sql(sql, params)
+    try:
+        while True:
+            block = cursor.fetchmany(chunk_size)
+            if not block:
+                break
+            for i, (handle, (_, typecode, _)) in enumerate(zip(handles, COLUMNS)):
+                values = array.array(typecode, [row[i] for row in block])
+                if sys.byteorder != "little":
+                    values.byteswap()
+                values.tofile(handle)
+            rows += len(block)
+    finally:
+        cursor.close()
+        for handle in handles:
+            handle.close()
+    meta = {
+        "version": FORMAT_VERSION,
+        "rows": rows,
+        "columns": DTYPES,
+        "vehicles": dict(Vehicle.select(Vehicle.pk, Vehicle.vin).tuples()),
+        "types": dict(
+            VehicleType.select(VehicleType.pk, VehicleType.type_name).tuples()
+        ),
+    }
+    with open(os.path.join(directory, "meta.json"), "w") as handle:
+        json.dump(meta, handle)
+    return rows
+
+
+class ColumnarLog:
+    # Read-only view over an export. Columns are memoryviews over mmap'd
+    # files; with numpy installed the statistics run vectorized over
+    # zero-copy arrays of the same mappings.
+    def __init__(self, directory: str, use_numpy: bool = None):
+        with open(os.path.join(directory, "meta.json")) as handle:
+            meta = json.load(handle)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError("Unsupported columnar export version")
+        if sys.byteorder != "little":
+            raise ValueError(
+                "Columnar exports can only be mapped on little-endian hosts"
+            )
+        self.directory = directory
+        self.rows = meta["rows"]
+        self.vehicles = {int(pk): vin for pk, vin in meta["vehicles"].items()}
+        self.types = {int(pk): name for pk, name in meta["types"].items()}
+        self.use_numpy = np is not None if use_numpy is None else use_numpy
+        if self.use_numpy and np is None:
+            raise ImportError("numpy is not installed, install with pip install numpy")
+        self._maps = {}
+        self.columns = {}
+        for name, typecode, _ in COLUMNS:
+            with open(os.path.join(directory, f"{name}.bin"), "rb") as handle:
+                if self.rows:
+                    mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[name] = mapped
+                    self.columns[name] = memoryview(mapped).cast(typecode)
+                else:
+                    self.columns[name] = memoryview(b"").cast(typecode)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # Views must be released before their mappings can be closed
+        for view in self.columns.values():
+            view.release()
+        for mapped in self._maps.values():
+            mapped.close()
+        self.columns = {}
+        self._maps = {}
+
+    def numpy_column(self, name: str):
+        # Zero-copy numpy array over the mapping, valid until close()
+        if np is None:
+            raise ImportError("numpy is not installed, install with pip install numpy")
+        return np.frombuffer(self.columns[name], dtype=DTYPES[name])
+
+    def row_range(self, start=None, end=None) -> tuple:
+        # Row indexes [lo, hi) with start <= timestamp < end, by binary search
+        timestamps = self.columns["timestamp"]
+        lo = (
+            0 if start is None else bisect.bisect_left(timestamps, epoch_seconds(start))
+        )
+        hi = (
+            self.rows
+            if end is None
+            else bisect.bisect_left(timestamps, epoch_seconds(end), lo)
+        )
+        return lo, hi
+
+    def average_speed(self, gear_to: int = 4, start=None, end=None):
+        # Same answer as average_speed_to_fourth_gear for gear_to=4
+        lo, hi = self.row_range(start, end)
+        if self.use_numpy:
+            mask = self.numpy_column("gear_to")[lo:hi] == gear_to
+            if not mask.any():
+                return None
+            return float(self.numpy_column("gear_speed")[lo:hi][mask].mean())
+        total = count = 0
+        speeds = self.columns["gear_speed"]
+        for i, gear in enumerate(self.columns["gear_to"][lo:hi], lo):
+            if gear == gear_to:
+                total += speeds[i]
+                count += 1
+        return total / count if count else None
+
+    def error_counts(self, lo: int, hi: int) -> dict:
+        # {vehicle_ref: shift errors} within rows [lo, hi)
+        if self.use_numpy:
+            errors = self.numpy_column("error_code")[lo:hi] != 0
+            refs, counts = np.unique(
+                self.numpy_column("vehicle_ref")[lo:hi][errors], return_counts=True
+            )
+            return dict(zip(refs.tolist(), counts.tolist()))
+        counts = {}
+        refs = self.columns["vehicle_ref"]
+        for i, code in enumerate(self.columns["error_code"][lo:hi], lo):
+            if code:
+                counts[refs[i]] = counts.get(refs[i], 0) + 1
+        return counts
+
+    def error_recurrence(
+        self, before: datetime.date = None, since: datetime.date = None
+    ) -> list[dict]:
+        # Same answer as error_frequency_previous_last_week
+        today = datetime.date.today()
+        before = before or today - datetime.timedelta(days=30)
+        since = since or today - datetime.timedelta(days=7)
+        _, before_end = self.row_range(end=before)
+        since_start, _ = self.row_range(start=since)
+        errors_before = self.error_counts(0, before_end)
+        errors_since = self.error_counts(since_start, self.rows)
+        return sorted(
+            (
+                {
+                    "vin": self.vehicles[ref],
+                    "errors_before": errors_before[ref],
+                    "errors_since": errors_since[ref],
+                }
+                for ref in errors_before.keys() & errors_since.keys()
+            ),
+            key=lambda row: row["vin"],
+        )
@@ -0,0 +1,323 @@
+import os
+import json
+import stat
+import time
+import socket
+import datetime
+import selectors
+from collections import deque
+from peewee import DatabaseError
+from models.automatic import shift_log_add_many
+from models.instrumentation import instrumentation
+
+# Shift event input, one JSON object per line:
+# {"vin": "1G1ZZ8F", "speed": 15, "gear_to": 2, "gear_from": 1}
+# An optional "timestamp" in ISO format is used as the log date. With a state
+# tracker (models.state) events without gear_from and gear_to are accepted as
+# speed samples: {"vin": "1G1ZZ8F", "speed": 32}
+
+READ_SIZE = 65536
+
+
+def parse_event(line, allow_samples: bool = False) -> tuple:
+    # Speed samples are returned with gear_from and gear_to set to None
+    try:
+        event = json.loads(line)
+        timestamp = event.get("timestamp")
+        if timestamp is not None:
+            timestamp = datetime.datetime.fromisoformat(timestamp)
+        if allow_samples and "gear_from" not in event and "gear_to" not in event:
+            return (event["vin"], event["speed"], None, None, timestamp)
+        return (
+            event["vin"],
+            event["speed"],
+            event["gear_from"],
+            event["gear_to"],
+            timestamp,
+        )
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ValueError(
+            "Invalid shift event, please use {'vin', 'speed', 'gear_to', 'gear_from'}"
+        )
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class IngestStats:
+    def __init__(self, max_samples=100000, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.received = 0
+        self.logged = 0
+        self.errors = 0
+        self.rejected = 0
+        self.rejections = {}
+        self.samples = 0
+        self.flushes = 0
+        # Batches the writer raised on, their events are counted as rejected
+        self.write_failures = 0
+        # Seconds between an event being received and its batch committing
+        self.latencies = deque(maxlen=max_samples)
+
+    def reject(self, message: str) -> None:
+        self.rejected += 1
+        self.rejections[message] = self.rejections.get(message, 0) + 1
+
+    def report(self) -> dict:
+        elapsed = max(self.clock() - self.started, 1e-9)
+        latencies = list(self.latencies)
+        return {
+            "received": self.received,
+            "logged": self.logged,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "rejections": dict(self.rejections),
+            "samples": self.samples,
+            "flushes": self.flushes,
+            "write_failures": self.write_failures,
+            "elapsed_seconds": round(elapsed, 3),
+            "events_per_second": round(self.logged / elapsed, 1),
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50) * 1000, 3),
+                "p95": round(percentile(latencies, 95) * 1000, 3),
+                "p99": round(percentile(latencies, 99) * 1000, 3),
+                "max": round(max(latencies, default=0.0) * 1000, 3),
+            },
+        }
+
+
+class ShiftEventBuffer:
+    # Collects parsed shift events and hands them to the writer in batches,
+    # flushing when flush_size events are pending or the oldest pending event
+    # has waited flush_interval seconds.
+    def __init__(
+        self,
+        flush_size=500,
+        flush_interval=1.0,
+        writer=shift_log_add_many,
+        clock=time.monotonic,
+        tracker=None,
+    ):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.writer = writer
+        self.clock = clock
+        # Optional models.state.ShiftStateTracker, fed as events arrive
+        self.tracker = tracker
+        self.stats = IngestStats(clock=clock)
+        self._records = []
+        self._received_at = []
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def add(self, record: tuple) -> None:
+        self.stats.received += 1
+        if self.tracker is not None:
+            self.tracker.observe(record)
+            if record[2] is None and record[3] is None:
+                # Speed samples only feed the tracker, they are not logged
+                self.stats.samples += 1
+                return
+        self._records.append(record)
+        self._received_at.append(self.clock())
+        if len(self._records) >= self.flush_size:
+            self.flush()
+
+    def add_line(self, line) -> None:
+        if not line.strip():
+            return
+        try:
+            record = parse_event(line, allow_samples=self.tracker is not None)
+        except ValueError as exc:
+            self.stats.received += 1
+            self.stats.reject(str(exc))
+            return
+        self.add(record)
+
+    def time_until_flush(self) -> float:
+        if not self._records:
+            return self.flush_interval
+        waited = self.clock() - self._received_at[0]
+        return max(0.0, self.flush_interval - waited)
+
+    def flush_if_due(self) -> None:
+        if self._records and self.time_until_flush() <= 0:
+            self.flush()
+
+    def flush(self) -> list[dict]:
+        if not self._records:
+            return []
+        records, received_at = self._records, self._received_at
+        self._records, self._received_at = [], []
+        try:
+            results = self.writer(records)
+        except DatabaseError as exc:
+            # e.g. "database is locked" once the write retries ran out: the
+            # batch is rejected and serving carries on
+            self.stats.write_failures += 1
+            for _ in records:
+                self.stats.reject(f"Write failed: {exc}")
+            return []
+        done = self.clock()
+        self.stats.flushes += 1
+        for result, started in zip(results, received_at):
+            if result["logged"]:
+                self.stats.logged += 1
+                self.stats.errors += result["error"]
+                self.stats.latencies.append(done - started)
+            else:
+                self.stats.reject(result["message"])
+        return results
+
+
+class _LineReader:
+    def __init__(self, read):
+        self.read = read
+        self.pending = b""
+
+    def lines(self):
+        # Returns (complete lines, eof)
+        data = self.read()
+        if not data:
+            tail = [self.pending] if self.pending else []
+            self.pending = b""
+            return tail, True
+        chunks = (self.pending + data).split(b"\n")
+        self.pending = chunks.pop()
+        return chunks, False
+
+
+def selectable(fd: int) -> bool:
+    # epoll polls pipes, terminals and sockets but refuses regular files
+    mode = os.fstat(fd).st_mode
+    return stat.S_ISFIFO(mode) or stat.S_ISCHR(mode) or stat.S_ISSOCK(mode)
+
+
+class IngestServer:
+    # Resident ingest loop reading newline-delimited JSON shift events from a
+    # stream (stdin) and/or a Unix socket into a ShiftEventBuffer. A stream
+    # redirected from a file is read to the end before the socket is served.
+    def __init__(
+        self,
+        buffer: ShiftEventBuffer,
+        stream=None,
+        socket_path=None,
+        stats_interval: float = None,
+        stats_stream=None,
+    ):
+        self.buffer = buffer
+        self.stream = stream
+        self.socket_path = socket_path
+        # Emit an instrumentation snapshot JSON line every stats_interval seconds
+        self.stats_interval = stats_interval
+        self.stats_stream = stats_stream
+        self._stats_due = None
+        self.running = False
+        self._selector = None
+        self._server = None
+        self._file = None
+
+    def stop(self, *args) -> None:
+        self.running = False
+
+    def open(self) -> None:
+        self._selector = selectors.DefaultSelector()
+        if self.stream is not None:
+            fd = self.stream.fileno()
+            reader = _LineReader(lambda: os.read(fd, READ_SIZE))
+            if selectable(fd):
+                self._selector.register(fd, selectors.EVENT_READ, reader)
+            else:
+                self._file = reader
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(self.socket_path)
+            self._server.listen()
+            self._server.setblocking(False)
+            self._selector.register(self._server, selectors.EVENT_READ, None)
+
+    def close(self) -> None:
+        for key in list(self._selector.get_map().values()):
+            self._selector.unregister(key.fileobj)
+            if isinstance(key.fileobj, socket.socket):
+                key.fileobj.close()
+        self._selector.close()
+        self._selector = None
+        self._file = None
+        if self._server is not None:
+            os.unlink(self.socket_path)
+            self._server = None
+
+    def _accept(self) -> None:
+        conn, _ = self._server.accept()
+        conn.setblocking(False)
+        reader = _LineReader(lambda: conn.recv(READ_SIZE))
+        self._selector.register(conn, selectors.EVENT_READ, reader)
+
+    def _read(self, key) -> None:
+        try:
+            lines, eof = key.data.lines()
+        except BlockingIOError:
+            return
+        for line in lines:
+            self.buffer.add_line(line)
+        if eof:
+            self._selector.unregister(key.fileobj)
+            if isinstance(key.fileobj, socket.socket):
+                key.fileobj.close()
+
+    def _time_until_stats(self) -> float:
+        now = self.buffer.clock()
+        if self._stats_due is None:
+            self._stats_due = now + self.stats_interval
+        return max(0.0, self._stats_due - now)
+
+    def _read_file(self) -> None:
+        # Plain blocking reads, a regular file always has data or is at EOF
+        lines, eof = self._file.lines()
+        for line in lines:
+            self.buffer.add_line(line)
+        if eof:
+            self._file = None
+
+    def _tick(self) -> None:
+        self.buffer.flush_if_due()
+        if self.stats_interval and self._time_until_stats() <= 0:
+            instrumentation.dump(self.stats_stream)
+            self._stats_due = None
+
+    def serve(self) -> dict:
+        if self._selector is None:
+            self.open()
+        self.running = True
+        try:
+            while self.running and self._file is not None:
+                self._read_file()
+                self._tick()
+            # Without a socket the loop ends once the stream is exhausted
+            while self.running and self._selector.get_map():
+                timeout = self.buffer.time_until_flush()
+                if self.stats_interval:
+                    timeout = min(timeout, self._time_until_stats())
+                for key, _ in self._selector.select(timeout):
+                    if key.data is None:
+                        self._accept()
+                    else:
+                        self._read(key)
+                self._tick()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            self.buffer.flush()
+            self.close()
+        return self.buffer.stats.report()
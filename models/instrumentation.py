@@ -0,0 +1,137 @@
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+# Per-stage timers and counters for the shift processing hot path. Recording a
+# stage is a clock read and a few additions on a preallocated record, which is
+# cheap enough to leave enabled in production.
+
+
+class StageStats:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float, count: int = 1) -> None:
+        self.count += count
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_us": round(self.total / self.count * 1e6, 3) if self.count else 0.0,
+            "max_us": round(self.max * 1e6, 3),
+        }
+
+
+class Instrumentation:
+    def __init__(self, clock=time.perf_counter, enabled: bool = True):
+        self.clock = clock
+        self.enabled = enabled
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.queries = {}
+
+    def lap(self, name: str, started: float, count: int = 1) -> float:
+        # Records the time since `started` under `name` and returns the current
+        # clock, so consecutive stages can be chained:
+        #   t = instrumentation.clock()
+        #   t = instrumentation.lap("vehicle_lookup", t)
+        now = self.clock()
+        if self.enabled:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(now - started, count)
+        return now
+
+    @contextmanager
+    def stage(self, name: str, count: int = 1):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.lap(name, started, count)
+
+    def incr(self, name: str, value: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_query(self, sql: str, seconds: float) -> None:
+        if self.enabled:
+            kind = sql.split(None, 1)[0].upper() if sql else ""
+            stats = self.queries.get(kind)
+            if stats is None:
+                stats = self.queries[kind] = StageStats()
+            stats.add(seconds)
+
+    def reset(self) -> None:
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.queries = {}
+
+    def snapshot(self) -> dict:
+        return {
+            "timestamp": time.time(),
+            "uptime_seconds": round(time.time() - self.started, 3),
+            "stages": {name: s.to_dict() for name, s in self.stages.items()},
+            "counters": dict(self.counters),
+            "queries": {kind: s.to_dict() for kind, s in self.queries.items()},
+        }
+
+    def dump(self, stream=None) -> None:
+        # One JSON line per snapshot, suitable for log shipping
+        stream = stream or sys.stderr
+        stream.write(json.dumps(self.snapshot()) + "\n")
+        stream.flush()
+
+
+instrumentation = Instrumentation()
+
+
+def install_query_hook(database, instr: Instrumentation = None) -> None:
+    # Counts and times every statement peewee sends to `database`
+    instr = instr or instrumentation
+    execute_sql = type(database).execute_sql
+
+    def timed_execute_sql(sql, params=None, *args, **kwargs):
+        started = instr.clock()
+        try:
+            return execute_sql(database, sql, params, *args, **kwargs)
+        finally:
+            instr.record_query(sql, instr.clock() - started)
+
+    database.execute_sql = timed_execute_sql
+
+
+def remove_query_hook(database) -> None:
+    database.__dict__.pop("execute_sql", None)
+
+
+@contextmanager
+def profiled(path: str = None, limit: int = 25, stream=None):
+    # Opt-in cProfile around a block, e.g. the ingest daemon or a bulk import.
+    # Writes a pstats file to `path`, or prints the top `limit` entries.
+    import pstats
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
+        else:
+            stats = pstats.Stats(profiler, stream=stream or sys.stderr)
+            stats.sort_stats("cumulative").print_stats(limit)
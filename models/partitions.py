@@ -0,0 +1,160 @@
+import os
+import datetime
+from peewee import fn
+from models.automatic import (
+    TransmissionLog,
+    RetiredShiftSpeedAggregate,
+    LogPartition,
+    get_database,
+    log_models,
+    month_start,
+    next_month,
+    partition_model,
+    shift_speed_aggregate_conflict,
+    shift_speed_aggregate_fields,
+    shift_speed_aggregate_query,
+    as_datetime,
+)
+
+# Monthly partitioning of TransmissionLog. New shifts always land in the hot
+# transmissionlog table; rotate_partitions moves whole months older than the
+# hot window into transmissionlog_YYYYMM tables, and apply_retention retires
+# old partitions: their totals stay in the aggregate tables, the raw rows are
+# copied to an archive file (optional) and the table is dropped.
+
+
+def previous_month(month: datetime.date) -> datetime.date:
+    return (month - datetime.timedelta(days=1)).replace(day=1)
+
+
+def months_back(keep_months: int, now: datetime.datetime = None) -> datetime.date:
+    # First month of a window of `keep_months` months ending with the current one
+    if type(keep_months) != int or keep_months < 1:
+        raise ValueError("keep_months must be a positive integer")
+    month = month_start(now or datetime.datetime.now())
+    for _ in range(keep_months - 1):
+        month = previous_month(month)
+    return month
+
+
+def rotate_partitions(keep_months: int = 3, now: datetime.datetime = None) -> dict:
+    # Moves rows older than the hot window into monthly partitions and returns
+    # {table_name: rows moved}
+    # SQL - INSERT INTO transmissionlog_YYYYMM SELECT * FROM transmissionlog
+    #       WHERE date_timestamp >= :month AND date_timestamp < :next_month;
+    #       DELETE FROM transmissionlog WHERE date_timestamp >= :month AND date_timestamp < :next_month;
+    cutoff = as_datetime(months_back(keep_months, now))
+    Log = TransmissionLog
+    month_key = fn.strftime("%Y-%m-01", Log.date_timestamp)
+    months = [
+        datetime.date.fromisoformat(month)
+        for (month,) in Log.select(month_key)
+        .where(Log.date_timestamp < cutoff)
+        .distinct()
+        .order_by(month_key)
+        .tuples()
+    ]
+    fields = list(Log._meta.sorted_fields)
+    moved = {}
+    for month in months:
+        Partition = partition_model(month)
+        in_month = (Log.date_timestamp >= as_datetime(month)) & (
+            Log.date_timestamp < as_datetime(next_month(month))
+        )
+        with get_database().atomic():
+            Partition.create_table(safe=True)
+            Partition.insert_from(
+                Log.select(*fields).where(in_month),
+                [Partition._meta.fields[field.name] for field in fields],
+            ).execute()
+            rows = Log.delete().where(in_month).execute()
+            table_name = Partition._meta.table_name
+            partition = LogPartition.get_or_none(LogPartition.table_name == table_name)
+            if partition is None:
+                LogPartition.create(table_name=table_name, month=month, row_count=rows)
+            elif partition.dropped:
+                # Late rows for a month that was already retired reopen it
+                partition.dropped = False
+                partition.row_count = rows
+                partition.save()
+            else:
+                partition.row_count += rows
+                partition.save()
+        moved[table_name] = rows
+    return moved
+
+
+def select_log(
+    start: datetime.datetime = None, end: datetime.datetime = None, fields=None
+):
+    # TransmissionLog rows with start <= date_timestamp < end, reading only the
+    # hot table and the partitions that overlap the range (UNION ALL)
+    names = fields or [field.name for field in TransmissionLog._meta.sorted_fields]
+    query = None
+    for Log in log_models(start, end):
+        select = Log.select(*[getattr(Log, name) for name in names])
+        if start is not None:
+            select = select.where(Log.date_timestamp >= as_datetime(start))
+        if end is not None:
+            select = select.where(Log.date_timestamp < as_datetime(end))
+        query = select if query is None else query + select
+    return query
+
+
+def apply_retention(
+    keep_months: int = 12,
+    archive_dir: str = None,
+    now: datetime.datetime = None,
+    vacuum: bool = False,
+) -> list[str]:
+    # Retires live partitions older than `keep_months` and returns their
+    # table names. Error rollups keep their days, shift speed totals move to
+    # RetiredShiftSpeedAggregate so rebuilds still include them.
+    cutoff = months_back(keep_months, now)
+    database = get_database()
+    retired = []
+    partitions = list(
+        LogPartition.select()
+        .where((LogPartition.dropped == False) & (LogPartition.month < cutoff))
+        .order_by(LogPartition.month)
+    )
+    for partition in partitions:
+        Partition = partition_model(partition.month)
+        table = Partition._meta.table_name
+        path = None
+        if archive_dir:
+            os.makedirs(archive_dir, exist_ok=True)
+            path = os.path.join(archive_dir, f"{table}.db")
+            # ATTACH is not allowed inside a transaction
+            database.execute_sql("ATTACH DATABASE ? AS archive", (path,))
+        try:
+            with database.atomic():
+                if path:
+                    # Idempotent copy, a retry replaces rows archived earlier
+                    database.execute_sql(
+                        f'CREATE TABLE IF NOT EXISTS archive."{table}" AS '
+                        f'SELECT * FROM main."{table}" WHERE 0'
+                    )
+                    database.execute_sql(
+                        f'DELETE FROM archive."{table}" WHERE pk IN '
+                        f'(SELECT pk FROM main."{table}")'
+                    )
+                    database.execute_sql(
+                        f'INSERT INTO archive."{table}" SELECT * FROM main."{table}"'
+                    )
+                Retired = RetiredShiftSpeedAggregate
+                Retired.insert_from(
+                    shift_speed_aggregate_query(Partition),
+                    shift_speed_aggregate_fields(Retired),
+                ).on_conflict(**shift_speed_aggregate_conflict(Retired)).execute()
+                Partition.drop_table()
+                partition.dropped = True
+                partition.archived_path = path or partition.archived_path
+                partition.save()
+        finally:
+            if path:
+                database.execute_sql("DETACH DATABASE archive")
+        retired.append(table)
+    if retired and vacuum:
+        database.execute_sql("VACUUM")
+    return retired
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import queue
+import datetime
+import threading
+from collections import OrderedDict
+from urllib.parse import quote, urlsplit, parse_qs
+from peewee import SqliteDatabase
+from models.automatic import (
+    TransmissionLog,
+    LogPartition,
+    average_speed_to_fourth_gear,
+    error_frequency_previous_last_week,
+    get_database,
+)
+
+# Cached read-only access to the dashboard queries. Queries run on their own
+# read-only connections (one per thread), so in WAL mode they never take the
+# write lock or wait for the ingest writer. Results are cached per query and
+# arguments until they are older than `ttl`, or until the change marker moves:
+# the largest TransmissionLog pk (every logged shift) and the number of
+# partitions dropped by retention. Reading the marker is one indexed lookup,
+# and it is only re-read every `marker_interval` seconds, so a cached hit
+# within that window is a dict lookup.
+#
+# Registered queries are function(database, *args), with their arguments
+# resolved before the cache lookup so relative dates key by the actual day.
+
+
+def error_recurrence(
+    database: SqliteDatabase,
+    before: datetime.date = None,
+    since: datetime.date = None,
+) -> list[dict]:
+    return error_frequency_previous_last_week(before, since, database=database)
+
+
+def error_recurrence_arguments(
+    before: datetime.date = None, since: datetime.date = None
+) -> tuple:
+    today = datetime.date.today()
+    return (
+        before or today - datetime.timedelta(days=30),
+        since or today - datetime.timedelta(days=7),
+    )
+
+
+# name -> (function(database, *args), resolve(*args) -> args)
+QUERIES = {
+    "average_speed_to_fourth_gear": (average_speed_to_fourth_gear, lambda: ()),
+    "error_frequency_previous_last_week": (
+        error_recurrence,
+        error_recurrence_arguments,
+    ),
+}
+
+# SQL - SELECT (SELECT MAX(pk) FROM transmissionlog),
+#              (SELECT COUNT(*) FROM logpartition WHERE dropped = 1);
+MARKER_SQL = (
+    f'SELECT (SELECT MAX(pk) FROM "{TransmissionLog._meta.table_name}"), '
+    f'(SELECT COUNT(*) FROM "{LogPartition._meta.table_name}" WHERE dropped = 1)'
+)
+
+
+def make_read_database(path: str) -> SqliteDatabase:
+    # Read-only connections to an existing database file, see the profiles
+    # in models/automatic.py for the cache and mmap sizes
+    if not path or path == ":memory:" or path.startswith("file:"):
+        raise ValueError("The query service needs the path of a database file")
+    uri = "file:" + quote(os.path.abspath(path)) + "?mode=ro"
+    return SqliteDatabase(
+        uri,
+        uri=True,
+        pragmas={
+            "query_only": 1,
+            "cache_size": -16000,
+            "mmap_size": 256 * 1024 * 1024,
+            "busy_timeout": 5000,
+        },
+    )
+
+
+class QueryService:
+    def __init__(
+        self,
+        path: str = None,
+        ttl: float = 5.0,
+        max_entries: int = 256,
+        marker_interval: float = 1.0,
+        clock=time.monotonic,
+    ):
+        # path defaults to the file of the database the models are bound to
+        self.database = make_read_database(path or get_database().database)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.marker_interval = marker_interval
+        self.clock = clock
+        self.queries = dict(QUERIES)
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._marker = None
+        self._marker_read = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.invalidations = 0
+
+    def register(self, name: str, function, resolve=lambda *args: args) -> None:
+        # function(database, *args) -> JSON friendly result
+        self.queries[name] = (function, resolve)
+
+    def marker(self) -> tuple:
+        # Re-read at most every marker_interval seconds; a moved marker drops
+        # every cached result
+        now = self.clock()
+        with self._lock:
+            if (
+                self._marker_read is not None
+                and now - self._marker_read < self.marker_interval
+            ):
+                return self._marker
+        marker = tuple(self.database.execute_sql(MARKER_SQL).fetchone())
+        with self._lock:
+            if marker != self._marker:
+                if self._results:
+                    self.invalidations += 1
+                self._results.clear()
+                self._marker = marker
+            self._marker_read = now
+        return marker
+
+    def query(self, name: str, *args):
+        # Cached results are shared between callers, do not modify them
+        if name not in self.queries:
+            raise ValueError(f"Unknown query, please use {sorted(self.queries)}")
+        function, resolve = self.queries[name]
+        key = (name, resolve(*args))
+        marker = self.marker()
+        now = self.clock()
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] == marker and now < cached[1]:
+                self.hits += 1
+                self._results.move_to_end(key)
+                return cached[2]
+            self.misses += 1
+        result = function(self.database, *key[1])
+        with self._lock:
+            self._results[key] = (marker, now + self.ttl, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+                self.evicted += 1
+        return result
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._results.clear()
+            self._marker_read = None
+
+    def close(self) -> None:
+        self.database.close()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "invalidations": self.invalidations,
+            "cached": len(self._results),
+            "marker": self._marker,
+        }
+
+
+def query_arguments(name: str, parameters: dict) -> tuple:
+    # HTTP query string -> query arguments, dates as YYYY-MM-DD
+    if name == "error_frequency_previous_last_week":
+        return tuple(
+            (
+                datetime.date.fromisoformat(parameters[key][0])
+                if key in parameters
+                else None
+            )
+            for key in ("before", "since")
+        )
+    return ()
+
+
+def serve_http(
+    service: QueryService, host: str = "127.0.0.1", port: int = 9600, threads: int = 8
+):
+    # GET /<query name>[?before=YYYY-MM-DD&since=YYYY-MM-DD] returns JSON,
+    # GET /stats the cache counters. Requests are answered by a fixed pool of
+    # threads, each keeping its read-only connection open until server_close.
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            name = url.path.strip("/")
+            try:
+                if name == "stats":
+                    body, status = service.stats(), 200
+                elif name not in service.queries:
+                    body = {
+                        "error": f"Unknown query, please use {sorted(service.queries)}"
+                    }
+                    status = 404
+                else:
+                    args = query_arguments(name, parse_qs(url.query))
+                    body, status = service.query(name, *args), 200
+            except ValueError as exc:
+                body, status = {"error": str(exc)}, 400
+            payload = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(HTTPServer):
+        def __init__(self, address):
+            super().__init__(address, Handler)
+            self.requests = queue.Queue()
+            self.workers = [
+                threading.Thread(target=self.work, daemon=True) for _ in range(threads)
+            ]
+            for worker in self.workers:
+                worker.start()
+
+        def work(self):
+            # Accepted requests until None, then closes this thread's connection
+            try:
+                while True:
+                    accepted = self.requests.get()
+                    if accepted is None:
+                        break
+                    request, client_address = accepted
+                    try:
+                        self.finish_request(request, client_address)
+                    except Exception:
+                        self.handle_error(request, client_address)
+                    finally:
+                        self.shutdown_request(request)
+            finally:
+                service.database.close()
+
+        def process_request(self, request, client_address):
+            self.requests.put((request, client_address))
+
+        def server_close(self):
+            super().server_close()
+            for _ in self.workers:
+                self.requests.put(None)
+            for worker in self.workers:
+                worker.join()
+
+    return Server((host, port))
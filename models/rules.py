@@ -0,0 +1,122 @@
+# Shift rules compiled from GearChangeConfig into dense per-type threshold
+# tables, evaluated over whole batches. Rules produce integer error codes and
+# messages are only rendered for the rows that are errors.
+
+NO_ERROR = 0
+LATE_SHIFT = 1  # Upshift above the configured speed (the original is_error case)
+EARLY_SHIFT = 2  # Upshift below the configured speed
+DOWNSHIFT_OVERSPEED = 3  # Downshift while still above the speed of the gear left
+SKIPPED_GEAR = 4  # Shift across more than one gear
+
+# Negative codes mark events that cannot be evaluated and are not logged
+MISSING_CONFIG = -1
+INVALID_SPEED = -2
+INVALID_GEAR = -3
+
+RULE_LATE_SHIFT = "late_shift"
+RULE_EARLY_SHIFT = "early_shift"
+RULE_DOWNSHIFT = "downshift"
+RULE_SKIPPED_GEAR = "skipped_gear"
+
+ALL_RULES = frozenset(
+    [RULE_LATE_SHIFT, RULE_EARLY_SHIFT, RULE_DOWNSHIFT, RULE_SKIPPED_GEAR]
+)
+# Matches is_error: every shift is compared against the config of gear_to
+DEFAULT_RULES = frozenset([RULE_LATE_SHIFT])
+
+NO_ERROR_MESSAGE = "No Error Detected"
+
+MESSAGES = {
+    NO_ERROR: NO_ERROR_MESSAGE,
+    LATE_SHIFT: "Gear shift exceeded at {speed}, expected {expected}, shifting from {gear_from} to {gear_to}",
+    EARLY_SHIFT: "Gear shift speed not met at {speed}, expected {expected}, shifting from {gear_from} to {gear_to}",
+    DOWNSHIFT_OVERSPEED: "Downshift at {speed} above {expected}, shifting from {gear_from} to {gear_to}",
+    SKIPPED_GEAR: "Gear skipped at {speed}, shifting from {gear_from} to {gear_to}",
+    MISSING_CONFIG: "Gear config does not exist",
+    INVALID_SPEED: "Gear speed and actual speed must be integers",
+    INVALID_GEAR: "Gear from and gear to must be integers",
+}
+
+
+def render_error_message(
+    code: int, speed: int, expected: int, gear_from: int, gear_to: int
+) -> str:
+    template = MESSAGES.get(code)
+    if template is None:
+        raise ValueError("Unknown error code")
+    return template.format(
+        speed=speed, expected=expected, gear_from=gear_from, gear_to=gear_to
+    )
+
+
+class ShiftRuleEngine:
+    def __init__(self, thresholds: dict, rules=DEFAULT_RULES, early_margin: int = 5):
+        # thresholds: {(vehicle_type_ref, gear_to): speed}
+        unknown = set(rules) - ALL_RULES
+        if unknown:
+            raise ValueError(f"Unknown shift rules {sorted(unknown)}")
+        self.rules = frozenset(rules)
+        self.early_margin = early_margin
+        types = max((type_ref for type_ref, _ in thresholds), default=0) + 1
+        gears = max((gear_to for _, gear_to in thresholds), default=0) + 1
+        # table[type_ref][gear] is the speed that shifts into `gear`, or None
+        self.table = [[None] * gears for _ in range(types)]
+        for (type_ref, gear_to), speed in thresholds.items():
+            self.table[type_ref][gear_to] = speed
+
+    @classmethod
+    def from_configs(cls, configs: dict, **options):
+        # configs as returned by load_gear_configs()
+        thresholds = {key: config.speed for key, config in configs.items()}
+        return cls(thresholds, **options)
+
+    def threshold(self, type_ref: int, gear: int):
+        table = self.table
+        if type(type_ref) is not int or type(gear) is not int:
+            return None
+        if 0 <= type_ref < len(table) and 0 <= gear < len(table[type_ref]):
+            return table[type_ref][gear]
+        return None
+
+    def evaluate(self, type_ref: int, speed: int, gear_from: int, gear_to: int):
+        return self.evaluate_many([(type_ref, speed, gear_from, gear_to)])[0]
+
+    def evaluate_many(self, events, rules=None) -> list[tuple]:
+        # events: iterable of (type_ref, speed, gear_from, gear_to)
+        # Returns (code, expected_speed) per event in one pass over the batch
+        rules = self.rules if rules is None else rules
+        late = RULE_LATE_SHIFT in rules
+        early = RULE_EARLY_SHIFT in rules
+        downshift = RULE_DOWNSHIFT in rules
+        skipped = RULE_SKIPPED_GEAR in rules
+        margin = self.early_margin
+        threshold = self.threshold
+        results = []
+        append = results.append
+        for type_ref, speed, gear_from, gear_to in events:
+            expected = threshold(type_ref, gear_to)
+            if expected is None:
+                append((MISSING_CONFIG, None))
+                continue
+            if type(speed) is not int:
+                append((INVALID_SPEED, expected))
+                continue
+            if type(gear_from) is not int:
+                append((INVALID_GEAR, expected))
+                continue
+            if skipped and abs(gear_to - gear_from) > 1:
+                append((SKIPPED_GEAR, expected))
+            elif downshift and gear_to < gear_from:
+                # Leaving gear_from while above the speed that selects it
+                limit = threshold(type_ref, gear_from)
+                if limit is not None and speed > limit:
+                    append((DOWNSHIFT_OVERSPEED, limit))
+                else:
+                    append((NO_ERROR, expected))
+            elif late and speed > expected:
+                append((LATE_SHIFT, expected))
+            elif early and gear_to > gear_from and speed < expected - margin:
+                append((EARLY_SHIFT, expected))
+            else:
+                append((NO_ERROR, expected))
+        return results
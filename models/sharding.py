@@ -0,0 +1,329 @@
+import os
+import zlib
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from models.automatic import (
+    Vehicle,
+    MODELS,
+    DATABASE_PATH,
+    DATABASE_PROFILE,
+    make_database,
+    use_database,
+    get_database,
+    check_existance,
+    add_vehicle,
+    add_vehicles_many,
+    shift_log_add,
+    shift_log_add_many,
+    flush_shift_sketches,
+    fourth_gear_speed_totals,
+    shift_speed_totals,
+    speed_stats,
+    lookup_cache,
+)
+from models.query_service import make_read_database, error_recurrence
+
+# The fleet split across several SQLite files, each a complete database
+# (configs, vehicles, log, aggregates) with its own write lock. A vehicle and
+# all of its shifts live on one shard, chosen by a stable hash of its VIN or
+# of its vehicle type name:
+#   automatic.db -> automatic-shard00.db, automatic-shard01.db, ...
+# Each shard gets a writer process, so ingest scales with cores instead of
+# queueing on one lock. Queries fan out to every shard on read-only
+# connections in a thread pool (sqlite3 releases the GIL while a query runs)
+# and merge the partial aggregates. The shard count and key are fixed once
+# vehicles are registered.
+
+SHARD_KEYS = ("vin", "type")
+
+UNKNOWN_VEHICLE = "Vehicle does not exist"
+
+
+def shard_paths(path: str, shards: int) -> list[str]:
+    root, extension = os.path.splitext(path)
+    return [f"{root}-shard{index:02d}{extension or '.db'}" for index in range(shards)]
+
+
+def stable_shard(value: str, shards: int) -> int:
+    # crc32 is the same in every process, unlike the salted str hash
+    return zlib.crc32(value.encode()) % shards
+
+
+class ShardRouter:
+    # Maps vehicles to shards. With key="type" a VIN is only routed once its
+    # shard is known, from registration or load_directory.
+    def __init__(self, shards: int, key: str = "vin"):
+        if shards < 1:
+            raise ValueError("At least one shard is needed")
+        if key not in SHARD_KEYS:
+            raise ValueError(f"Unknown shard key, please use {list(SHARD_KEYS)}")
+        self.shards = shards
+        self.key = key
+        # {vin: shard} for key="type"
+        self.directory = {}
+
+    def vehicle_shard(self, vin: str, vtype: str) -> int:
+        # Shard to register a vehicle on. A known VIN stays where it is, so
+        # registering it again under another type updates it in place
+        if self.key == "vin":
+            return stable_shard(vin, self.shards)
+        known = self.directory.get(vin)
+        if known is not None:
+            return known
+        return stable_shard(vtype.lower(), self.shards)
+
+    def shard(self, vin: str) -> int:
+        # None for an unknown VIN under key="type"
+        if self.key == "vin":
+            return stable_shard(vin, self.shards)
+        return self.directory.get(vin)
+
+    def learn(self, vin: str, shard: int) -> None:
+        if self.key == "type":
+            self.directory[vin] = shard
+
+
+def _shard_writer(path: str, profile: str, inbox, outbox) -> None:
+    # Writer process of one shard: batches of shift records in, the
+    # shift_log_add_many results (or the exception) out, None to stop
+    use_database(path, profile)
+    try:
+        while True:
+            records = inbox.get()
+            if records is None:
+                break
+            try:
+                outbox.put(shift_log_add_many(records))
+            except Exception as exc:
+                outbox.put(exc)
+        flush_shift_sketches()
+    finally:
+        get_database().close()
+
+
+class ShardedFleet:
+    def __init__(
+        self,
+        path: str = DATABASE_PATH,
+        shards: int = 4,
+        key: str = "vin",
+        profile: str = DATABASE_PROFILE,
+        query_threads: int = None,
+    ):
+        self.router = ShardRouter(shards, key)
+        self.paths = shard_paths(path, shards)
+        self.profile = profile
+        self.databases = [
+            make_database(shard_path, profile) for shard_path in self.paths
+        ]
+        self._readers = None
+        self._pool = ThreadPoolExecutor(query_threads or shards)
+        self._writers = None
+
+    @contextmanager
+    def shard(self, index: int):
+        # Binds the models to one shard in this process for the duration,
+        # for setup and single events; not thread safe
+        database = self.databases[index]
+        with database.bind_ctx(MODELS, bind_refs=False, bind_backrefs=False):
+            lookup_cache.clear()
+            try:
+                yield database
+            finally:
+                flush_shift_sketches()
+                database.close()
+                lookup_cache.clear()
+
+    def create(self) -> None:
+        # Creates or migrates every shard, then learns where vehicles live
+        for index in range(self.router.shards):
+            with self.shard(index):
+                check_existance()
+        if self.router.key == "type":
+            self.load_directory()
+
+    def load_directory(self) -> None:
+        vins = self.fan_out(
+            lambda database: [
+                vin for (vin,) in Vehicle.select(Vehicle.vin).bind(database).tuples()
+            ]
+        )
+        for index, shard_vins in enumerate(vins):
+            for vin in shard_vins:
+                self.router.learn(vin, index)
+
+    def add_vehicle(self, vin: str, make: str, year: int, vtype: str) -> None:
+        if type(vin) != str or type(vtype) != str:
+            raise ValueError("Invalid vehicle data")
+        index = self.router.vehicle_shard(vin, vtype)
+        with self.shard(index):
+            add_vehicle(vin, make, year, vtype)
+        self.router.learn(vin, index)
+
+    def add_vehicles_many(self, vehicles) -> dict:
+        # (vin, make, year, vtype) tuples, with the summary of
+        # models.automatic.add_vehicles_many over all shards
+        batches = [[] for _ in self.paths]
+        # {vin: shard} of this call, a VIN listed twice goes to one shard
+        routes = {}
+        result = {"added": 0, "updated": 0, "rejected": 0, "rejections": {}}
+        for vehicle in vehicles:
+            vin, _, _, vtype = vehicle
+            if type(vin) != str or type(vtype) != str:
+                result["rejected"] += 1
+                rejections = result["rejections"]
+                rejections["Invalid vehicle data"] = (
+                    rejections.get("Invalid vehicle data", 0) + 1
+                )
+                continue
+            if vin not in routes:
+                routes[vin] = self.router.vehicle_shard(vin, vtype)
+            batches[routes[vin]].append(vehicle)
+        for index, batch in enumerate(batches):
+            if not batch:
+                continue
+            with self.shard(index):
+                shard_result = add_vehicles_many(batch)
+                if self.router.key == "type":
+                    stored = lookup_cache.vehicles(vin for vin, _, _, _ in batch)
+                    for vin in stored:
+                        self.router.learn(vin, index)
+            for name in ("added", "updated", "rejected"):
+                result[name] += shard_result[name]
+            for message, count in shard_result["rejections"].items():
+                result["rejections"][message] = (
+                    result["rejections"].get(message, 0) + count
+                )
+        return result
+
+    def start_writers(self) -> None:
+        # One writer process per shard, used by shift_log_add_many until
+        # stop_writers. Without them batches are written in this process.
+        if self._writers is not None:
+            return
+        self._writers = []
+        for path in self.paths:
+            inbox, outbox = multiprocessing.Queue(), multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_shard_writer,
+                args=(path, self.profile, inbox, outbox),
+                daemon=True,
+            )
+            process.start()
+            self._writers.append((process, inbox, outbox))
+
+    def stop_writers(self) -> None:
+        if self._writers is None:
+            return
+        for _, inbox, _ in self._writers:
+            inbox.put(None)
+        for process, _, _ in self._writers:
+            process.join()
+        self._writers = None
+
+    def shift_log_add(self, vin: str, gear_speed: int, gear_from: int, gear_to: int):
+        index = self.router.shard(vin)
+        if index is None:
+            raise ValueError(UNKNOWN_VEHICLE)
+        with self.shard(index):
+            shift_log_add(vin, gear_speed, gear_from, gear_to)
+
+    def shift_log_add_many(self, records) -> list[dict]:
+        # Same contract as models.automatic.shift_log_add_many; every shard
+        # writes its part of the batch at the same time
+        records = list(records)
+        results = [None] * len(records)
+        batches = [[] for _ in self.paths]
+        positions = [[] for _ in self.paths]
+        for position, record in enumerate(records):
+            index = self.router.shard(record[0])
+            if index is None:
+                results[position] = {
+                    "vin": record[0],
+                    "logged": False,
+                    "error": False,
+                    "message": UNKNOWN_VEHICLE,
+                }
+                continue
+            batches[index].append(record)
+            positions[index].append(position)
+        if self._writers is None:
+            shard_results = []
+            for index, batch in enumerate(batches):
+                if batch:
+                    with self.shard(index):
+                        shard_results.append(shift_log_add_many(batch))
+                else:
+                    shard_results.append([])
+        else:
+            for (_, inbox, _), batch in zip(self._writers, batches):
+                if batch:
+                    inbox.put(batch)
+            shard_results = []
+            for (_, _, outbox), batch in zip(self._writers, batches):
+                shard_results.append(outbox.get() if batch else [])
+            for shard_result in shard_results:
+                if isinstance(shard_result, Exception):
+                    raise shard_result
+        for shard_positions, shard_result in zip(positions, shard_results):
+            for position, result in zip(shard_positions, shard_result):
+                results[position] = result
+        return results
+
+    def readers(self) -> list:
+        if self._readers is None:
+            self._readers = [make_read_database(path) for path in self.paths]
+        return self._readers
+
+    def fan_out(self, function) -> list:
+        # function(database) on every shard in parallel, one result per shard
+        def run(database):
+            try:
+                return function(database)
+            finally:
+                database.close()
+
+        return list(self._pool.map(run, self.readers()))
+
+    def average_speed_to_fourth_gear(self):
+        totals = self.fan_out(fourth_gear_speed_totals)
+        total = sum(speed_sum for speed_sum, _ in totals)
+        count = sum(shifts for _, shifts in totals)
+        return total / count if count else None
+
+    def shift_speed_stats(self, gear_from: int = 3, gear_to: int = 4) -> list[dict]:
+        merged = {}
+        for rows in self.fan_out(
+            lambda database: shift_speed_totals(gear_from, gear_to, database)
+        ):
+            for type_ref, type_name, count, total, squares, low, high in rows:
+                totals = merged.get(type_ref)
+                if totals is None:
+                    merged[type_ref] = [type_name, count, total, squares, low, high]
+                    continue
+                totals[1] += count
+                totals[2] += total
+                totals[3] += squares
+                totals[4] = min(totals[4], low)
+                totals[5] = max(totals[5], high)
+        return [
+            speed_stats(totals[0], gear_from, gear_to, *totals[1:])
+            for _, totals in sorted(merged.items())
+        ]
+
+    def error_frequency_previous_last_week(self, before=None, since=None) -> list[dict]:
+        # A vehicle's rollups are all on its shard, so the shard answers only
+        # need merging in VIN order
+        rows = []
+        for shard_rows in self.fan_out(
+            lambda database: error_recurrence(database, before, since)
+        ):
+            rows.extend(shard_rows)
+        return sorted(rows, key=lambda row: row["vin"])
+
+    def close(self) -> None:
+        self.stop_writers()
+        self._pool.shutdown()
+        for database in self.databases:
+            database.close()
@@ -0,0 +1,247 @@
+import json
+import time
+import random
+import datetime
+from peewee import chunked
+from models.automatic import (
+    Vehicle,
+    VehicleType,
+    get_database,
+    lookup_cache,
+)
+
+# Automatic transmission simulator for load tests. Virtual vehicles of every
+# VehicleType accelerate, cruise and brake; the transmission upshifts when the
+# speed reaches the GearChangeConfig speed of the next gear and downshifts
+# once the speed is back under the speed of the gear below. late_ratio of the
+# upshifts are held past the threshold so they are logged as late shifts.
+# Shifts into first gear have no config and cannot be logged, so vehicles
+# only start in first gear and stop and pull away in second, which keeps the
+# stream consistent for models.state.
+#
+# Everything is drawn from one seeded random.Random, so a seed reproduces the
+# same events. Events are (vin, speed, gear_from, gear_to, timestamp) records
+# in simulated time order, ready for shift_log_add_many or ShiftEventBuffer;
+# with samples=True every tick also yields a speed-only sample
+# (vin, speed, None, None, timestamp) for models.state.
+
+# Acceleration in speed units per second by type name, other types use 2.0
+ACCELERATION = {"Truck": 1.5, "Car": 3.0, "SUV": 2.5, "Van": 2.0}
+
+
+class SimulatedVehicle:
+    __slots__ = (
+        "vin",
+        "type_ref",
+        "acceleration",
+        "gear",
+        "speed",
+        "target",
+        "phase",
+        "ticks",
+        "late_margin",
+    )
+
+    def __init__(self, vin: str, type_ref: int, acceleration: float):
+        self.vin = vin
+        self.type_ref = type_ref
+        self.acceleration = acceleration
+        self.gear = 1
+        self.speed = 0.0
+        self.target = 0.0
+        self.phase = "idle"
+        self.ticks = 0
+        # Extra speed before the pending upshift, None until it is decided
+        self.late_margin = None
+
+
+class TransmissionSimulator:
+    def __init__(
+        self,
+        vehicles_per_type: int = 10,
+        late_ratio: float = 0.05,
+        seed: int = 0,
+        tick: float = 1.0,
+        start: datetime.datetime = None,
+        samples: bool = False,
+        configs: dict = None,
+        vehicle_types: dict = None,
+    ):
+        # configs {(type_ref, gear_to): record with speed}, vehicle_types {pk: name}
+        if not 0 <= late_ratio <= 1:
+            raise ValueError("late_ratio must be between 0 and 1")
+        self.late_ratio = late_ratio
+        self.tick = tick
+        self.samples = samples
+        self.rng = random.Random(seed)
+        self.now = start or datetime.datetime(2024, 1, 1)
+        configs = configs if configs is not None else lookup_cache.gear_configs()
+        if vehicle_types is None:
+            vehicle_types = dict(
+                VehicleType.select(VehicleType.pk, VehicleType.type_name).tuples()
+            )
+        # thresholds[type_ref][gear] is the speed that shifts into `gear`
+        self.thresholds = {}
+        for (type_ref, gear_to), config in configs.items():
+            self.thresholds.setdefault(type_ref, {})[gear_to] = config.speed
+        self.vehicles = []
+        for type_ref in sorted(self.thresholds):
+            name = vehicle_types.get(type_ref, str(type_ref))
+            for number in range(vehicles_per_type):
+                jitter = self.rng.uniform(0.8, 1.2)
+                self.vehicles.append(
+                    SimulatedVehicle(
+                        f"SIM{type_ref:02d}{number:07d}",
+                        type_ref,
+                        ACCELERATION.get(name, 2.0) * jitter,
+                    )
+                )
+
+    def fleet(self) -> list[tuple]:
+        # (vin, type_ref) of every simulated vehicle
+        return [(vehicle.vin, vehicle.type_ref) for vehicle in self.vehicles]
+
+    def _next_phase(self, vehicle: SimulatedVehicle) -> None:
+        rng = self.rng
+        thresholds = self.thresholds[vehicle.type_ref]
+        top = max(thresholds.values()) + 10
+        if vehicle.phase in ("idle", "decelerate"):
+            if vehicle.speed <= 0 and vehicle.phase == "decelerate":
+                vehicle.phase, vehicle.ticks = "idle", rng.randint(1, 10)
+                return
+            vehicle.phase = "accelerate"
+            vehicle.target = rng.uniform(min(vehicle.speed + 5, top), top)
+        elif vehicle.phase == "accelerate":
+            vehicle.phase, vehicle.ticks = "cruise", rng.randint(5, 60)
+        else:
+            vehicle.phase = "decelerate"
+            vehicle.target = (
+                0.0 if rng.random() < 0.3 else rng.uniform(0, vehicle.speed)
+            )
+
+    def _drive(self, vehicle: SimulatedVehicle) -> None:
+        rng = self.rng
+        step = vehicle.acceleration * self.tick
+        if vehicle.phase == "accelerate":
+            vehicle.speed = min(vehicle.target, vehicle.speed + step)
+            if vehicle.speed >= vehicle.target:
+                self._next_phase(vehicle)
+        elif vehicle.phase == "decelerate":
+            vehicle.speed = max(vehicle.target, vehicle.speed - step * 1.5)
+            if vehicle.speed <= vehicle.target:
+                self._next_phase(vehicle)
+        else:
+            if vehicle.phase == "cruise":
+                vehicle.speed = max(0.0, vehicle.speed + rng.uniform(-1, 1))
+            vehicle.ticks -= 1
+            if vehicle.ticks <= 0:
+                self._next_phase(vehicle)
+
+    def _shift(self, vehicle: SimulatedVehicle) -> list[tuple]:
+        thresholds = self.thresholds[vehicle.type_ref]
+        events = []
+        upshift = thresholds.get(vehicle.gear + 1)
+        if upshift is not None and vehicle.speed >= upshift:
+            if vehicle.late_margin is None:
+                late = self.rng.random() < self.late_ratio
+                vehicle.late_margin = self.rng.randint(1, 10) if late else 0
+            if vehicle.speed >= upshift + vehicle.late_margin:
+                # On time shifts happen at the threshold, late ones above it
+                speed = int(vehicle.speed) if vehicle.late_margin else upshift
+                events.append((vehicle.vin, speed, vehicle.gear, vehicle.gear + 1))
+                vehicle.gear += 1
+                vehicle.late_margin = None
+            return events
+        # A held upshift stays held until the gear changes
+        downshift = thresholds.get(vehicle.gear - 1)
+        if downshift is not None and vehicle.speed <= downshift:
+            events.append(
+                (vehicle.vin, int(vehicle.speed), vehicle.gear, vehicle.gear - 1)
+            )
+            vehicle.gear -= 1
+            vehicle.late_margin = None
+        return events
+
+    def step(self) -> list[tuple]:
+        # Advances every vehicle by one tick, returns that tick's records
+        self.now += datetime.timedelta(seconds=self.tick)
+        timestamp = self.now
+        records = []
+        for vehicle in self.vehicles:
+            self._drive(vehicle)
+            for vin, speed, gear_from, gear_to in self._shift(vehicle):
+                records.append((vin, speed, gear_from, gear_to, timestamp))
+            if self.samples:
+                records.append((vehicle.vin, int(vehicle.speed), None, None, timestamp))
+        return records
+
+    def events(self, count: int = None, duration: float = None):
+        # Yields records until `count` records or `duration` simulated seconds
+        emitted = 0
+        elapsed = 0.0
+        while duration is None or elapsed < duration:
+            elapsed += self.tick
+            for record in self.step():
+                yield record
+                emitted += 1
+                if count is not None and emitted >= count:
+                    return
+
+
+def register_simulated_fleet(simulator: TransmissionSimulator) -> int:
+    # Adds the simulated vehicles that are not in the database yet
+    fleet = simulator.fleet()
+    existing = set()
+    for chunk in chunked([vin for vin, _ in fleet], 500):
+        existing.update(
+            vin
+            for (vin,) in Vehicle.select(Vehicle.vin)
+            .where(Vehicle.vin.in_(chunk))
+            .tuples()
+        )
+    rows = [
+        {"vin": vin, "type_make": "Simulated", "type_year": 2024, "type_ref": type_ref}
+        for vin, type_ref in fleet
+        if vin not in existing
+    ]
+    # Another process may register the same fleet at the same time
+    with get_database().atomic():
+        for chunk in chunked(rows, 100):
+            Vehicle.insert_many(chunk).on_conflict_ignore().execute()
+    lookup_cache.invalidate_vehicle()
+    return len(rows)
+
+
+def paced(records, rate: float, clock=time.monotonic, sleep=time.sleep):
+    # Yields records no faster than `rate` per second of wall time
+    if rate is None or rate <= 0:
+        yield from records
+        return
+    started = clock()
+    for number, record in enumerate(records):
+        delay = started + number / rate - clock()
+        if delay > 0:
+            sleep(delay)
+        yield record
+
+
+def to_ndjson(record: tuple) -> str:
+    # One ingest line, see models.ingest.parse_event
+    vin, speed, gear_from, gear_to, timestamp = record
+    event = {"vin": vin, "speed": speed}
+    if gear_from is not None or gear_to is not None:
+        event["gear_from"] = gear_from
+        event["gear_to"] = gear_to
+    if timestamp is not None:
+        event["timestamp"] = timestamp.isoformat()
+    return json.dumps(event)
+
+
+def feed(buffer, records) -> dict:
+    # Drives a models.ingest.ShiftEventBuffer with the records, as --serve
+    # would, and returns its report. Samples need a buffer with a tracker.
+    for record in records:
+        buffer.add(record)
+        buffer.flush_if_due()
+    buffer.flush()
+    return buffer.stats.report()
@@ -0,0 +1,315 @@
+import math
+import json
+import time
+import random
+import threading
+import hashlib
+
+# Mergeable streaming summaries for approximate fleet statistics. They hold
+# no database state; models.automatic feeds them from the write path and
+# stores them in ShiftSketch as blobs.
+#
+#   ReservoirSample - uniform sample of shift speeds (Algorithm R), the
+#                     average comes with a 95% confidence half-width
+#   TDigest         - merging t-digest of shift speeds, accurate quantiles
+#                     with the best resolution at the tails
+#   HyperLogLog     - distinct count with a standard error of 1.04 / sqrt(m)
+
+SPEED_SAMPLE = "speed_sample"
+SPEED_DIGEST = "speed_digest"
+ERROR_VEHICLES = "error_vehicles"
+
+RESERVOIR_SIZE = 256
+DIGEST_COMPRESSION = 100
+HLL_PRECISION = 12
+
+
+class ReservoirSample:
+    def __init__(self, size: int = RESERVOIR_SIZE, count: int = 0, items=None):
+        self.size = size
+        # Values seen, the sample holds min(count, size) of them
+        self.count = count
+        self.items = list(items or [])
+
+    def add(self, value, rng=random) -> None:
+        self.count += 1
+        if len(self.items) < self.size:
+            self.items.append(value)
+            return
+        slot = rng.randrange(self.count)
+        if slot < self.size:
+            self.items[slot] = value
+
+    def merge(self, other, rng=random) -> None:
+        if other.size != self.size:
+            raise ValueError("Reservoir sizes differ")
+        # Each draw picks a side in proportion to the values it has left, so
+        # the split follows the hypergeometric distribution of a uniform
+        # sample of the combined stream
+        ours, theirs = list(self.items), list(other.items)
+        rng.shuffle(ours)
+        rng.shuffle(theirs)
+        left, right = self.count, other.count
+        items = []
+        while len(items) < self.size and (left or right):
+            if rng.random() * (left + right) < left:
+                items.append(ours.pop())
+                left -= 1
+            else:
+                items.append(theirs.pop())
+                right -= 1
+        self.items = items
+        self.count += other.count
+
+    def mean(self) -> tuple:
+        # (estimate, 95% half-width); exact while every value is in the sample
+        sampled = len(self.items)
+        if not sampled:
+            return None, None
+        mean = sum(self.items) / sampled
+        if sampled == self.count or sampled == 1:
+            return mean, 0.0
+        variance = sum((item - mean) ** 2 for item in self.items) / (sampled - 1)
+        correction = (self.count - sampled) / (self.count - 1)
+        return mean, 1.96 * math.sqrt(variance / sampled * correction)
+
+    def to_blob(self) -> bytes:
+        return json.dumps(
+            {"size": self.size, "n": self.count, "items": self.items}
+        ).encode()
+
+    @classmethod
+    def from_blob(cls, data: bytes):
+        state = json.loads(data)
+        return cls(state["size"], state["n"], state["items"])
+
+
+class TDigest:
+    def __init__(self, compression: int = DIGEST_COMPRESSION):
+        self.compression = compression
+        # Sorted [mean, weight] centroids plus values not merged in yet
+        self.centroids = []
+        self.pending = []
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight: int = 1) -> None:
+        self.pending.append((value, weight))
+        self.count += weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.pending) >= 5 * self.compression:
+            self._compress()
+
+    def merge(self, other) -> None:
+        if not other.count:
+            return
+        other._compress()
+        self.pending.extend((mean, weight) for mean, weight in other.centroids)
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+
+    def _limit(self, q: float) -> float:
+        # Inverse of the k1 scale function, clamped to q <= 1
+        k = self.compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        k = min(k, self.compression / 4)
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self) -> None:
+        if not self.pending:
+            return
+        points = sorted(
+            [(mean, weight) for mean, weight in self.centroids] + self.pending
+        )
+        self.pending = []
+        total = self.count
+        merged = []
+        seen = 0
+        mean, weight = points[0]
+        limit = total * self._limit(0)
+        for value, value_weight in points[1:]:
+            if seen + weight + value_weight <= limit:
+                weight += value_weight
+                mean += (value - mean) * value_weight / weight
+            else:
+                seen += weight
+                merged.append([mean, weight])
+                limit = total * self._limit(seen / total)
+                mean, weight = value, value_weight
+        merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q: float) -> tuple:
+        # (estimate, rank error): the rank error is the share of values in
+        # the centroids the estimate is interpolated between
+        self._compress()
+        if not self.centroids:
+            return None, None
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile must be between 0 and 1")
+        target = q * self.count
+        cumulative = 0
+        previous = None
+        for mean, weight in self.centroids:
+            if target < cumulative + weight / 2:
+                if previous is None:
+                    fraction = target / (weight / 2)
+                    return self.min + (mean - self.min) * fraction, weight / self.count
+                left_mean, left_weight = previous
+                span = (left_weight + weight) / 2
+                fraction = (target - (cumulative - left_weight / 2)) / span
+                estimate = left_mean + (mean - left_mean) * fraction
+                return estimate, span / self.count
+            cumulative += weight
+            previous = (mean, weight)
+        mean, weight = previous
+        fraction = (target - (self.count - weight / 2)) / (weight / 2)
+        return mean + (self.max - mean) * min(fraction, 1), weight / self.count
+
+    def to_blob(self) -> bytes:
+        self._compress()
+        state = {
+            "compression": self.compression,
+            "n": self.count,
+            "min": self.min,
+            "max": self.max,
+            "c": self.centroids,
+        }
+        return json.dumps(state).encode()
+
+    @classmethod
+    def from_blob(cls, data: bytes):
+        state = json.loads(data)
+        digest = cls(state["compression"])
+        digest.count = state["n"]
+        digest.min = state["min"]
+        digest.max = state["max"]
+        digest.centroids = state["c"]
+        return digest
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = HLL_PRECISION, registers: bytes = None):
+        self.precision = precision
+        self.registers = bytearray(registers or bytes(1 << precision))
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, value) -> None:
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, "big")
+        rest_bits = 64 - self.precision
+        index = hashed >> rest_bits
+        rest = hashed & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other) -> None:
+        if other.precision != self.precision:
+            raise ValueError("HyperLogLog precisions differ")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0**-rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Small range correction (linear counting)
+            estimate = size * math.log(size / zeros)
+        return round(estimate)
+
+    def to_blob(self) -> bytes:
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_blob(cls, data: bytes):
+        return cls(data[0], data[1:])
+
+
+SKETCH_TYPES = {
+    SPEED_SAMPLE: ReservoirSample,
+    SPEED_DIGEST: TDigest,
+    ERROR_VEHICLES: HyperLogLog,
+}
+
+
+def speed_key(type_ref: int, gear_from: int, gear_to: int) -> str:
+    return f"{type_ref}:{gear_from}:{gear_to}"
+
+
+class SketchBuffer:
+    # Sketch deltas for the rows logged since the last flush, keyed by
+    # (kind, key). Deltas merge into the stored sketches, so the write path
+    # only updates memory and the stored sketches are read and written once
+    # per flush_events events or flush_seconds seconds. Thread safe: the
+    # storage committer thread adds while the main thread flushes.
+    def __init__(self, flush_events=5000, flush_seconds=10.0, clock=time.monotonic):
+        self.flush_events = flush_events
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._reset()
+
+    def __len__(self) -> int:
+        return self.events
+
+    def _reset(self) -> None:
+        self.sketches = {}
+        self.events = 0
+        self.started = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def sketch(self, kind: str, key: str):
+        sketch = self.sketches.get((kind, key))
+        if sketch is None:
+            sketch = self.sketches[(kind, key)] = SKETCH_TYPES[kind]()
+        return sketch
+
+    def add(self, type_ref, vehicle_ref, speed, gear_from, gear_to, error, day):
+        key = speed_key(type_ref, gear_from, gear_to)
+        with self._lock:
+            if self.started is None:
+                self.started = self.clock()
+            self.events += 1
+            self.sketch(SPEED_SAMPLE, key).add(speed)
+            self.sketch(SPEED_DIGEST, key).add(speed)
+            if error:
+                self.sketch(ERROR_VEHICLES, day.isoformat()).add(vehicle_ref)
+
+    def due(self) -> bool:
+        with self._lock:
+            if not self.events:
+                return False
+            if self.events >= self.flush_events:
+                return True
+            return self.clock() - self.started >= self.flush_seconds
+
+    def drain(self) -> tuple:
+        # (sketches, events) pending so far, leaving the buffer empty
+        with self._lock:
+            drained = self.sketches, self.events
+            self._reset()
+            return drained
+
+    def restore(self, sketches: dict, events: int) -> None:
+        # Puts drained sketches back, e.g. after a failed flush, merged with
+        # whatever was added in the meantime
+        with self._lock:
+            if self.started is None:
+                self.started = self.clock()
+            self.events += events
+            for (kind, key), sketch in sketches.items():
+                self.sketch(kind, key).merge(sketch)
+
+    def take(self) -> dict:
+        return self.drain()[0]
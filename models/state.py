@@ -0,0 +1,218 @@
+import time
+from collections import OrderedDict, namedtuple
+from models.automatic import lookup_cache, rule_engine
+from models.rules import NO_ERROR, render_error_message
+
+# In-memory state per VIN fed by the event stream. Shift events move a
+# vehicle into gear_to; speed samples (no gear_from/gear_to) only update the
+# speed. Anomalies are pushed to the subscribers as they are detected:
+#
+#   missed_upshift - the speed went above the configured speed of the next
+#                    gear without a gear change (reported once per excursion)
+#   gear_mismatch  - a shift started from another gear than the tracked one,
+#                    usually because events were lost
+#   shift_error    - the shift itself broke a rule, see models.rules
+#
+# Vehicles are kept in least recently active order, so both the size bound
+# and idle eviction only ever pop from the front. Idle vehicles are evicted
+# whenever a new vehicle is tracked, or explicitly with evict_idle().
+
+MISSED_UPSHIFT = "missed_upshift"
+GEAR_MISMATCH = "gear_mismatch"
+SHIFT_ERROR = "shift_error"
+
+# missed_upshift: gear_from is the current gear and gear_to the one expected
+# gear_mismatch: gear_from is the tracked gear and gear_to the reported one
+Anomaly = namedtuple(
+    "Anomaly",
+    ["vin", "kind", "speed", "gear_from", "gear_to", "expected", "code", "timestamp"],
+)
+
+
+class VehicleState:
+    __slots__ = ("vin", "type_ref", "gear", "speed", "active", "over_limit")
+
+    def __init__(self, vin: str, type_ref: int, active: float):
+        self.vin = vin
+        self.type_ref = type_ref
+        self.gear = None
+        self.speed = None
+        self.active = active
+        # True while above the next gear's speed, so one excursion alerts once
+        self.over_limit = False
+
+
+class ShiftStateTracker:
+    def __init__(
+        self,
+        max_vehicles: int = 100000,
+        idle_timeout: float = 900.0,
+        vehicles=None,
+        engine=None,
+        clock=time.monotonic,
+    ):
+        # vehicles(vins) -> {vin: record with type_ref}, engine() -> ShiftRuleEngine
+        self.max_vehicles = max_vehicles
+        self.idle_timeout = idle_timeout
+        self.vehicles = vehicles or lookup_cache.vehicles
+        self.engine = engine or rule_engine
+        self.clock = clock
+        self.subscribers = []
+        self._states = OrderedDict()
+        self.observed = 0
+        self.unknown = 0
+        self.evicted = 0
+        self.anomalies = 0
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def subscribe(self, callback) -> None:
+        # callback(anomaly); use queue.put_nowait to stream into a queue
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback) -> None:
+        self.subscribers.remove(callback)
+
+    def state(self, vin: str) -> VehicleState:
+        return self._states.get(vin)
+
+    def _emit(self, anomaly: Anomaly) -> None:
+        self.anomalies += 1
+        for callback in self.subscribers:
+            callback(anomaly)
+
+    def _touch(self, vin: str, now: float) -> VehicleState:
+        state = self._states.get(vin)
+        if state is not None:
+            state.active = now
+            self._states.move_to_end(vin)
+            return state
+        vehicle = self.vehicles([vin]).get(vin)
+        if vehicle is None:
+            self.unknown += 1
+            return None
+        self.evict_idle(now)
+        state = self._states[vin] = VehicleState(vin, vehicle.type_ref, now)
+        while len(self._states) > self.max_vehicles:
+            self._states.popitem(last=False)
+            self.evicted += 1
+        return state
+
+    def observe(self, record: tuple) -> None:
+        # record: (vin, speed, gear_from, gear_to, timestamp), gears None for
+        # a speed sample
+        vin, speed, gear_from, gear_to, timestamp = record
+        self.observed += 1
+        state = self._touch(vin, self.clock())
+        if state is None:
+            return
+        engine = self.engine()
+        if gear_from is None and gear_to is None:
+            state.speed = speed
+            self._check_upshift(state, engine, timestamp)
+            return
+        if state.gear is not None and gear_from != state.gear:
+            self._emit(
+                Anomaly(
+                    vin,
+                    GEAR_MISMATCH,
+                    speed,
+                    state.gear,
+                    gear_from,
+                    None,
+                    None,
+                    timestamp,
+                )
+            )
+        code, expected = engine.evaluate(state.type_ref, speed, gear_from, gear_to)
+        if code < NO_ERROR:
+            # Not a usable shift (bad values or no config), keep the state
+            return
+        if code > NO_ERROR:
+            self._emit(
+                Anomaly(
+                    vin,
+                    SHIFT_ERROR,
+                    speed,
+                    gear_from,
+                    gear_to,
+                    expected,
+                    code,
+                    timestamp,
+                )
+            )
+        state.gear = gear_to
+        state.speed = speed
+        state.over_limit = False
+        self._check_upshift(state, engine, timestamp)
+
+    def observe_many(self, records) -> None:
+        # Loads the unknown VINs of the whole batch in one lookup first
+        records = list(records)
+        self.vehicles(
+            [record[0] for record in records if record[0] not in self._states]
+        )
+        for record in records:
+            self.observe(record)
+
+    def _check_upshift(self, state: VehicleState, engine, timestamp) -> None:
+        if state.gear is None or type(state.speed) is not int:
+            return
+        limit = engine.threshold(state.type_ref, state.gear + 1)
+        if limit is None or state.speed <= limit:
+            state.over_limit = False
+            return
+        if not state.over_limit:
+            state.over_limit = True
+            self._emit(
+                Anomaly(
+                    state.vin,
+                    MISSED_UPSHIFT,
+                    state.speed,
+                    state.gear,
+                    state.gear + 1,
+                    limit,
+                    None,
+                    timestamp,
+                )
+            )
+
+    def evict_idle(self, now: float = None) -> int:
+        # Drops vehicles without events for idle_timeout seconds
+        now = self.clock() if now is None else now
+        evicted = 0
+        states = self._states
+        while states:
+            vin, state = next(iter(states.items()))
+            if now - state.active < self.idle_timeout:
+                break
+            del states[vin]
+            evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self._states),
+            "observed": self.observed,
+            "unknown": self.unknown,
+            "evicted": self.evicted,
+            "anomalies": self.anomalies,
+        }
+
+
+def describe(anomaly: Anomaly) -> dict:
+    # JSON friendly form of an anomaly, with the rule message for shift errors
+    event = anomaly._asdict()
+    if anomaly.timestamp is not None:
+        event["timestamp"] = anomaly.timestamp.isoformat()
+    if anomaly.code is not None:
+        event["message"] = render_error_message(
+            anomaly.code,
+            anomaly.speed,
+            anomaly.expected,
+            anomaly.gear_from,
+            anomaly.gear_to,
+        )
+    return event
@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import zlib
+import datetime
+import threading
+from peewee import DatabaseError
+from models.automatic import (
+    StorageCheckpoint,
+    BATCH_CHUNK_SIZE,
+    get_database,
+    write_shift_logs,
+    insert_shift_logs,
+    sketch_shift_logs,
+    write_transaction,
+)
+from models.instrumentation import instrumentation
+
+# Storage backends behind store_shift_logs (models.automatic). A backend takes
+# the (vehicle_type_ref, TransmissionLog row) entries of classified shifts:
+#   SqliteBackend   - commits them in the calling thread, like having none set
+#   BufferedBackend - appends them to an on-disk segment log and an in-memory
+#                     ring buffer, then acknowledges. A committer thread writes
+#                     them to SQLite in groups, so an event waits for a segment
+#                     append instead of a commit.
+#
+# Every entry gets a sequence number. A group is committed together with the
+# StorageCheckpoint row holding its last sequence, so after a crash the
+# segment log is replayed from the checkpoint on and no entry is written twice.
+# Acknowledged entries survive a crash of the process once appended; with
+# sync=True the append is also fsynced, to survive a power loss.
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+
+# Row fields in segment records, in order after the vehicle type
+SEGMENT_FIELDS = (
+    "vehicle_ref",
+    "gear_speed",
+    "gear_from",
+    "gear_to",
+    "error",
+    "error_code",
+    "expected_speed",
+    "date_timestamp",
+)
+
+
+def encode_record(first: int, entries) -> bytes:
+    # One line per write: "<crc32 hex> [first sequence, [[type_ref, *row], ...]]"
+    rows = []
+    for type_ref, row in entries:
+        values = [type_ref]
+        values.extend(row[name] for name in SEGMENT_FIELDS[:-1])
+        values.append(row["date_timestamp"].isoformat())
+        rows.append(values)
+    payload = json.dumps([first, rows], separators=(",", ":")).encode()
+    return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+
+def decode_record(line: bytes) -> tuple:
+    # Returns (first sequence, entries), a torn or corrupt line raises ValueError
+    if not line.endswith(b"\n") or line[8:9] != b" ":
+        raise ValueError("Incomplete segment record")
+    payload = line[9:-1]
+    if int(line[:8], 16) != zlib.crc32(payload):
+        raise ValueError("Segment record checksum mismatch")
+    first, rows = json.loads(payload)
+    entries = []
+    for values in rows:
+        row = dict(zip(SEGMENT_FIELDS, values[1:]))
+        row["date_timestamp"] = datetime.datetime.fromisoformat(row["date_timestamp"])
+        entries.append((values[0], row))
+    return first, entries
+
+
+class SegmentLog:
+    # Append-only files in `directory`, named after the first sequence they
+    # hold. A new segment is started once the current one reaches
+    # segment_bytes, and segments are deleted once fully committed.
+    def __init__(
+        self, directory: str, segment_bytes: int = 64 * 1024 * 1024, sync=False
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sync = sync
+        self._file = None
+        # Sequence after the last appended entry
+        self.next = None
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self) -> list[tuple]:
+        # [(first sequence, path)] in sequence order
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                first = int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+                segments.append((first, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def path(self, first: int) -> str:
+        return os.path.join(
+            self.directory, f"{SEGMENT_PREFIX}{first:016d}{SEGMENT_SUFFIX}"
+        )
+
+    def append(self, first: int, entries) -> None:
+        if self._file is None:
+            self._file = open(self.path(first), "ab")
+        self._file.write(encode_record(first, entries))
+        self._file.flush()
+        self.next = first + len(entries)
+        if self.sync:
+            os.fsync(self._file.fileno())
+        if self._file.tell() >= self.segment_bytes:
+            self._file.close()
+            self._file = None
+
+    def records(self, after: int = 0):
+        # Yields (sequence, entry) for every entry after `after`. A segment is
+        # read up to its first torn or corrupt record, the tail of a write
+        # that never completed.
+        for _, path in self.segments():
+            with open(path, "rb") as segment:
+                for line in segment:
+                    try:
+                        first, entries = decode_record(line)
+                    except ValueError:
+                        instrumentation.incr("segment_records_discarded")
+                        break
+                    for sequence, entry in enumerate(entries, start=first):
+                        if sequence > after:
+                            yield sequence, entry
+
+    def truncate(self, committed: int) -> int:
+        # Deletes the segments whose entries are all committed, never the one
+        # being appended to. Returns the number deleted.
+        segments = self.segments()
+        active = self._file.name if self._file is not None else None
+        ends = [first for first, _ in segments[1:]] + [self.next]
+        deleted = 0
+        for (_, path), end in zip(segments, ends):
+            if end is None or end - 1 > committed or path == active:
+                break
+            os.unlink(path)
+            deleted += 1
+        return deleted
+
+    def reset(self) -> None:
+        # Drops every segment, once all of them are committed
+        self.close()
+        for _, path in self.segments():
+            os.unlink(path)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_checkpoint(name: str) -> int:
+    checkpoint = StorageCheckpoint.get_or_none(StorageCheckpoint.name == name)
+    return checkpoint.sequence if checkpoint is not None else 0
+
+
+def commit_entries(name: str, entries, last: int, chunk_size: int) -> None:
+    def commit() -> None:
+        insert_shift_logs(entries, chunk_size)
+        # SQL - INSERT OR REPLACE INTO storagecheckpoint (name, sequence) VALUES (?, ?);
+        StorageCheckpoint.insert(
+            name=name, sequence=last
+        ).on_conflict_replace().execute()
+
+    # A failed group is retried, so the sketches only see it once committed
+    write_transaction(commit)
+    sketch_shift_logs(entries)
+
+
+class SqliteBackend:
+    def __init__(self, chunk_size: int = BATCH_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    def write(self, entries) -> None:
+        write_shift_logs(entries, self.chunk_size)
+
+    def flush(self, timeout: float = None) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class BufferedBackend:
+    # Ring buffer of `capacity` acknowledged entries, committed every
+    # commit_interval seconds or once commit_size are pending. A full ring
+    # blocks writers until the committer catches up. One backend per
+    # directory and database file; the committer thread opens its own
+    # connection, so in-memory databases are not supported.
+    def __init__(
+        self,
+        directory: str,
+        capacity: int = 100000,
+        commit_size: int = 5000,
+        commit_interval: float = 0.2,
+        segment_bytes: int = 64 * 1024 * 1024,
+        sync: bool = False,
+        name: str = "shift_log",
+        chunk_size: int = BATCH_CHUNK_SIZE,
+    ):
+        path = get_database().database
+        if not path or ":memory:" in path or "mode=memory" in path:
+            raise ValueError("The buffered backend needs a database file")
+        if capacity < 1 or commit_size < 1:
+            raise ValueError("Capacity and commit size must be at least 1")
+        self.capacity = capacity
+        self.commit_size = min(commit_size, capacity)
+        self.commit_interval = commit_interval
+        self.name = name
+        self.chunk_size = chunk_size
+        self.segments = SegmentLog(directory, segment_bytes, sync)
+        self.error = None
+        self._ring = [None] * capacity
+        self._condition = threading.Condition()
+        self._flush_to = 0
+        self._closing = False
+        self.recovered = self.recover()
+        # Sequences of the last acknowledged and the last committed entry
+        self.written = self.committed = load_checkpoint(name)
+        self._thread = threading.Thread(
+            target=self._run, name="storage-committer", daemon=True
+        )
+        self._thread.start()
+
+    def recover(self) -> int:
+        # Commits the entries of the segment log past the checkpoint, then
+        # starts over with an empty log. Returns the number replayed.
+        committed = load_checkpoint(self.name)
+        replayed = 0
+        batch = []
+        for sequence, entry in self.segments.records(committed):
+            batch.append(entry)
+            if len(batch) >= self.commit_size:
+                commit_entries(self.name, batch, sequence, self.chunk_size)
+                replayed += len(batch)
+                batch = []
+        if batch:
+            commit_entries(self.name, batch, sequence, self.chunk_size)
+            replayed += len(batch)
+        self.segments.reset()
+        instrumentation.incr("replayed", replayed)
+        return replayed
+
+    def __len__(self) -> int:
+        # Entries acknowledged but not committed yet
+        return self.written - self.committed
+
+    def write(self, entries) -> None:
+        started = instrumentation.clock()
+        for start in range(0, len(entries), self.capacity):
+            self._append(entries[start : start + self.capacity])
+        instrumentation.lap("acknowledge", started)
+
+    def _append(self, entries) -> None:
+        with self._condition:
+            if self._closing:
+                raise ValueError("Storage backend is closed")
+            while self.written - self.committed + len(entries) > self.capacity:
+                instrumentation.incr("backpressure_waits")
+                self._flush_to = max(self._flush_to, self.written)
+                self._condition.notify_all()
+                self._condition.wait()
+            first = self.written + 1
+            self.segments.append(first, entries)
+            for sequence, entry in enumerate(entries, start=first):
+                self._ring[sequence % self.capacity] = entry
+            self.written += len(entries)
+            if self.written - self.committed >= self.commit_size:
+                self._condition.notify_all()
+
+    def _take(self) -> tuple:
+        # Waits for a group to commit, returns (entries, last sequence)
+        with self._condition:
+            if (
+                self.written - self.committed < self.commit_size
+                and self._flush_to <= self.committed
+                and not self._closing
+            ):
+                self._condition.wait(self.commit_interval)
+            first, last = self.committed + 1, self.written
+            ring, capacity = self._ring, self.capacity
+            return [
+                ring[sequence % capacity] for sequence in range(first, last + 1)
+            ], last
+
+    def _run(self) -> None:
+        try:
+            while True:
+                entries, last = self._take()
+                if not entries:
+                    if self._closing:
+                        return
+                    continue
+                started = instrumentation.clock()
+                try:
+                    commit_entries(self.name, entries, last, self.chunk_size)
+                except DatabaseError as exc:
+                    # Kept in the ring and retried; on close the segment log
+                    # still holds them for the next recovery
+                    with self._condition:
+                        self.error = exc
+                        self._condition.notify_all()
+                        if self._closing:
+                            return
+                        self._condition.wait(self.commit_interval)
+                    continue
+                instrumentation.lap("group_commit", started, len(entries))
+                instrumentation.incr("group_commits")
+                with self._condition:
+                    for sequence in range(self.committed + 1, last + 1):
+                        self._ring[sequence % self.capacity] = None
+                    self.committed = last
+                    self.error = None
+                    self.segments.truncate(last)
+                    self._condition.notify_all()
+        finally:
+            get_database().close()
+
+    def flush(self, timeout: float = None) -> None:
+        # Waits until every entry acknowledged so far is committed. Raises
+        # the error of the last failed commit, or TimeoutError.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            target = self.written
+            self._flush_to = max(self._flush_to, target)
+            self._condition.notify_all()
+            while self.committed < target:
+                if self.error is not None:
+                    raise self.error
+                if not self._thread.is_alive():
+                    raise ValueError("Storage backend is closed")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("Storage backend flush timed out")
+                self._condition.wait(remaining)
+
+    def close(self) -> None:
+        # Commits what is pending and stops the committer. Entries that could
+        # not be committed stay in the segment log.
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join()
+        self.segments.close()
+        if self.committed < self.written and self.error is not None:
+            raise self.error
@@ -23,6 +23,11 @@ REQUIRED = [
     "peewee",
 ]
 
+# What packages are optional?
+EXTRAS = {
+    "analytics": ["numpy"],
+}
+
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -51,6 +56,7 @@ setup(
     #     'console_scripts': ['mycli=mymodule:cli'],
     # },
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
     include_package_data=True,
     license="MIT",
     classifiers=[
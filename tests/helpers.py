@@ -0,0 +1,38 @@
+from peewee import SqliteDatabase, OperationalError
+from models.automatic import MODELS, lookup_cache, shift_sketches
+
+# Fixtures shared by the test modules
+
+# Shared in-memory database, emptied by close_test_database after every test
+test_db = SqliteDatabase(":memory:")
+
+
+class FakeClock:
+    # Stands in for time.monotonic (and time.sleep), moved by hand
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def open_test_database(database: SqliteDatabase = test_db) -> SqliteDatabase:
+    # Binds every model to database and creates the tables, with the
+    # in-process caches of the previous test cleared
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    try:
+        database.connect()
+    except OperationalError:
+        pass
+    database.create_tables(MODELS)
+    lookup_cache.clear()
+    shift_sketches.clear()
+    return database
+
+
+def close_test_database(database: SqliteDatabase = test_db) -> None:
+    database.drop_tables(MODELS)
+    database.close()
@@ -0,0 +1,70 @@
+import io
+import os
+import json
+import tempfile
+import argparse
+import unittest
+from contextlib import redirect_stderr
+from models.automatic import MODELS, get_database
+from benchmarks import bench_automatic
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.database = get_database()
+
+    def tearDown(self):
+        # The benchmarks rebind the models to their own databases
+        self.database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+
+    def test_smoke_run(self):
+        output = os.path.join(tempfile.mkdtemp(), "bench.json")
+        bench_automatic.main(
+            [
+                "--vehicles",
+                "10",
+                "--type-mix",
+                "car=1",
+                "--events",
+                "50",
+                "--batch-sizes",
+                "25",
+                "--sizes",
+                "100",
+                "200",
+                "--repeat",
+                "1",
+                "--lookups",
+                "20",
+                "--output",
+                output,
+            ]
+        )
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(report["options"]["type_mix"], {"Car": 1.0})
+        self.assertEqual(report["single_ingest"]["events"], 50)
+        self.assertEqual(report["batched_ingest"][0]["batch_size"], 25)
+        self.assertEqual([q["rows"] for q in report["queries"]], [100, 200])
+        self.assertIn("p99_us", report["single_ingest"]["latency"])
+        lookups = {entry["lookup"]: entry for entry in report["lookups"]}
+        self.assertIn("get_vehicle", lookups)
+        self.assertIn("peak_bytes_per_lookup", lookups["get_vehicle"]["current"])
+
+    def test_parse_type_mix(self):
+        self.assertEqual(
+            bench_automatic.parse_type_mix(["car=0.5", "Van=0.5"]),
+            {"Car": 0.5, "Van": 0.5},
+        )
+        self.assertEqual(
+            bench_automatic.parse_type_mix(["SUV=1", "suv=2"]), {"SUV": 2.0}
+        )
+        for values in (["Boat=1"], ["Car"], ["Car=-1"], ["Car=0"]):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                bench_automatic.parse_type_mix(values)
+        with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            bench_automatic.parse_args(["--type-mix", "Boat=1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
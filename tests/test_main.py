@@ -0,0 +1,116 @@
+import io
+import os
+import json
+import sys
+import time
+import tempfile
+import unittest
+import subprocess
+from contextlib import redirect_stdout, redirect_stderr
+from models.automatic import MODELS, get_database
+from models.instrumentation import instrumentation, remove_query_hook
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Generous upper bound so slow CI machines do not fail, the measured times
+# are printed with every run
+COLD_START_BUDGET = float(os.environ.get("AUTOMATIC_COLD_START_BUDGET", "5.0"))
+
+
+def run_cli(*args) -> tuple:
+    # Runs main.py in a fresh interpreter with -X importtime, returns
+    # (returncode, seconds, imported module names)
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.join(ROOT, "main.py"), *args],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - started
+    modules = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    return process.returncode, elapsed, modules
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.database = get_database()
+        self.path = os.path.join(tempfile.mkdtemp(), "automatic.db")
+
+    def tearDown(self):
+        remove_query_hook(get_database())
+        get_database().close()
+        # main() rebinds the models to its own database
+        self.database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+
+    def test_cold_start(self):
+        code, invalid, modules = run_cli("--shift-log")
+        self.assertEqual(code, 1)
+        # Argument errors are reported before peewee or the models load
+        self.assertNotIn("peewee", modules)
+        self.assertNotIn("models.automatic", modules)
+        code, first, modules = run_cli("--db", self.path, "--average-speed")
+        self.assertEqual(code, 0)
+        self.assertNotIn("playhouse.migrate", modules)
+        self.assertNotIn("cProfile", modules)
+        code, second, _ = run_cli("--db", self.path, "--average-speed")
+        self.assertEqual(code, 0)
+        sys.stderr.write(
+            f"\ncold start: invalid arguments {invalid * 1000:.0f}ms, "
+            f"new database {first * 1000:.0f}ms, existing database {second * 1000:.0f}ms\n"
+        )
+        self.assertLess(max(invalid, first, second), COLD_START_BUDGET)
+
+    def test_no_command(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(main.main([]), 0)
+        self.assertIn("usage", output.getvalue())
+
+    def test_zero_is_a_command(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(main.main(["--db", self.path, "--error-vehicles", "0"]), 0)
+        self.assertEqual(json.loads(output.getvalue())["vehicles"], 0)
+        for option, value in (
+            ("--error-vehicles", "-1"),
+            ("--rotate-partitions", "0"),
+            ("--retention", "0"),
+        ):
+            with redirect_stderr(io.StringIO()) as error:
+                with self.assertRaises(SystemExit):
+                    main.main([option, value])
+            self.assertIn(" or more, not ", error.getvalue())
+
+    def test_vehicle_add_known_vin(self):
+        vehicle = '{"vin": "ABC123", "make": "Honda", "year": 2020, "type": "car"}'
+        output = io.StringIO()
+        with redirect_stdout(output):
+            for _ in range(2):
+                main.main(["--db", self.path, "--vehicle-add", "--vehicle", vehicle])
+        self.assertEqual(output.getvalue(), "Vehicle already exists\n")
+
+    def test_schema_check_uses_user_version(self):
+        with redirect_stdout(io.StringIO()):
+            main.main(["--db", self.path, "--average-speed"])
+        instrumentation.reset()
+        output = io.StringIO()
+        with redirect_stdout(output):
+            main.main(["--db", self.path, "--average-speed", "--stats"])
+        average, stats = output.getvalue().splitlines()
+        self.assertEqual(average, "None")
+        # The schema check is PRAGMA user_version only, the two SELECTs are
+        # the partition list and the average itself
+        queries = json.loads(stats)["queries"]
+        self.assertEqual(queries["SELECT"]["count"], 2)
+        self.assertEqual(queries["PRAGMA"]["count"], 1)
+        instrumentation.reset()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import datetime
+from models.automatic import preload_config, add_vehicle, shift_log_add_many
+from models.partitions import rotate_partitions
+from models import analytics
+from tests.helpers import open_test_database, close_test_database
+
+
+@unittest.skipIf(analytics.np is None, "numpy is not installed")
+class TestAnalytics(unittest.TestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("ABC123456", "Honda", 2012, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        timestamp = datetime.datetime(2024, 1, 2, 3, 4, 5)
+        shift_log_add_many(
+            [
+                ("ABC12345", 38, 3, 4, timestamp),
+                ("ABC12345", 44, 3, 4, timestamp),
+                ("ABC123456", 41, 3, 4, timestamp),
+                ("ABC123456", 10, 1, 2, timestamp),
+                ("VAN12345", 25, 3, 4, timestamp),
+            ]
+        )
+
+    def tearDown(self):
+        close_test_database()
+
+    def test_load_log_chunks(self):
+        chunks = list(analytics.iter_log_chunks(chunk_size=2))
+        self.assertEqual([len(c["gear_speed"]) for c in chunks], [2, 2, 1])
+        log = analytics.load_log(chunk_size=2)
+        self.assertEqual(log["gear_speed"].tolist(), [38, 44, 41, 10, 25])
+        self.assertEqual(log["type_ref"].tolist(), [2, 2, 2, 2, 4])
+        self.assertEqual(log["error"].tolist(), [0, 1, 1, 0, 0])
+        self.assertEqual(
+            int(log["timestamp"][0]),
+            int(
+                datetime.datetime(
+                    2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc
+                ).timestamp()
+            ),
+        )
+        empty = analytics.load_log(where="t.gear_to = ?", params=(9,))
+        self.assertEqual(len(empty["gear_speed"]), 0)
+
+    def test_rotated_partitions(self):
+        shift_log_add_many([("VAN12345", 30, 3, 4, datetime.datetime(2023, 10, 2))])
+        moved = rotate_partitions(keep_months=3, now=datetime.datetime(2024, 1, 15))
+        self.assertEqual(moved, {"transmissionlog_202310": 1})
+        log = analytics.load_log(where="t.gear_to = ?", params=(4,))
+        self.assertEqual(sorted(log["gear_speed"].tolist()), [25, 30, 38, 41, 44])
+        by_vin = {r["vin"]: r for r in analytics.error_rates(analytics.load_log())}
+        self.assertEqual(by_vin["VAN12345"]["shifts"], 2)
+
+    def test_shift_speed_summary(self):
+        log = analytics.load_log()
+        summary = analytics.shift_speed_summary(log, percentiles=(0, 50, 100))
+        car = [s for s in summary if s["type_name"] == "Car" and s["gear_to"] == 4][0]
+        self.assertEqual(car["count"], 3)
+        self.assertAlmostEqual(car["mean"], 41.0)
+        self.assertEqual(car["percentiles"], {0: 38, 50: 41, 100: 44})
+        self.assertEqual(sum(car["histogram"]["counts"]), 3)
+        self.assertEqual(len(summary), 3)
+        self.assertEqual(
+            analytics.shift_speed_summary(analytics.load_log(where="t.gear_to = 9")), []
+        )
+
+    def test_error_rates(self):
+        log = analytics.load_log()
+        by_vin = {r["vin"]: r for r in analytics.error_rates(log, by="vin")}
+        self.assertEqual(by_vin["ABC12345"]["errors"], 1)
+        self.assertEqual(by_vin["ABC12345"]["error_rate"], 0.5)
+        self.assertEqual(by_vin["VAN12345"]["errors"], 0)
+        by_year = {r["year"]: r for r in analytics.error_rates(log, by="year")}
+        self.assertEqual(by_year[2012]["shifts"], 2)
+        self.assertRaises(ValueError, analytics.error_rates, log, "color")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from peewee import OperationalError
+from models.automatic import TransmissionLog, preload_config, add_vehicle
+from models.async_ingest import AsyncIngestService
+from tests.helpers import open_test_database, close_test_database
+
+
+class TestAsyncIngestService(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+
+    def tearDown(self):
+        close_test_database()
+
+    async def test_backpressure_and_drain(self):
+        service = AsyncIngestService(queue_size=2, batch_size=10)
+        await service.submit(("ABC12345", 10, 1, 2, None))
+        await service.submit(("ABC12345", 20, 1, 2, None))
+        # Queue is full and no writer is running, producers have to wait
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                service.submit(("ABC12345", 30, 1, 2, None)), timeout=0.05
+            )
+        report = await service.stop()
+        self.assertEqual(report["logged"], 2)
+        self.assertEqual(TransmissionLog.select().count(), 2)
+        with self.assertRaises(ValueError):
+            await service.submit(("ABC12345", 30, 1, 2, None))
+
+    async def test_concurrent_producers(self):
+        path = os.path.join(tempfile.mkdtemp(), "ingest.sock")
+        batches = []
+
+        def writer(records):
+            batches.append(len(records))
+            return [
+                {"vin": r[0], "logged": True, "error": False, "message": ""}
+                for r in records
+            ]
+
+        service = AsyncIngestService(queue_size=5, batch_size=4, writer=writer)
+        await service.start(path=path)
+
+        async def produce(count):
+            reader, writer = await asyncio.open_unix_connection(path)
+            for speed in range(count):
+                event = {
+                    "vin": "ABC12345",
+                    "speed": speed,
+                    "gear_to": 2,
+                    "gear_from": 1,
+                }
+                writer.write(json.dumps(event).encode() + b"\n")
+            writer.write(b"not json\n")
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+
+        await asyncio.gather(*(produce(25) for _ in range(4)))
+        while service.stats.received < 104:
+            await asyncio.sleep(0.01)
+        report = await service.stop()
+        self.assertEqual(report["logged"], 100)
+        self.assertEqual(report["rejected"], 4)
+        self.assertEqual(sum(batches), 100)
+        self.assertTrue(all(size <= 4 for size in batches))
+
+    async def test_writer_failure(self):
+        failures = [OperationalError("database is locked")]
+
+        def writer(records):
+            if failures:
+                raise failures.pop()
+            return [
+                {"vin": r[0], "logged": True, "error": False, "message": ""}
+                for r in records
+            ]
+
+        service = AsyncIngestService(queue_size=2, batch_size=2, writer=writer)
+        for speed in range(6):
+            if speed == 2:
+                service.start_writer()
+            await asyncio.wait_for(
+                service.submit(("ABC12345", speed, 1, 2, None)), timeout=1
+            )
+        report = await asyncio.wait_for(service.stop(), timeout=1)
+        self.assertEqual(report["write_failures"], 1)
+        self.assertEqual((report["logged"], report["rejected"]), (4, 2))
+        self.assertEqual(report["rejections"], {"Write failed: database is locked": 2})
+        # A writer task that died does not hang stop()
+        service = AsyncIngestService(queue_size=2)
+        service.start_writer()
+        service._writer_task.cancel()
+        await asyncio.sleep(0)
+        await service.submit(("ABC12345", 10, 1, 2, None))
+        report = await asyncio.wait_for(service.stop(), timeout=1)
+        self.assertEqual(report["rejections"], {"Ingest writer stopped": 1})
+
+    async def test_stop_waits_for_write(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def writer(records):
+            started.set()
+            release.wait(1)
+            return [
+                {"vin": r[0], "logged": True, "error": False, "message": ""}
+                for r in records
+            ]
+
+        executor = ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        service = AsyncIngestService(writer=writer, executor=executor)
+        service.start_writer()
+        await service.submit(("ABC12345", 10, 1, 2, None))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 1)
+        # Cancelled while the executor commits the batch
+        service._writer_task.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        report = await asyncio.wait_for(service.stop(), timeout=1)
+        self.assertEqual((report["logged"], report["rejected"]), (1, 0))
+        self.assertEqual(len(service.stats.latencies), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
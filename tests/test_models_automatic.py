@@ -1,7 +1,10 @@
+import os
+import tempfile
 import unittest
+import datetime
 from functools import wraps, partial
 from playhouse.sqlite_ext import SqliteExtDatabase
-from peewee import SqliteDatabase, OperationalError
+from peewee import SqliteDatabase
 from models.automatic import (
     GearChangeConfig,
     TransmissionLog,
@@ -13,32 +16,44 @@ from models.automatic import (
     get_vehicle_type,
     get_vehicle,
     add_vehicle,
+    add_vehicles_many,
     get_gear_config_by_vtid_gearto,
     get_vehicle_type_ref,
     is_error,
     shift_log_add,
+    shift_log_add_many,
     average_speed_to_fourth_gear,
     error_frequency_previous_last_week,
+    lookup_cache,
+    MIGRATIONS,
+    migrate,
+    schema_version,
+    explain_queries,
+    rebuild_shift_speed_aggregates,
+    shift_speed_stats,
+    MODELS,
+    PROFILES,
+    make_database,
+    use_database,
+    get_database,
+    VehicleErrorRollup,
+    ShiftSpeedAggregate,
+    rebuild_vehicle_error_rollups,
+    set_shift_rules,
+    VehicleRecord,
+    VehicleTypeRecord,
+    GearChangeRecord,
 )
-
-MODELS = [GearChangeConfig, TransmissionLog, Vehicle, VehicleType]
-
-test_db = SqliteDatabase(":memory:")
+from models.rules import ALL_RULES, DEFAULT_RULES, EARLY_SHIFT, SKIPPED_GEAR
+from tests.helpers import open_test_database, close_test_database
 
 
 class TestAutomatic(unittest.TestCase):
     def setUp(self):
-        self.db = test_db
-        self.db.bind(MODELS, bind_refs=False, bind_backrefs=False)
-        try:
-            self.db.connect()
-        except OperationalError:
-            pass
-        self.db.create_tables(MODELS)
+        self.db = open_test_database()
 
     def tearDown(self):
-        self.db.drop_tables(MODELS)
-        self.db.close()
+        close_test_database(self.db)
 
     def test_preload_config(self):
         # Initialize Configs for testing
@@ -72,6 +87,216 @@ class TestAutomatic(unittest.TestCase):
         results = check_existance()
         self.assertEqual(type(results), SqliteDatabase)
 
+    def test_migrate(self):
+        # Simulate a database created before the indexes existed
+        for index in self.db.get_indexes("transmissionlog"):
+            self.db.execute_sql(f"DROP INDEX {index.name}")
+        self.assertEqual(schema_version(), 0)
+        self.assertEqual(migrate(), len(MIGRATIONS))
+        self.assertEqual(schema_version(), len(MIGRATIONS))
+        self.assertEqual(len(self.db.get_indexes("transmissionlog")), 3)
+        # Already up to date, nothing to apply
+        self.assertEqual(migrate(), len(MIGRATIONS))
+
+    def test_migrate_compact_error_codes(self):
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        # Recreate the log as it was before error codes
+        self.db.drop_tables([TransmissionLog])
+        self.db.execute_sql(
+            "CREATE TABLE transmissionlog (pk INTEGER PRIMARY KEY, "
+            "vehicle_ref INTEGER, gear_speed INTEGER, gear_from INTEGER, "
+            "gear_to INTEGER, error INTEGER, error_message VARCHAR(255), "
+            "date_timestamp DATETIME)"
+        )
+        self.db.execute_sql(
+            "INSERT INTO transmissionlog VALUES "
+            "(1, 1, 42, 3, 4, 1, 'Gear shift exceeded at 42, expected 40, "
+            "shifting from 3 to 4', '2024-01-02 03:04:05'), "
+            "(2, 1, 38, 3, 4, 0, 'No Error Detected', '2024-01-02 03:04:05')"
+        )
+        self.db.pragma("user_version", 3)
+        migrate()
+        columns = [c.name for c in self.db.get_columns("transmissionlog")]
+        self.assertNotIn("error_message", columns)
+        logs = list(TransmissionLog.select().order_by(TransmissionLog.pk))
+        self.assertEqual([log.error_code for log in logs], [1, 0])
+        self.assertEqual([log.expected_speed for log in logs], [40, 40])
+        self.assertEqual(
+            logs[0].error_message,
+            "Gear shift exceeded at 42, expected 40, shifting from 3 to 4",
+        )
+        self.assertEqual(logs[1].error_message, "No Error Detected")
+
+    def test_migrate_unique_vehicle_vin(self):
+        preload_config()
+        # Recreate the vehicle table as it was before the unique index
+        self.db.drop_tables([Vehicle])
+        self.db.execute_sql(
+            "CREATE TABLE vehicle (pk INTEGER PRIMARY KEY, vin VARCHAR(255), "
+            "type_make VARCHAR(255), type_year INTEGER, type_ref INTEGER)"
+        )
+        self.db.execute_sql(
+            "INSERT INTO vehicle VALUES (1, 'ABC12345', 'Toyota', 2010, 2), "
+            "(2, 'VAN12345', 'Ford', 2015, 4), (3, 'ABC12345', 'Toyota', 2011, 2)"
+        )
+        old = datetime.datetime.now() - datetime.timedelta(days=45)
+        # Logs and rollups written against both registrations
+        for vehicle_ref in (1, 3):
+            TransmissionLog.insert(
+                vehicle_ref=vehicle_ref,
+                gear_speed=30,
+                gear_from=1,
+                gear_to=2,
+                error=True,
+                error_code=1,
+                expected_speed=15,
+                date_timestamp=old,
+            ).execute()
+            VehicleErrorRollup.insert(
+                vehicle_ref=vehicle_ref, day=old.date(), error_count=1
+            ).execute()
+        self.db.pragma("user_version", 5)
+        migrate()
+        self.assertEqual(
+            list(Vehicle.select(Vehicle.pk, Vehicle.vin).tuples()),
+            [(1, "ABC12345"), (2, "VAN12345")],
+        )
+        self.assertEqual({log.vehicle_ref for log in TransmissionLog.select()}, {1})
+        rollups = list(VehicleErrorRollup.select().tuples())
+        self.assertEqual([row[1:] for row in rollups], [(1, old.date(), 2)])
+        with self.assertRaises(ValueError):
+            add_vehicle("ABC12345", "Toyota", 2010, "Car")
+
+    def test_migrate_baseline_database(self):
+        # A database file written by the first release, at user_version 0
+        path = os.path.join(tempfile.mkdtemp(), "automatic.db")
+        baseline = SqliteDatabase(path)
+        for statement in (
+            "CREATE TABLE vehicle (pk INTEGER NOT NULL PRIMARY KEY, "
+            "vin VARCHAR(255) NOT NULL, type_make VARCHAR(255) NOT NULL, "
+            "type_year INTEGER NOT NULL, type_ref INTEGER NOT NULL)",
+            "CREATE TABLE vehicletype (pk INTEGER NOT NULL PRIMARY KEY, "
+            "type_name VARCHAR(255) NOT NULL, fuel_type VARCHAR(255) NOT NULL)",
+            "CREATE TABLE gearchangeconfig (pk INTEGER NOT NULL PRIMARY KEY, "
+            "vehicle_type_ref INTEGER NOT NULL, speed INTEGER NOT NULL, "
+            "gear_from INTEGER NOT NULL, gear_to INTEGER NOT NULL)",
+            "CREATE TABLE transmissionlog (pk INTEGER NOT NULL PRIMARY KEY, "
+            "vehicle_ref INTEGER NOT NULL, gear_speed INTEGER NOT NULL, "
+            "gear_from INTEGER NOT NULL, gear_to INTEGER NOT NULL, "
+            "error INTEGER NOT NULL, error_message VARCHAR(255) NOT NULL, "
+            "date_timestamp DATETIME NOT NULL)",
+            "INSERT INTO vehicletype VALUES (2, 'Car', 'Gasoline')",
+            "INSERT INTO gearchangeconfig VALUES (1, 2, 15, 1, 2), (2, 2, 40, 3, 4)",
+            "INSERT INTO vehicle VALUES (1, 'ABC123', 'Honda', 2020, 2)",
+            "INSERT INTO transmissionlog VALUES "
+            "(1, 1, 45, 3, 4, 1, 'Gear shift exceeded at 45, expected 40, "
+            "shifting from 3 to 4', '2024-01-02 03:04:05'), "
+            "(2, 1, 15, 1, 2, 0, 'No Error Detected', '2024-01-02 03:04:06')",
+        ):
+            baseline.execute_sql(statement)
+        baseline.close()
+        database = use_database(path)
+        try:
+            self.assertEqual(schema_version(), 0)
+            check_existance()
+            self.assertEqual(schema_version(), len(MIGRATIONS))
+            self.assertEqual(average_speed_to_fourth_gear(), 45)
+            self.assertEqual([row["count"] for row in shift_speed_stats(3, 4)], [1])
+            logs = list(TransmissionLog.select().order_by(TransmissionLog.pk))
+            self.assertEqual([log.error_code for log in logs], [1, 0])
+            self.assertEqual(VehicleErrorRollup.select().count(), 1)
+        finally:
+            database.close()
+            self.db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+
+    def test_add_vehicles_many(self):
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        get_vehicle("ABC12345")
+        vehicles = [(f"TRK{i:05d}", "Volvo", 2020, "truck") for i in range(250)]
+        vehicles += [
+            ("ABC12345", "Toyota", 2012, "Suv"),
+            ("VAN12345", "Ford", 2015, "Saturn"),
+            ("VAN12345", "Ford", "2015", "Van"),
+            ("TRK00000", "Scania", 2021, "Truck"),
+        ]
+        result = add_vehicles_many(vehicles, batch_size=100, chunk_size=30)
+        self.assertEqual(result["added"], 250)
+        self.assertEqual(result["updated"], 2)
+        self.assertEqual(
+            result["rejections"],
+            {"Invalid vehicle type": 1, "Invalid vehicle data": 1},
+        )
+        self.assertEqual(Vehicle.select().count(), 251)
+        # Upserted in place and the cached record is dropped
+        vehicle = get_vehicle("ABC12345")
+        self.assertEqual(
+            (vehicle.pk, vehicle.type_year, vehicle.type_ref), (1, 2012, 3)
+        )
+        self.assertEqual(lookup_cache.vehicle("ABC12345").type_ref, 3)
+        self.assertEqual(get_vehicle("TRK00000").type_make, "Scania")
+
+    def test_add_vehicles_many_keeps_logged_types(self):
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        shift_log_add("ABC12345", 40, 3, 4)
+        aggregates = list(ShiftSpeedAggregate.select().tuples())
+        result = add_vehicles_many(
+            [("ABC12345", "Toyota", 2011, "Truck"), ("VAN12345", "Ford", 2016, "Car")]
+        )
+        self.assertEqual((result["added"], result["updated"]), (0, 1))
+        self.assertEqual(
+            result["rejections"],
+            {"Vehicle type cannot change once shifts are logged": 1},
+        )
+        vehicle = get_vehicle("ABC12345")
+        self.assertEqual((vehicle.type_year, vehicle.type_ref), (2010, 2))
+        self.assertEqual(get_vehicle("VAN12345").type_ref, 2)
+        self.assertEqual(list(ShiftSpeedAggregate.select().tuples()), aggregates)
+
+    def test_explain_queries(self):
+        plans = explain_queries()
+        self.assertIn("INDEX vehicle_vin", " ".join(plans["vehicle_lookup"]))
+        self.assertIn(
+            "transmissionlog_gear_to_gear_from_gear_speed",
+            " ".join(plans["average_speed_to_fourth_gear"]),
+        )
+        self.assertIn(
+            "vehicleerrorrollup",
+            " ".join(plans["error_frequency_previous_last_week"]),
+        )
+        self.assertNotIn(
+            "transmissionlog", " ".join(plans["error_frequency_previous_last_week"])
+        )
+
+    def test_make_database_profiles(self):
+        path = os.path.join(tempfile.mkdtemp(), "automatic.db")
+        for profile in PROFILES:
+            database = make_database(path, profile)
+            database.connect()
+            expected = PROFILES[profile]["journal_mode"]
+            self.assertEqual(database.pragma("journal_mode"), expected)
+            self.assertEqual(
+                database.pragma("busy_timeout"), PROFILES[profile]["busy_timeout"]
+            )
+            database.close()
+        self.assertRaises(ValueError, make_database, path, "fastest")
+
+    def test_use_database(self):
+        path = os.path.join(tempfile.mkdtemp(), "automatic.db")
+        database = use_database(path, "bulk-load")
+        try:
+            self.assertIs(get_database(), database)
+            check_existance()
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(database.pragma("synchronous"), 0)
+            self.assertEqual(GearChangeConfig.select().count(), 20)
+        finally:
+            database.close()
+            self.db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+
     def test_get_vehicle_type(self):
         # Initialize Configs for testing
         preload_config()
@@ -97,6 +322,21 @@ class TestAutomatic(unittest.TestCase):
         # Test negative case
         self.assertRaises(ValueError, get_vehicle, "Something Wrong")
 
+    def test_lookup_records(self):
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        # Every call returns the same module-level record type
+        self.assertIs(type(get_vehicle("ABC12345")), VehicleRecord)
+        self.assertIs(type(get_vehicle("VAN12345")), VehicleRecord)
+        self.assertEqual(get_vehicle_type("van"), VehicleTypeRecord(4, "Van", "Diesel"))
+        self.assertIsInstance(get_vehicle_type_ref(2), VehicleTypeRecord)
+        config = get_gear_config_by_vtid_gearto(4, 3)
+        self.assertIsInstance(config, GearChangeRecord)
+        self.assertEqual((config.speed, config.gear_from), (19, 2))
+        self.assertIsNone(get_gear_config_by_vtid_gearto(4, 9))
+        self.assertFalse(get_vehicle_type("Saturn"))
+
     def test_get_gear_config_by_vtid_gearto(self):
         # Add Configs
         preload_config()
@@ -169,6 +409,107 @@ class TestAutomatic(unittest.TestCase):
         with self.assertRaises(ValueError):
             shift_log_add(vin, gear_speed, gear_from, gear_to)
 
+    def test_shift_log_add_cached_lookups(self):
+        # Add Configs
+        preload_config()
+        vin, make, year, vtype = "ABC12345", "Toyota", 2010, "Car"
+        add_vehicle(vin, make, year, vtype)
+        shift_log_add(vin, 20, 1, 2)
+        # Known vehicle: the hot path only writes, no reads
+        statements = []
+        execute_sql = self.db.execute_sql
+
+        def record(sql, *args, **kwargs):
+            statements.append(sql)
+            return execute_sql(sql, *args, **kwargs)
+
+        self.db.execute_sql = record
+        try:
+            shift_log_add(vin, 30, 2, 3)
+        finally:
+            del self.db.execute_sql
+        self.assertTrue(any(sql.startswith("INSERT") for sql in statements))
+        self.assertFalse([sql for sql in statements if sql.startswith("SELECT")])
+        self.assertGreater(lookup_cache.stats()["hits"], 0)
+
+    def test_shift_log_add_many(self):
+        # Add Configs
+        preload_config()
+        # Setup Vehicles
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        timestamp = datetime.datetime(2024, 1, 2, 3, 4, 5)
+        records = [
+            ("ABC12345", 20, 1, 2, timestamp),
+            ("VAN12345", 20, 1, 2, None),
+            ("MISSING", 20, 1, 2, None),
+            ("ABC12345", 20, 1, 9, None),
+            ("ABC12345", "20", 1, 2, None),
+        ]
+        results = shift_log_add_many(records, chunk_size=1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(
+            [r["logged"] for r in results], [True, True, False, False, False]
+        )
+        self.assertEqual(results[0]["error"], True)  # Car shifts 1->2 at 15
+        self.assertEqual(results[1]["error"], True)  # Van shifts 1->2 at 12
+        self.assertEqual(results[2]["message"], "Vehicle does not exist")
+        self.assertEqual(results[3]["message"], "Gear config does not exist")
+        self.assertEqual(
+            results[4]["message"], "Gear speed and actual speed must be integers"
+        )
+        self.assertEqual(TransmissionLog.select().count(), 2)
+        first = TransmissionLog.select().order_by(TransmissionLog.pk).first()
+        self.assertEqual(first.date_timestamp, timestamp)
+        # Empty batch is a no-op
+        self.assertEqual(shift_log_add_many([]), [])
+
+    def test_shift_log_add_many_rules(self):
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        records = [("ABC12345", 20, 3, 4, None), ("ABC12345", 20, 1, 3, None)]
+        results = shift_log_add_many(records)
+        self.assertEqual([r["error"] for r in results], [False, False])
+        set_shift_rules(ALL_RULES)
+        try:
+            results = shift_log_add_many(records)
+        finally:
+            set_shift_rules(DEFAULT_RULES)
+        self.assertEqual([r["code"] for r in results], [EARLY_SHIFT, SKIPPED_GEAR])
+        self.assertEqual(
+            results[0]["message"],
+            "Gear shift speed not met at 20, expected 40, shifting from 3 to 4",
+        )
+        log = TransmissionLog.select().order_by(TransmissionLog.pk.desc()).first()
+        self.assertEqual(log.error_code, SKIPPED_GEAR)
+        self.assertEqual(log.error_message, "Gear skipped at 20, shifting from 1 to 3")
+
+    def test_shift_speed_stats(self):
+        # Add Configs
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("ABC123456", "Honda", 2012, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        shift_log_add("ABC12345", 38, 3, 4)
+        shift_log_add_many(
+            [
+                ("ABC123456", 42, 3, 4, None),
+                ("VAN12345", 30, 3, 4, None),
+                ("VAN12345", 18, 1, 2, None),
+            ]
+        )
+        stats = shift_speed_stats(3, 4)
+        self.assertEqual([s["type_name"] for s in stats], ["Car", "Van"])
+        car = stats[0]
+        self.assertEqual(car["count"], 2)
+        self.assertEqual(car["average"], 40.0)
+        self.assertEqual(car["variance"], 4.0)
+        self.assertEqual((car["min"], car["max"]), (38, 42))
+        self.assertEqual(shift_speed_stats(1, 2)[0]["type_name"], "Van")
+        # Rebuilding from the raw log gives the same totals
+        self.assertEqual(rebuild_shift_speed_aggregates(), 3)
+        self.assertEqual(shift_speed_stats(3, 4), stats)
+
     def test_add_vehicle(self):
         # Add Configs
         preload_config()
@@ -219,6 +560,48 @@ class TestAutomatic(unittest.TestCase):
         result = error_frequency_previous_last_week()
         print(result)
 
+    def test_error_frequency_windows(self):
+        # Add Configs
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("ABC123456", "Ford", 2010, "Truck")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=45)
+        recent = now - datetime.timedelta(days=2)
+        shift_log_add_many(
+            [
+                # Errors both before last month and in the last 7 days
+                ("ABC12345", 30, 1, 2, old),
+                ("ABC12345", 31, 1, 2, old),
+                ("ABC12345", 30, 1, 2, recent),
+                # Only old errors
+                ("ABC123456", 30, 1, 2, old),
+                # Old errors, recent shift without an error
+                ("VAN12345", 30, 1, 2, old),
+                ("VAN12345", 10, 1, 2, recent),
+            ]
+        )
+        self.assertEqual(VehicleErrorRollup.select().count(), 4)
+        self.assertEqual(
+            error_frequency_previous_last_week(),
+            [{"vin": "ABC12345", "errors_before": 2, "errors_since": 1}],
+        )
+        # Arbitrary window boundaries
+        result = error_frequency_previous_last_week(
+            before=now.date() + datetime.timedelta(days=1),
+            since=now.date() - datetime.timedelta(days=60),
+        )
+        self.assertEqual(
+            [r["vin"] for r in result], ["ABC12345", "ABC123456", "VAN12345"]
+        )
+        # Rebuilding from the raw log gives the same rollups
+        self.assertEqual(rebuild_vehicle_error_rollups(), 4)
+        self.assertEqual(
+            error_frequency_previous_last_week(),
+            [{"vin": "ABC12345", "errors_before": 2, "errors_since": 1}],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
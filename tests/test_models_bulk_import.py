@@ -0,0 +1,156 @@
+import os
+import json
+import tempfile
+import unittest
+from models.automatic import (
+    TransmissionLog,
+    ShiftSpeedAggregate,
+    Vehicle,
+    ImportChunk,
+    make_database,
+    preload_config,
+    add_vehicle,
+    add_vehicles_many,
+)
+from models.bulk_import import (
+    split_chunks,
+    parse_chunk,
+    import_file,
+    read_vehicles,
+)
+from tests.helpers import open_test_database
+
+CSV_ROWS = [
+    "vin,speed,gear_from,gear_to,timestamp",
+    "ABC12345,12,1,2,2024-01-10T08:00:00",
+    "ABC12345,42,3,4,2024-01-10T08:01:00",
+    "VAN12345,10,1,2,",
+    "MISSING,20,1,2,2024-01-10T08:02:00",
+    "ABC12345,fast,1,2,2024-01-10T08:03:00",
+    "VAN12345,20,3,4,2024-01-11T09:00:00",
+]
+
+
+class TestBulkImport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # A file, so the worker processes can read the vehicles
+        self.db = open_test_database(
+            make_database(os.path.join(self.directory, "automatic.db"))
+        )
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+
+    def tearDown(self):
+        self.db.close()
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as handle:
+            handle.write("\n".join(lines) + "\n")
+        return path
+
+    def test_split_chunks(self):
+        path = self.write("shifts.csv", CSV_ROWS)
+        chunks = split_chunks(path, 40, skip_header=True)
+        self.assertEqual(chunks[0][0], len(CSV_ROWS[0]) + 1)
+        self.assertEqual(chunks[-1][1], os.path.getsize(path))
+        header = CSV_ROWS[0].split(",")
+        records = []
+        for start, end in chunks:
+            records += parse_chunk(path, start, end, "csv", header)[0]
+        self.assertEqual(len(records), 5)
+        with self.assertRaises(ValueError):
+            split_chunks(path, 0)
+
+    def test_import_csv(self):
+        path = self.write("shifts.csv", CSV_ROWS)
+        updates = []
+        result = import_file(path, workers=0, chunk_bytes=40, progress=updates.append)
+        self.assertEqual(result["logged"], 4)
+        self.assertEqual(result["rejected"], 2)
+        self.assertEqual(TransmissionLog.select().count(), 4)
+        self.assertEqual(
+            TransmissionLog.select().where(TransmissionLog.error == True).count(), 1
+        )
+        self.assertEqual(ShiftSpeedAggregate.select().count(), 4)
+        self.assertEqual(updates[-1]["bytes_done"], updates[-1]["bytes_total"])
+
+    def test_import_ndjson_workers(self):
+        lines = [
+            json.dumps(
+                {"vin": "ABC12345", "speed": 20 + i % 5, "gear_from": 1, "gear_to": 2}
+            )
+            for i in range(50)
+        ]
+        path = self.write("shifts.ndjson", lines + ["not json"])
+        result = import_file(path, workers=2, chunk_bytes=200)
+        self.assertEqual((result["logged"], result["rejected"]), (50, 1))
+        self.assertEqual(TransmissionLog.select().count(), 50)
+
+    def test_resume_from_checkpoint(self):
+        path = self.write("shifts.csv", CSV_ROWS)
+        checkpoint = path + ".checkpoint"
+
+        def interrupt(state):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            import_file(path, 0, 40, checkpoint, progress=interrupt)
+        first = TransmissionLog.select().count()
+        # The range was committed together with its rows
+        self.assertEqual(ImportChunk.select().count(), 1)
+        self.assertEqual(ImportChunk.get().logged, first)
+        result = import_file(path, 0, 40, checkpoint)
+        self.assertEqual(result["imported_chunks"], result["chunks"] - 1)
+        self.assertEqual(result["logged"], 4)
+        self.assertEqual(TransmissionLog.select().count(), 4)
+        self.assertGreater(first, 0)
+        # Without the checkpoint file the import starts over
+        os.unlink(checkpoint)
+        result = import_file(path, 0, 40, checkpoint)
+        self.assertEqual(result["imported_chunks"], result["chunks"])
+        self.assertEqual(ImportChunk.select().count(), result["chunks"])
+        self.assertEqual(TransmissionLog.select().count(), 8)
+        # A checkpoint from another file is refused
+        other = self.write("other.csv", CSV_ROWS[:3])
+        with self.assertRaises(ValueError):
+            import_file(other, 0, 40, checkpoint)
+
+    def test_onboard_vehicles(self):
+        csv_path = self.write(
+            "fleet.csv",
+            [
+                "vin,make,year,type",
+                "TRK00001,Volvo,2019,truck",
+                "ABC12345,Toyota,2011,Car",
+                "TRK00002,Volvo,old,truck",
+            ],
+        )
+        self.assertEqual(
+            list(read_vehicles(csv_path))[:2],
+            [
+                ("TRK00001", "Volvo", 2019, "truck"),
+                ("ABC12345", "Toyota", 2011, "Car"),
+            ],
+        )
+        result = add_vehicles_many(read_vehicles(csv_path))
+        self.assertEqual((result["added"], result["updated"]), (1, 1))
+        self.assertEqual(result["rejections"], {"Invalid vehicle data": 1})
+        ndjson_path = self.write(
+            "fleet.ndjson",
+            [
+                json.dumps(
+                    {"vin": "SUV00001", "make": "Kia", "year": 2022, "type": "suv"}
+                ),
+                "not json",
+            ],
+        )
+        result = add_vehicles_many(read_vehicles(ndjson_path))
+        self.assertEqual((result["added"], result["rejected"]), (1, 1))
+        self.assertEqual(Vehicle.select().count(), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
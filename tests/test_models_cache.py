@@ -0,0 +1,73 @@
+import unittest
+from models.cache import LookupCache
+
+
+class TestLookupCache(unittest.TestCase):
+    def setUp(self):
+        self.calls = {"configs": 0, "types": 0, "vehicles": []}
+        self.fleet = {"ABC12345": ("ABC12345", 2), "VAN12345": ("VAN12345", 4)}
+
+        def load_configs():
+            self.calls["configs"] += 1
+            return {(2, 2): "car-1-2", (4, 2): "van-1-2"}
+
+        def load_vehicle_types():
+            self.calls["types"] += 1
+            return {2: "Car", 4: "Van"}
+
+        def load_vehicles(vins):
+            self.calls["vehicles"].append(list(vins))
+            return {vin: self.fleet[vin] for vin in vins if vin in self.fleet}
+
+        self.cache = LookupCache(
+            load_configs, load_vehicle_types, load_vehicles, max_vehicles=1
+        )
+
+    def test_configs_loaded_once(self):
+        self.assertEqual(self.cache.gear_config(2, 2), "car-1-2")
+        self.assertEqual(self.cache.gear_config(4, 2), "van-1-2")
+        self.assertIsNone(self.cache.gear_config(4, 9))
+        self.assertEqual(self.cache.vehicle_type(4), "Van")
+        self.assertEqual(self.calls["configs"], 1)
+        self.assertEqual(self.calls["types"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+        self.assertEqual(self.cache.stats()["hits"], 3)
+        # Invalidation forces a reload
+        self.cache.invalidate_configs()
+        self.cache.gear_config(2, 2)
+        self.assertEqual(self.calls["configs"], 2)
+
+    def test_vehicle_lru(self):
+        self.assertEqual(self.cache.vehicle("ABC12345"), ("ABC12345", 2))
+        self.assertEqual(self.cache.vehicle("ABC12345"), ("ABC12345", 2))
+        self.assertEqual(self.calls["vehicles"], [["ABC12345"]])
+        # Bounded to one entry, so loading another VIN evicts the first
+        self.cache.vehicle("VAN12345")
+        self.cache.vehicle("ABC12345")
+        self.assertEqual(
+            self.calls["vehicles"], [["ABC12345"], ["VAN12345"], ["ABC12345"]]
+        )
+        self.assertEqual(self.cache.stats()["vehicles"], 1)
+
+    def test_vehicle_missing_not_cached(self):
+        self.assertRaises(ValueError, self.cache.vehicle, "NEW12345")
+        self.fleet["NEW12345"] = ("NEW12345", 2)
+        self.assertEqual(self.cache.vehicle("NEW12345"), ("NEW12345", 2))
+
+    def test_vehicles_bulk(self):
+        found = self.cache.vehicles(["ABC12345", "MISSING", "ABC12345"])
+        self.assertEqual(found, {"ABC12345": ("ABC12345", 2)})
+        self.assertEqual(self.calls["vehicles"], [["ABC12345", "MISSING"]])
+
+    def test_invalidate_vehicle(self):
+        self.cache.vehicle("ABC12345")
+        self.fleet["ABC12345"] = ("ABC12345", 4)
+        self.cache.invalidate_vehicle("ABC12345")
+        self.assertEqual(self.cache.vehicle("ABC12345"), ("ABC12345", 4))
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()["hits"], 0)
+        self.assertEqual(self.cache.stats()["vehicles"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import json
+import tempfile
+import unittest
+import datetime
+from models.automatic import (
+    preload_config,
+    add_vehicle,
+    shift_log_add_many,
+    average_speed_to_fourth_gear,
+    error_frequency_previous_last_week,
+)
+from models.columnar import COLUMNS, export_columnar, ColumnarLog
+from tests.helpers import open_test_database, close_test_database
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("ABC123456", "Ford", 2010, "Truck")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=45)
+        recent = now - datetime.timedelta(days=2)
+        shift_log_add_many(
+            [
+                ("ABC12345", 30, 1, 2, old),
+                ("ABC12345", 30, 1, 2, recent),
+                ("ABC12345", 42, 3, 4, recent),
+                ("ABC123456", 30, 1, 2, old),
+                ("ABC123456", 38, 3, 4, recent),
+                ("VAN12345", 30, 1, 2, recent),
+                ("VAN12345", 20, 3, 4, old),
+            ]
+        )
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        close_test_database()
+
+    def test_export_layout(self):
+        self.assertEqual(export_columnar(self.directory), 7)
+        with open(os.path.join(self.directory, "meta.json")) as handle:
+            meta = json.load(handle)
+        self.assertEqual(meta["rows"], 7)
+        self.assertEqual(meta["vehicles"]["3"], "VAN12345")
+        for name, _, dtype in COLUMNS:
+            size = os.path.getsize(os.path.join(self.directory, f"{name}.bin"))
+            self.assertEqual(size, 7 * int(dtype[-1]))
+
+    def test_reader_matches_queries(self):
+        export_columnar(self.directory)
+        expected_average = average_speed_to_fourth_gear()
+        expected_recurrence = error_frequency_previous_last_week()
+        for use_numpy in (False, True):
+            with ColumnarLog(self.directory, use_numpy=use_numpy) as log:
+                self.assertEqual(len(log), 7)
+                timestamps = list(log.columns["timestamp"])
+                self.assertEqual(timestamps, sorted(timestamps))
+                self.assertAlmostEqual(log.average_speed(4), expected_average)
+                self.assertEqual(log.error_recurrence(), expected_recurrence)
+        self.assertEqual([row["vin"] for row in expected_recurrence], ["ABC12345"])
+
+    def test_date_range(self):
+        since = datetime.date.today() - datetime.timedelta(days=7)
+        self.assertEqual(export_columnar(self.directory, start=since), 4)
+        with ColumnarLog(self.directory, use_numpy=False) as log:
+            self.assertEqual(log.average_speed(4), 40.0)
+            self.assertEqual(log.row_range(), (0, 4))
+            self.assertEqual(log.error_recurrence(), [])
+
+    def test_empty_export(self):
+        start = datetime.date.today() + datetime.timedelta(days=1)
+        self.assertEqual(export_columnar(self.directory, start=start), 0)
+        with ColumnarLog(self.directory) as log:
+            self.assertEqual(len(log), 0)
+            self.assertIsNone(log.average_speed(4))
+
+
+if __name__ == "__main__":
+    unittest.main()
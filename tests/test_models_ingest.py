@@ -0,0 +1,173 @@
+import os
+import json
+import socket
+import tempfile
+import threading
+import unittest
+from peewee import OperationalError
+from models.automatic import TransmissionLog, preload_config, add_vehicle
+from models.ingest import (
+    IngestServer,
+    ShiftEventBuffer,
+    parse_event,
+    percentile,
+)
+from tests.helpers import FakeClock, open_test_database, close_test_database
+
+
+class TestShiftEventBuffer(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.clock = FakeClock()
+
+        def writer(records):
+            self.batches.append(records)
+            return [
+                {"vin": r[0], "logged": r[0] != "BAD", "error": False, "message": "x"}
+                for r in records
+            ]
+
+        self.buffer = ShiftEventBuffer(
+            flush_size=3, flush_interval=1.0, writer=writer, clock=self.clock
+        )
+
+    def test_parse_event(self):
+        record = parse_event(
+            '{"vin": "1G1ZZ8F", "speed": 15, "gear_to": 2, "gear_from": 1}'
+        )
+        self.assertEqual(record, ("1G1ZZ8F", 15, 1, 2, None))
+        record = parse_event(
+            '{"vin": "A", "speed": 1, "gear_to": 2, "gear_from": 1, '
+            '"timestamp": "2024-01-02T03:04:05"}'
+        )
+        self.assertEqual(record[4].day, 2)
+        self.assertRaises(ValueError, parse_event, "not json")
+        self.assertRaises(ValueError, parse_event, '{"vin": "A"}')
+
+    def test_flush_on_size(self):
+        for _ in range(3):
+            self.buffer.add(("ABC", 20, 1, 2, None))
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_flush_on_time(self):
+        self.buffer.add(("ABC", 20, 1, 2, None))
+        self.buffer.flush_if_due()
+        self.assertEqual(self.batches, [])
+        self.clock.now = 0.4
+        self.assertAlmostEqual(self.buffer.time_until_flush(), 0.6)
+        self.clock.now = 1.5
+        self.buffer.flush_if_due()
+        self.assertEqual(len(self.batches), 1)
+        report = self.buffer.stats.report()
+        self.assertEqual(report["logged"], 1)
+        self.assertEqual(report["latency_ms"]["max"], 1500.0)
+
+    def test_rejections_counted(self):
+        self.buffer.add_line(b"garbage")
+        self.buffer.add_line(b"")
+        self.buffer.add(("BAD", 20, 1, 2, None))
+        self.buffer.flush()
+        report = self.buffer.stats.report()
+        self.assertEqual(report["received"], 2)
+        self.assertEqual(report["rejected"], 2)
+        self.assertEqual(report["rejections"]["x"], 1)
+
+    def test_writer_failure(self):
+        writer = self.buffer.writer
+
+        def failing(records):
+            raise OperationalError("database is locked")
+
+        self.buffer.writer = failing
+        for speed in (10, 20):
+            self.buffer.add(("ABC12345", speed, 1, 2, None))
+        self.assertEqual(self.buffer.flush(), [])
+        self.buffer.writer = writer
+        self.buffer.add(("ABC12345", 30, 1, 2, None))
+        self.buffer.flush()
+        report = self.buffer.stats.report()
+        self.assertEqual(report["write_failures"], 1)
+        self.assertEqual((report["logged"], report["rejected"]), (1, 2))
+        self.assertEqual(report["rejections"], {"Write failed: database is locked": 2})
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 50), 0.0)
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile(list(range(101)), 99), 99)
+
+
+class TestIngestServer(unittest.TestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+
+    def tearDown(self):
+        close_test_database()
+
+    def event(self, speed):
+        return json.dumps(
+            {"vin": "ABC12345", "speed": speed, "gear_to": 2, "gear_from": 1}
+        ).encode()
+
+    def test_serve_stream(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, self.event(10) + b"\n" + self.event(20) + b"\n")
+        # Trailing line without a newline is still ingested at EOF
+        os.write(write_fd, b'{"vin": "NOPE", "speed": 1, "gear_to": 2, "gear_from": 1}')
+        os.close(write_fd)
+        with os.fdopen(read_fd, "rb") as stream:
+            server = IngestServer(ShiftEventBuffer(flush_size=100), stream=stream)
+            report = server.serve()
+        self.assertEqual(report["logged"], 2)
+        self.assertEqual(report["errors"], 1)
+        self.assertEqual(report["rejections"], {"Vehicle does not exist": 1})
+        self.assertEqual(TransmissionLog.select().count(), 2)
+
+    def test_serve_file(self):
+        # A stream redirected from a regular file, which epoll refuses
+        path = os.path.join(tempfile.mkdtemp(), "shifts.ndjson")
+        with open(path, "wb") as shifts:
+            for speed in range(10, 70, 5):
+                shifts.write(self.event(speed) + b"\n")
+            shifts.write(b"not json\n")
+        with open(path, "rb") as stream:
+            server = IngestServer(ShiftEventBuffer(flush_size=5), stream=stream)
+            report = server.serve()
+        self.assertEqual(report["logged"], 12)
+        self.assertEqual(report["flushes"], 3)
+        self.assertEqual(report["rejected"], 1)
+        self.assertEqual(TransmissionLog.select().count(), 12)
+
+    def test_serve_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), "ingest.sock")
+        buffer = ShiftEventBuffer(flush_size=100, flush_interval=0.05)
+        server = IngestServer(buffer, socket_path=path)
+        server.open()
+
+        def produce():
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(path)
+                client.sendall(self.event(10) + b"\n" + self.event(30) + b"\n")
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        producer.join()
+        # Stop once both events have been flushed
+        flush = buffer.flush
+
+        def flush_and_stop():
+            results = flush()
+            if buffer.stats.logged == 2:
+                server.stop()
+            return results
+
+        buffer.flush = flush_and_stop
+        report = server.serve()
+        self.assertEqual(report["logged"], 2)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import io
+import os
+import json
+import pstats
+import tempfile
+import unittest
+from models.automatic import (
+    preload_config,
+    add_vehicle,
+    shift_log_add,
+    shift_log_add_many,
+)
+from models.instrumentation import (
+    Instrumentation,
+    instrumentation,
+    install_query_hook,
+    remove_query_hook,
+    profiled,
+)
+from tests.helpers import test_db, FakeClock, open_test_database, close_test_database
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_lap_and_snapshot(self):
+        clock = FakeClock()
+        instr = Instrumentation(clock=clock)
+        started = clock()
+        clock.now = 0.002
+        started = instr.lap("vehicle_lookup", started)
+        clock.now = 0.005
+        instr.lap("is_error", started)
+        with instr.stage("write", count=10):
+            clock.now = 0.015
+        instr.incr("events", 3)
+        snapshot = instr.snapshot()
+        self.assertEqual(snapshot["stages"]["vehicle_lookup"]["mean_us"], 2000.0)
+        self.assertEqual(snapshot["stages"]["is_error"]["max_us"], 3000.0)
+        self.assertEqual(snapshot["stages"]["write"]["count"], 10)
+        self.assertEqual(snapshot["counters"], {"events": 3})
+        stream = io.StringIO()
+        instr.dump(stream)
+        self.assertEqual(json.loads(stream.getvalue())["counters"]["events"], 3)
+        instr.reset()
+        self.assertEqual(instr.snapshot()["stages"], {})
+
+    def test_disabled(self):
+        instr = Instrumentation(enabled=False)
+        instr.lap("vehicle_lookup", instr.clock())
+        instr.incr("events")
+        instr.record_query("SELECT 1", 0.1)
+        snapshot = instr.snapshot()
+        self.assertEqual(snapshot["stages"], {})
+        self.assertEqual(snapshot["counters"], {})
+        self.assertEqual(snapshot["queries"], {})
+
+    def test_profiled(self):
+        path = os.path.join(tempfile.mkdtemp(), "ingest.pstats")
+        with profiled(path):
+            sum(range(1000))
+        self.assertTrue(pstats.Stats(path).total_calls > 0)
+        stream = io.StringIO()
+        with profiled(stream=stream, limit=5):
+            sum(range(1000))
+        self.assertIn("function calls", stream.getvalue())
+
+
+class TestShiftInstrumentation(unittest.TestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        instrumentation.reset()
+
+    def tearDown(self):
+        remove_query_hook(test_db)
+        close_test_database()
+
+    def test_shift_stages(self):
+        install_query_hook(test_db)
+        shift_log_add("ABC12345", 20, 1, 2)
+        shift_log_add_many([("ABC12345", 20, 1, 2, None), ("MISSING", 20, 1, 2, None)])
+        snapshot = instrumentation.snapshot()
+        for stage in ("vehicle_lookup", "config_lookup", "is_error", "classify"):
+            self.assertIn(stage, snapshot["stages"])
+        self.assertEqual(snapshot["stages"]["write"]["count"], 2)
+        self.assertEqual(
+            snapshot["counters"], {"events": 3, "rejected": 1, "logged": 2}
+        )
+        self.assertGreater(snapshot["queries"]["INSERT"]["count"], 0)
+        remove_query_hook(test_db)
+        shift_log_add("ABC12345", 20, 1, 2)
+        self.assertEqual(
+            instrumentation.snapshot()["queries"]["INSERT"]["count"],
+            snapshot["queries"]["INSERT"]["count"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
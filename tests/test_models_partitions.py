@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+import datetime
+from peewee import SqliteDatabase
+from models.automatic import (
+    TransmissionLog,
+    LogPartition,
+    VehicleErrorRollup,
+    preload_config,
+    add_vehicle,
+    shift_log_add_many,
+    average_speed_to_fourth_gear,
+    rebuild_shift_speed_aggregates,
+    rebuild_vehicle_error_rollups,
+    shift_speed_stats,
+    log_models,
+    partition_model,
+)
+from models.partitions import (
+    months_back,
+    rotate_partitions,
+    select_log,
+    apply_retention,
+)
+from tests.helpers import open_test_database, close_test_database
+
+NOW = datetime.datetime(2024, 5, 15, 12, 0)
+
+
+class TestPartitions(unittest.TestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        shift_log_add_many(
+            [
+                ("ABC12345", 42, 3, 4, datetime.datetime(2024, 1, 10)),
+                ("ABC12345", 30, 1, 2, datetime.datetime(2024, 1, 20)),
+                ("VAN12345", 38, 3, 4, datetime.datetime(2024, 2, 3)),
+                ("ABC12345", 40, 3, 4, datetime.datetime(2024, 5, 2)),
+                ("ABC12345", 31, 1, 2, datetime.datetime(2024, 5, 9)),
+            ]
+        )
+
+    def tearDown(self):
+        live = LogPartition.select().where(LogPartition.dropped == False)
+        for partition in list(live):
+            partition_model(partition.month).drop_table(safe=True)
+        close_test_database()
+
+    def test_months_back(self):
+        self.assertEqual(months_back(1, NOW), datetime.date(2024, 5, 1))
+        self.assertEqual(months_back(6, NOW), datetime.date(2023, 12, 1))
+        with self.assertRaises(ValueError):
+            months_back(0, NOW)
+
+    def test_rotate_partitions(self):
+        average = average_speed_to_fourth_gear()
+        stats = shift_speed_stats(3, 4)
+        moved = rotate_partitions(keep_months=2, now=NOW)
+        self.assertEqual(
+            moved, {"transmissionlog_202401": 2, "transmissionlog_202402": 1}
+        )
+        self.assertEqual(TransmissionLog.select().count(), 2)
+        self.assertEqual(len(log_models()), 3)
+        # Only the hot table and January are needed for this range
+        january = log_models(datetime.date(2024, 1, 1), datetime.date(2024, 2, 1))
+        self.assertEqual(
+            [Log._meta.table_name for Log in january],
+            ["transmissionlog", "transmissionlog_202401"],
+        )
+        rows = list(
+            select_log(datetime.date(2024, 1, 15), NOW, ["gear_speed"]).tuples()
+        )
+        self.assertEqual(sorted(rows), [(30,), (31,), (38,), (40,)])
+        self.assertEqual(average_speed_to_fourth_gear(), average)
+        self.assertEqual(rebuild_shift_speed_aggregates(), 3)
+        self.assertEqual(shift_speed_stats(3, 4), stats)
+        # Nothing left to move
+        self.assertEqual(rotate_partitions(keep_months=2, now=NOW), {})
+
+    def test_apply_retention(self):
+        rotate_partitions(keep_months=1, now=NOW)
+        stats = shift_speed_stats(3, 4)
+        rollups = VehicleErrorRollup.select().count()
+        archive_dir = tempfile.mkdtemp()
+        retired = apply_retention(keep_months=4, archive_dir=archive_dir, now=NOW)
+        self.assertEqual(retired, ["transmissionlog_202401"])
+        partition = LogPartition.get(LogPartition.table_name == retired[0])
+        self.assertTrue(partition.dropped)
+        self.assertFalse(partition_model(partition.month).table_exists())
+        archive = SqliteDatabase(partition.archived_path)
+        self.assertEqual(
+            archive.execute_sql(f"SELECT COUNT(*) FROM {retired[0]}").fetchone()[0], 2
+        )
+        archive.close()
+        self.assertEqual(os.path.dirname(partition.archived_path), archive_dir)
+        # Totals of the dropped month survive rebuilding from the raw log
+        self.assertEqual(rebuild_shift_speed_aggregates(), 3)
+        self.assertEqual(shift_speed_stats(3, 4), stats)
+        self.assertEqual(rebuild_vehicle_error_rollups(), rollups)
+        self.assertEqual(apply_retention(keep_months=4, now=NOW), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
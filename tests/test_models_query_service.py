@@ -0,0 +1,139 @@
+import os
+import json
+import tempfile
+import unittest
+import datetime
+import threading
+import urllib.request
+from peewee import OperationalError
+from models.automatic import (
+    make_database,
+    preload_config,
+    add_vehicle,
+    shift_log_add,
+    shift_log_add_many,
+    average_speed_to_fourth_gear,
+    error_frequency_previous_last_week,
+)
+from models.query_service import QueryService, make_read_database, serve_http
+from tests.helpers import FakeClock, open_test_database
+
+
+class TestQueryService(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "automatic.db")
+        self.db = open_test_database(make_database(self.path))
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        now = datetime.datetime.now()
+        shift_log_add_many(
+            [
+                ("ABC12345", 42, 3, 4, now - datetime.timedelta(days=45)),
+                ("ABC12345", 30, 1, 2, now - datetime.timedelta(days=2)),
+                ("VAN12345", 20, 3, 4, now),
+            ]
+        )
+        self.clock = FakeClock()
+        self.service = QueryService(
+            self.path, ttl=10, max_entries=3, marker_interval=0, clock=self.clock
+        )
+
+    def tearDown(self):
+        self.service.close()
+        self.db.close()
+
+    def test_cached_results(self):
+        average = self.service.query("average_speed_to_fourth_gear")
+        self.assertEqual(average, average_speed_to_fourth_gear())
+        self.assertEqual(average, 31.0)
+        recurrence = self.service.query("error_frequency_previous_last_week")
+        self.assertEqual(recurrence, error_frequency_previous_last_week())
+        self.assertEqual(recurrence[0]["vin"], "ABC12345")
+        self.assertIs(
+            self.service.query("error_frequency_previous_last_week"), recurrence
+        )
+        self.service.query("average_speed_to_fourth_gear")
+        self.assertEqual(self.service.stats()["hits"], 2)
+        self.assertEqual(self.service.stats()["misses"], 2)
+        with self.assertRaises(ValueError):
+            self.service.query("drop_everything")
+
+    def test_change_marker_and_ttl(self):
+        self.assertEqual(self.service.query("average_speed_to_fourth_gear"), 31.0)
+        shift_log_add("VAN12345", 26, 3, 4)
+        self.assertAlmostEqual(
+            self.service.query("average_speed_to_fourth_gear"), 88 / 3
+        )
+        self.assertEqual(self.service.stats()["invalidations"], 1)
+        # Within marker_interval the marker is not read again
+        self.service.marker_interval = 5
+        self.service.query("average_speed_to_fourth_gear")
+        shift_log_add("VAN12345", 20, 3, 4)
+        self.assertAlmostEqual(
+            self.service.query("average_speed_to_fourth_gear"), 88 / 3
+        )
+        self.clock.now += 5
+        self.assertEqual(self.service.query("average_speed_to_fourth_gear"), 27.0)
+        # Expired by ttl without any write
+        misses = self.service.stats()["misses"]
+        self.clock.now += 11
+        self.service.query("average_speed_to_fourth_gear")
+        self.assertEqual(self.service.stats()["misses"], misses + 1)
+
+    def test_size_bound(self):
+        today = datetime.date.today()
+        for days in range(5):
+            since = today - datetime.timedelta(days=days)
+            self.service.query("error_frequency_previous_last_week", None, since)
+        stats = self.service.stats()
+        self.assertEqual((stats["cached"], stats["evicted"]), (3, 2))
+
+    def test_read_only(self):
+        with self.assertRaises(OperationalError):
+            self.service.database.execute_sql("DELETE FROM transmissionlog")
+        with self.assertRaises(ValueError):
+            make_read_database(":memory:")
+
+    def test_http(self):
+        server = serve_http(self.service, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            with urllib.request.urlopen(base + "/average_speed_to_fourth_gear") as r:
+                self.assertEqual(json.load(r), 31.0)
+            since = datetime.date.today() - datetime.timedelta(days=7)
+            url = f"{base}/error_frequency_previous_last_week?since={since}"
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(json.load(response)[0]["vin"], "ABC12345")
+            bad_date = "/error_frequency_previous_last_week?since=yesterday"
+            for path, code in (("/unknown", 404), (bad_date, 400)):
+                with self.assertRaises(urllib.error.HTTPError) as raised:
+                    urllib.request.urlopen(base + path)
+                self.assertEqual(raised.exception.code, code)
+                raised.exception.close()
+            with urllib.request.urlopen(base + "/stats") as response:
+                self.assertEqual(json.load(response)["misses"], 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_http_connections(self):
+        # One request thread answers every request on the same connection
+        self.service.register("connection", lambda database: id(database.connection()))
+        server = serve_http(self.service, port=0, threads=1)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/connection"
+        try:
+            connections = set()
+            for _ in range(3):
+                self.service.invalidate()
+                with urllib.request.urlopen(url) as response:
+                    connections.add(json.load(response))
+            self.assertEqual(len(connections), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertFalse(any(worker.is_alive() for worker in server.workers))
@@ -0,0 +1,94 @@
+import unittest
+from models.automatic import is_error
+from models.rules import (
+    ShiftRuleEngine,
+    ALL_RULES,
+    NO_ERROR,
+    LATE_SHIFT,
+    EARLY_SHIFT,
+    DOWNSHIFT_OVERSPEED,
+    SKIPPED_GEAR,
+    MISSING_CONFIG,
+    INVALID_SPEED,
+    INVALID_GEAR,
+    render_error_message,
+)
+
+# Car thresholds from preload_config
+THRESHOLDS = {(2, 2): 15, (2, 3): 25, (2, 4): 40, (2, 5): 45, (2, 6): 50}
+
+
+class TestShiftRuleEngine(unittest.TestCase):
+    def test_default_rules_match_is_error(self):
+        engine = ShiftRuleEngine(THRESHOLDS)
+        for speed, gear_from, gear_to in [
+            (42, 3, 4),
+            (38, 3, 4),
+            (48, 4, 3),
+            (10, 1, 2),
+        ]:
+            code, expected = engine.evaluate(2, speed, gear_from, gear_to)
+            error = is_error(expected, speed, gear_from, gear_to)
+            self.assertEqual(code != NO_ERROR, error["error"])
+            self.assertEqual(
+                render_error_message(code, speed, expected, gear_from, gear_to),
+                error["message"],
+            )
+
+    def test_invalid_events(self):
+        engine = ShiftRuleEngine(THRESHOLDS)
+        self.assertEqual(
+            engine.evaluate_many(
+                [
+                    (2, 20, 1, 9),
+                    (9, 20, 1, 2),
+                    (None, 20, 1, 2),
+                    (2, "20", 1, 2),
+                    (2, 20, "1", 2),
+                ]
+            ),
+            [
+                (MISSING_CONFIG, None),
+                (MISSING_CONFIG, None),
+                (MISSING_CONFIG, None),
+                (INVALID_SPEED, 15),
+                (INVALID_GEAR, 15),
+            ],
+        )
+
+    def test_all_rules(self):
+        engine = ShiftRuleEngine(THRESHOLDS, rules=ALL_RULES, early_margin=5)
+        results = engine.evaluate_many(
+            [
+                (2, 42, 3, 4),  # late
+                (2, 30, 3, 4),  # early, more than 5 below 40
+                (2, 37, 3, 4),  # within the margin
+                (2, 48, 4, 3),  # downshift above the speed of 4th
+                (2, 20, 4, 3),  # normal downshift
+                (2, 30, 2, 4),  # skipped 3rd
+            ]
+        )
+        self.assertEqual(
+            [code for code, _ in results],
+            [
+                LATE_SHIFT,
+                EARLY_SHIFT,
+                NO_ERROR,
+                DOWNSHIFT_OVERSPEED,
+                NO_ERROR,
+                SKIPPED_GEAR,
+            ],
+        )
+        self.assertEqual(results[3], (DOWNSHIFT_OVERSPEED, 40))
+        self.assertEqual(
+            render_error_message(DOWNSHIFT_OVERSPEED, 48, 40, 4, 3),
+            "Downshift at 48 above 40, shifting from 4 to 3",
+        )
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, ShiftRuleEngine, THRESHOLDS, rules=["fast"])
+        self.assertRaises(ValueError, render_error_message, 99, 1, 1, 1, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
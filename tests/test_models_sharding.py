@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import datetime
+import tempfile
+import threading
+import unittest
+from peewee import OperationalError
+import models.automatic
+from models.automatic import (
+    TransmissionLog,
+    Vehicle,
+    make_database,
+    write_transaction,
+    lookup_cache,
+)
+from models.instrumentation import instrumentation
+from models.sharding import ShardRouter, ShardedFleet, stable_shard, shard_paths
+from tests.helpers import open_test_database
+
+
+def fleet_records() -> list:
+    now = datetime.datetime.now()
+    earlier = now - datetime.timedelta(days=45)
+    records = []
+    for i in range(60):
+        vin = f"VIN{i % 12:05d}"
+        records.append((vin, 30 + i % 15, 3, 4, now - datetime.timedelta(hours=i)))
+    # Late shifts before last month and in the last week for a few vehicles;
+    # van shifts into fourth at 30 and up are late too
+    for vin in ("VIN00001", "VIN00004", "VIN00007"):
+        records.append((vin, 70, 3, 4, earlier))
+        records.append((vin, 72, 3, 4, now))
+    records.append(("VIN00002", 70, 3, 4, earlier))
+    records.append(("UNKNOWN", 30, 3, 4, now))
+    return records
+
+
+class TestShardedFleet(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fleets = []
+
+    def tearDown(self):
+        for fleet in self.fleets:
+            fleet.close()
+        lookup_cache.clear()
+
+    def open_fleet(self, shards: int, key: str = "vin", name: str = "automatic.db"):
+        fleet = ShardedFleet(os.path.join(self.directory, name), shards, key)
+        fleet.create()
+        self.fleets.append(fleet)
+        return fleet
+
+    def register(self, fleet) -> dict:
+        vehicles = [
+            (f"VIN{i:05d}", "Ford", 2010, ("car", "truck", "van")[i % 3])
+            for i in range(12)
+        ]
+        return fleet.add_vehicles_many(vehicles + [("BAD00001", "Ford", 2010, "boat")])
+
+    def test_router(self):
+        self.assertEqual(stable_shard("1G1ZZ8F", 4), stable_shard("1G1ZZ8F", 4))
+        self.assertEqual(
+            [os.path.basename(path) for path in shard_paths("data/auto.db", 2)],
+            ["auto-shard00.db", "auto-shard01.db"],
+        )
+        router = ShardRouter(4, key="type")
+        self.assertEqual(
+            router.vehicle_shard("A", "Car"), router.vehicle_shard("B", "car")
+        )
+        self.assertIsNone(router.shard("A"))
+        router.learn("A", 2)
+        self.assertEqual(router.shard("A"), 2)
+        self.assertEqual(router.vehicle_shard("A", "Truck"), 2)
+        with self.assertRaises(ValueError):
+            ShardRouter(4, key="make")
+
+    def test_merged_queries_match_one_database(self):
+        single = self.open_fleet(1, name="single.db")
+        sharded = self.open_fleet(3)
+        self.assertEqual(self.register(single), self.register(sharded))
+        # Registering again updates
+        self.assertEqual(self.register(sharded)["updated"], 12)
+        records = fleet_records()
+        results = sharded.shift_log_add_many(records)
+        self.assertEqual(results, single.shift_log_add_many(records))
+        self.assertEqual(results[-1]["message"], "Vehicle does not exist")
+        counts = []
+        for index in range(3):
+            with sharded.shard(index):
+                counts.append(TransmissionLog.select().count())
+        self.assertEqual(sum(counts), len(records) - 1)
+        self.assertEqual(len([count for count in counts if count]), 3)
+        self.assertAlmostEqual(
+            sharded.average_speed_to_fourth_gear(),
+            single.average_speed_to_fourth_gear(),
+        )
+        merged = sharded.shift_speed_stats(3, 4)
+        self.assertEqual(len(merged), 3)
+        for row, expected in zip(merged, single.shift_speed_stats(3, 4)):
+            self.assertEqual(row.keys(), expected.keys())
+            for name, value in expected.items():
+                self.assertAlmostEqual(row[name], value)
+        recurrence = sharded.error_frequency_previous_last_week()
+        self.assertEqual(recurrence, single.error_frequency_previous_last_week())
+        self.assertEqual(
+            [row["vin"] for row in recurrence],
+            ["VIN00001", "VIN00002", "VIN00004", "VIN00007"],
+        )
+
+    def test_type_key(self):
+        fleet = self.open_fleet(4, key="type")
+        self.register(fleet)
+        fleet.add_vehicle("VAN99999", "Ford", 2015, "Van")
+        shards = {fleet.router.shard(f"VIN{i:05d}") for i in range(0, 12, 3)}
+        self.assertEqual(shards, {fleet.router.vehicle_shard("", "car")})
+        self.assertEqual(fleet.router.shard("VAN99999"), fleet.router.shard("VIN00002"))
+        # A known VIN under another type stays on its shard
+        with self.assertRaises(ValueError):
+            fleet.add_vehicle("VAN99999", "Ford", 2015, "Truck")
+        result = fleet.add_vehicles_many(
+            [("VIN00000", "Ford", 2010, "van"), ("NEW00001", "Kia", 2020, "car")]
+            + [("NEW00001", "Kia", 2020, "truck")]
+        )
+        self.assertEqual((result["added"], result["updated"]), (1, 2))
+        counts = fleet.fan_out(lambda database: Vehicle.select().bind(database).count())
+        self.assertEqual(sum(counts), 14)
+        # A new router learns where vehicles live from the shards
+        reopened = self.open_fleet(4, key="type")
+        self.assertEqual(reopened.router.directory, fleet.router.directory)
+        reopened.shift_log_add("VAN99999", 20, 3, 4)
+        self.assertAlmostEqual(reopened.average_speed_to_fourth_gear(), 20)
+
+    def test_writer_processes(self):
+        fleet = self.open_fleet(2)
+        self.register(fleet)
+        records = fleet_records()
+        fleet.start_writers()
+        results = fleet.shift_log_add_many(records)
+        results += fleet.shift_log_add_many(records[:10])
+        fleet.stop_writers()
+        self.assertEqual(sum(result["logged"] for result in results), len(records) + 9)
+        self.assertEqual(
+            [result["vin"] for result in results[:5]], [r[0] for r in records[:5]]
+        )
+        self.assertEqual(len(fleet.error_frequency_previous_last_week()), 4)
+
+
+class TestWriteTransaction(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "automatic.db")
+        self.db = open_test_database(make_database(self.path))
+        # Fail fast instead of waiting in SQLite, so the retries are exercised
+        self.db.pragma("busy_timeout", 0)
+        self.backoff = models.automatic.BUSY_BACKOFF
+        models.automatic.BUSY_BACKOFF = 0.02
+
+    def tearDown(self):
+        models.automatic.BUSY_BACKOFF = self.backoff
+        self.db.close()
+
+    def test_retries_while_locked(self):
+        other = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        other.execute("BEGIN IMMEDIATE")
+        timer = threading.Timer(0.05, other.execute, ["COMMIT"])
+        timer.start()
+        retries = instrumentation.counters.get("busy_retries", 0)
+        try:
+            self.assertEqual(write_transaction(lambda: 42), 42)
+        finally:
+            timer.join()
+            other.close()
+        self.assertGreater(instrumentation.counters.get("busy_retries", 0), retries)
+
+    def test_other_errors_raise(self):
+        def failing():
+            self.db.execute_sql("SELECT * FROM missing_table")
+
+        with self.assertRaises(OperationalError):
+            write_transaction(failing)
+        # Within a transaction the function runs without a new one
+        with self.db.atomic():
+            self.assertTrue(write_transaction(self.db.in_transaction))
@@ -0,0 +1,116 @@
+import json
+import unittest
+import datetime
+from models.automatic import TransmissionLog, Vehicle, preload_config, rule_engine
+from models.ingest import ShiftEventBuffer, parse_event
+from models.rules import NO_ERROR, LATE_SHIFT
+from models.state import ShiftStateTracker, GEAR_MISMATCH
+from models.simulator import (
+    TransmissionSimulator,
+    register_simulated_fleet,
+    paced,
+    to_ndjson,
+    feed,
+)
+from tests.helpers import FakeClock, open_test_database, close_test_database
+
+
+class TestTransmissionSimulator(unittest.TestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+
+    def tearDown(self):
+        close_test_database()
+
+    def test_fleet_covers_every_type(self):
+        simulator = TransmissionSimulator(vehicles_per_type=3)
+        type_refs = [type_ref for _, type_ref in simulator.fleet()]
+        self.assertEqual(sorted(set(type_refs)), [1, 2, 3, 4])
+        self.assertEqual(len(type_refs), 12)
+        self.assertEqual(register_simulated_fleet(simulator), 12)
+        # Registering again only adds what is missing
+        self.assertEqual(register_simulated_fleet(simulator), 0)
+        self.assertEqual(Vehicle.select().count(), 12)
+
+    def test_seed_is_deterministic(self):
+        first = list(TransmissionSimulator(5, 0.1, seed=7).events(duration=300))
+        second = list(TransmissionSimulator(5, 0.1, seed=7).events(duration=300))
+        other = list(TransmissionSimulator(5, 0.1, seed=8).events(duration=300))
+        self.assertTrue(first)
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+    def test_events_follow_thresholds(self):
+        simulator = TransmissionSimulator(10, late_ratio=0.0, seed=1)
+        type_refs = dict(simulator.fleet())
+        engine = rule_engine()
+        events = list(simulator.events(duration=900))
+        self.assertTrue(
+            any(gear_to < gear_from for _, _, gear_from, gear_to, _ in events)
+        )
+        for vin, speed, gear_from, gear_to, _ in events:
+            self.assertEqual(abs(gear_to - gear_from), 1)
+            code, expected = engine.evaluate(type_refs[vin], speed, gear_from, gear_to)
+            self.assertEqual(code, NO_ERROR)
+            if gear_to > gear_from:
+                self.assertEqual(speed, expected)
+
+    def test_late_ratio(self):
+        simulator = TransmissionSimulator(25, late_ratio=0.2, seed=3)
+        type_refs = dict(simulator.fleet())
+        engine = rule_engine()
+        upshifts = late = 0
+        for vin, speed, gear_from, gear_to, _ in simulator.events(duration=1800):
+            if gear_to > gear_from:
+                upshifts += 1
+                code, _ = engine.evaluate(type_refs[vin], speed, gear_from, gear_to)
+                late += code == LATE_SHIFT
+        self.assertAlmostEqual(late / upshifts, 0.2, delta=0.05)
+        with self.assertRaises(ValueError):
+            TransmissionSimulator(late_ratio=1.5)
+
+    def test_count_and_timestamps(self):
+        start = datetime.datetime(2024, 3, 1)
+        simulator = TransmissionSimulator(2, seed=4, start=start, samples=True)
+        events = list(simulator.events(count=50))
+        self.assertEqual(len(events), 50)
+        # Every vehicle reports one sample per tick, in time order
+        self.assertEqual(events[0][4], start + datetime.timedelta(seconds=1))
+        self.assertEqual(
+            [event[4] for event in events], sorted(event[4] for event in events)
+        )
+        # Nobody reaches a shift speed in the first second
+        self.assertEqual([event[2] for event in events[:8]], [None] * 8)
+        self.assertEqual(len({event[0] for event in events[:8]}), 8)
+
+    def test_paced(self):
+        clock = FakeClock()
+        records = list(paced(range(5), 10, clock=clock, sleep=clock.sleep))
+        self.assertEqual(records, [0, 1, 2, 3, 4])
+        self.assertAlmostEqual(clock.now, 0.4)
+        self.assertEqual(
+            list(paced(range(3), None, clock=clock, sleep=clock.sleep)), [0, 1, 2]
+        )
+
+    def test_ndjson_round_trip(self):
+        simulator = TransmissionSimulator(2, seed=5, samples=True)
+        for record in simulator.events(count=40):
+            line = to_ndjson(record)
+            json.loads(line)
+            self.assertEqual(parse_event(line, allow_samples=True), record)
+
+    def test_feed_ingest(self):
+        simulator = TransmissionSimulator(3, late_ratio=0.2, seed=6, samples=True)
+        register_simulated_fleet(simulator)
+        tracker = ShiftStateTracker()
+        mismatches = []
+        tracker.subscribe(
+            lambda anomaly: anomaly.kind == GEAR_MISMATCH and mismatches.append(anomaly)
+        )
+        buffer = ShiftEventBuffer(flush_size=100, tracker=tracker)
+        report = feed(buffer, simulator.events(duration=600))
+        self.assertEqual(report["rejected"], 0)
+        self.assertGreater(report["samples"], 0)
+        self.assertEqual(TransmissionLog.select().count(), report["logged"])
+        self.assertEqual(mismatches, [])
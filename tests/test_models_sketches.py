@@ -0,0 +1,203 @@
+import random
+import threading
+import unittest
+import datetime
+from peewee import OperationalError
+from models.automatic import (
+    ShiftSketch,
+    TransmissionLog,
+    preload_config,
+    add_vehicle,
+    shift_log_add,
+    shift_log_add_many,
+    shift_speed_stats,
+    average_speed_to_fourth_gear,
+    approximate_shift_speed_stats,
+    approximate_average_speed_to_fourth_gear,
+    approximate_error_vehicles,
+    flush_shift_sketches,
+    rebuild_shift_sketches,
+    load_shift_sketches,
+    shift_sketches,
+)
+from models.sketches import (
+    ReservoirSample,
+    TDigest,
+    HyperLogLog,
+    SketchBuffer,
+    SPEED_DIGEST,
+    ERROR_VEHICLES,
+)
+from tests.helpers import open_test_database, close_test_database
+
+
+class TestSketches(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def test_reservoir_sample(self):
+        sample = ReservoirSample(size=100)
+        for value in range(10):
+            sample.add(value, self.rng)
+        self.assertEqual(sample.mean(), (4.5, 0.0))
+        for value in range(10, 10000):
+            sample.add(value, self.rng)
+        self.assertEqual((sample.count, len(sample.items)), (10000, 100))
+        average, error = sample.mean()
+        self.assertLess(abs(average - 4999.5), 3 * error)
+        other = ReservoirSample(size=100)
+        for _ in range(30000):
+            other.add(20000, self.rng)
+        sample.merge(other, self.rng)
+        self.assertEqual(sample.count, 40000)
+        # About three quarters of the merged sample come from the larger stream
+        self.assertGreater(sample.items.count(20000), 60)
+        restored = ReservoirSample.from_blob(sample.to_blob())
+        self.assertEqual(restored.items, sample.items)
+
+    def test_tdigest_quantiles(self):
+        values = [self.rng.gauss(40, 5) for _ in range(20000)]
+        digest = TDigest()
+        half = TDigest()
+        for i, value in enumerate(values):
+            (digest if i % 2 else half).add(value)
+        digest.merge(half)
+        ordered = sorted(values)
+        for q in (0.01, 0.5, 0.9, 0.99):
+            estimate, rank_error = digest.quantile(q)
+            rank = sum(1 for value in ordered if value < estimate) / len(ordered)
+            self.assertLess(abs(rank - q), max(rank_error, 0.005))
+        self.assertLess(len(digest.centroids), 200)
+        self.assertEqual(digest.quantile(1)[0], ordered[-1])
+        restored = TDigest.from_blob(digest.to_blob())
+        self.assertEqual(restored.quantile(0.5), digest.quantile(0.5))
+        with self.assertRaises(ValueError):
+            digest.quantile(2)
+
+    def test_hyperloglog(self):
+        sketch = HyperLogLog()
+        for value in range(20):
+            sketch.add(value)
+        self.assertEqual(sketch.count(), 20)
+        for value in range(50000):
+            sketch.add(value)
+        self.assertLess(abs(sketch.count() - 50000), 50000 * 3 * sketch.relative_error)
+        other = HyperLogLog()
+        for value in range(40000, 90000):
+            other.add(value)
+        sketch.merge(other)
+        self.assertLess(abs(sketch.count() - 90000), 90000 * 3 * sketch.relative_error)
+        self.assertEqual(
+            HyperLogLog.from_blob(sketch.to_blob()).count(), sketch.count()
+        )
+        with self.assertRaises(ValueError):
+            sketch.merge(HyperLogLog(precision=10))
+
+    def test_buffer_due(self):
+        now = [0.0]
+        buffer = SketchBuffer(flush_events=3, flush_seconds=5, clock=lambda: now[0])
+        day = datetime.date(2024, 1, 2)
+        self.assertFalse(buffer.due())
+        buffer.add(2, 1, 40, 3, 4, False, day)
+        self.assertFalse(buffer.due())
+        now[0] = 5.0
+        self.assertTrue(buffer.due())
+        buffer.add(2, 1, 42, 3, 4, True, day)
+        buffer.add(2, 2, 45, 3, 4, True, day)
+        sketches = buffer.take()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(sketches[(ERROR_VEHICLES, "2024-01-02")].count(), 2)
+        self.assertEqual(sketches[(SPEED_DIGEST, "2:3:4")].count, 3)
+
+    def test_buffer_threads(self):
+        buffer = SketchBuffer()
+        day = datetime.date(2024, 1, 2)
+
+        def add():
+            for speed in range(2000):
+                buffer.add(2, 1, speed, 3, 4, speed % 2, day)
+
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        # Taken while the threads add, no update is lost or counted twice
+        events = 0
+        speeds = 0
+        while any(thread.is_alive() for thread in threads) or len(buffer):
+            sketches, taken = buffer.drain()
+            events += taken
+            if taken:
+                speeds += sketches[(SPEED_DIGEST, "2:3:4")].count
+        self.assertEqual((events, speeds), (8000, 8000))
+
+
+class TestShiftSketches(unittest.TestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("ABC123456", "Ford", 2010, "Truck")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        self.day = datetime.datetime(2024, 3, 4, 12)
+        shift_log_add_many(
+            [
+                ("ABC12345", 42, 3, 4, self.day),
+                ("ABC12345", 38, 3, 4, self.day),
+                ("ABC123456", 40, 3, 4, self.day),
+                ("VAN12345", 30, 3, 4, self.day + datetime.timedelta(days=1)),
+                ("VAN12345", 12, 1, 2, self.day + datetime.timedelta(days=2)),
+            ]
+        )
+
+    def tearDown(self):
+        shift_sketches.clear()
+        close_test_database()
+
+    def test_write_path_buffers(self):
+        # Nothing is read or stored until the buffer is due
+        self.assertEqual(len(shift_sketches), 5)
+        self.assertEqual(ShiftSketch.select().count(), 0)
+        self.assertEqual(flush_shift_sketches(), 5)
+        self.assertEqual(flush_shift_sketches(), 0)
+        shift_log_add("VAN12345", 26, 3, 4)
+        flush_shift_sketches()
+        digest = load_shift_sketches(SPEED_DIGEST, ["4:3:4"])["4:3:4"]
+        self.assertEqual((digest.count, digest.min, digest.max), (2, 26, 30))
+
+    def test_failed_flush_keeps_updates(self):
+        ShiftSketch.drop_table()
+        with self.assertRaises(OperationalError):
+            flush_shift_sketches()
+        shift_log_add("VAN12345", 26, 3, 4)
+        self.assertEqual(len(shift_sketches), 6)
+        ShiftSketch.create_table()
+        self.assertEqual(flush_shift_sketches(), 6)
+        digest = load_shift_sketches(SPEED_DIGEST, ["4:3:4"])["4:3:4"]
+        self.assertEqual((digest.count, digest.min, digest.max), (2, 26, 30))
+
+    def test_approximate_queries(self):
+        # Small streams fit the samples, so the estimates are exact
+        approximate = approximate_average_speed_to_fourth_gear()
+        self.assertAlmostEqual(approximate["average"], average_speed_to_fourth_gear())
+        self.assertEqual(approximate["count"], 4)
+        exact = {row["type_name"]: row for row in shift_speed_stats(3, 4)}
+        for row in approximate_shift_speed_stats(3, 4):
+            self.assertEqual(row["count"], exact[row["type_name"]]["count"])
+            self.assertAlmostEqual(row["average"], exact[row["type_name"]]["average"])
+        car = approximate_shift_speed_stats(3, 4)[1]
+        self.assertEqual(car["type_name"], "Car")
+        self.assertEqual(car["quantiles"]["p99"]["speed"], 42)
+        # Errors: ABC12345 at 42 on day 0, VAN12345 at 30 on day 1
+        self.assertEqual(approximate_error_vehicles()["vehicles"], 2)
+        start = self.day.date() + datetime.timedelta(days=1)
+        self.assertEqual(approximate_error_vehicles(start)["vehicles"], 1)
+        self.assertEqual(approximate_error_vehicles(end=start)["vehicles"], 1)
+
+    def test_rebuild(self):
+        flush_shift_sketches()
+        stored = {row.key: bytes(row.data) for row in ShiftSketch.select()}
+        TransmissionLog.delete().where(TransmissionLog.gear_to == 2).execute()
+        self.assertEqual(rebuild_shift_sketches(), 4)
+        rebuilt = {row.key: bytes(row.data) for row in ShiftSketch.select()}
+        self.assertNotIn("4:1:2", rebuilt)
+        self.assertEqual(rebuilt["2:3:4"], stored["2:3:4"])
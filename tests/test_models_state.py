@@ -0,0 +1,116 @@
+import queue
+import unittest
+import datetime
+from models.automatic import TransmissionLog, preload_config, add_vehicle
+from models.ingest import ShiftEventBuffer
+from models.rules import LATE_SHIFT
+from models.state import (
+    ShiftStateTracker,
+    MISSED_UPSHIFT,
+    GEAR_MISMATCH,
+    SHIFT_ERROR,
+    describe,
+)
+from tests.helpers import FakeClock, open_test_database, close_test_database
+
+
+class TestShiftStateTracker(unittest.TestCase):
+    def setUp(self):
+        open_test_database()
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        self.clock = FakeClock()
+        self.anomalies = queue.Queue()
+        self.tracker = ShiftStateTracker(
+            max_vehicles=2, idle_timeout=60, clock=self.clock
+        )
+        self.tracker.subscribe(self.anomalies.put_nowait)
+
+    def tearDown(self):
+        close_test_database()
+
+    def drain(self) -> list:
+        events = []
+        while not self.anomalies.empty():
+            events.append(self.anomalies.get_nowait())
+        return events
+
+    def test_missed_upshift_from_speed_samples(self):
+        self.tracker.observe(("ABC12345", 12, 1, 2, None))
+        self.assertEqual(self.tracker.state("ABC12345").gear, 2)
+        # Car 2 -> 3 is configured at 25
+        for speed in (20, 24, 27, 30, 31):
+            self.tracker.observe(("ABC12345", speed, None, None, None))
+        anomalies = self.drain()
+        self.assertEqual(len(anomalies), 1)
+        self.assertEqual(anomalies[0].kind, MISSED_UPSHIFT)
+        self.assertEqual(
+            (anomalies[0].speed, anomalies[0].gear_to, anomalies[0].expected),
+            (27, 3, 25),
+        )
+        # Dropping below the limit re-arms the alert, shifting clears it
+        self.tracker.observe(("ABC12345", 22, None, None, None))
+        self.tracker.observe(("ABC12345", 26, None, None, None))
+        self.assertEqual(len(self.drain()), 1)
+        self.tracker.observe(("ABC12345", 24, 2, 3, None))
+        self.tracker.observe(("ABC12345", 30, None, None, None))
+        self.assertEqual(self.drain(), [])
+
+    def test_shift_anomalies(self):
+        timestamp = datetime.datetime(2024, 5, 1, 8, 0)
+        self.tracker.observe(("ABC12345", 12, 1, 2, timestamp))
+        self.tracker.observe(("ABC12345", 45, 3, 4, timestamp))
+        mismatch, late = self.drain()
+        self.assertEqual(mismatch.kind, GEAR_MISMATCH)
+        self.assertEqual((mismatch.gear_from, mismatch.gear_to), (2, 3))
+        self.assertEqual((late.kind, late.code), (SHIFT_ERROR, LATE_SHIFT))
+        event = describe(late)
+        self.assertEqual(event["timestamp"], "2024-05-01T08:00:00")
+        self.assertEqual(
+            event["message"],
+            "Gear shift exceeded at 45, expected 40, shifting from 3 to 4",
+        )
+        # Unknown VINs and invalid shifts do not change any state
+        self.tracker.observe(("MISSING", 20, 1, 2, None))
+        self.tracker.observe(("ABC12345", 20, 4, 9, None))
+        self.assertEqual(self.tracker.state("ABC12345").gear, 4)
+        self.assertEqual(self.tracker.stats()["unknown"], 1)
+
+    def test_eviction(self):
+        self.tracker.observe_many(
+            [("ABC12345", 12, 1, 2, None), ("VAN12345", 10, 1, 2, None)]
+        )
+        self.assertEqual(len(self.tracker), 2)
+        self.clock.now = 30
+        self.tracker.observe(("ABC12345", 14, None, None, None))
+        # The van has been idle for 60s, the car only for 30s
+        self.clock.now = 60
+        self.assertEqual(self.tracker.evict_idle(), 1)
+        self.assertIsNone(self.tracker.state("VAN12345"))
+        # The size bound drops the least recently active vehicle
+        self.tracker.max_vehicles = 1
+        self.tracker.observe(("VAN12345", 10, 1, 2, None))
+        self.assertIsNone(self.tracker.state("ABC12345"))
+        self.assertEqual(self.tracker.stats()["evicted"], 2)
+
+    def test_ingest_buffer(self):
+        buffer = ShiftEventBuffer(flush_size=10, tracker=self.tracker)
+        buffer.add_line(
+            '{"vin": "ABC12345", "speed": 12, "gear_from": 1, "gear_to": 2}'
+        )
+        buffer.add_line('{"vin": "ABC12345", "speed": 30}')
+        self.assertEqual(len(buffer), 1)
+        self.assertEqual(self.drain()[0].kind, MISSED_UPSHIFT)
+        buffer.flush()
+        self.assertEqual(TransmissionLog.select().count(), 1)
+        report = buffer.stats.report()
+        self.assertEqual((report["samples"], report["logged"]), (1, 1))
+        # Without a tracker speed samples are still rejected
+        plain = ShiftEventBuffer(flush_size=10)
+        plain.add_line('{"vin": "ABC12345", "speed": 30}')
+        self.assertEqual(plain.stats.rejected, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
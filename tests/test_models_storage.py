@@ -0,0 +1,178 @@
+import os
+import datetime
+import tempfile
+import unittest
+from peewee import DatabaseError
+from models.automatic import (
+    TransmissionLog,
+    StorageCheckpoint,
+    make_database,
+    preload_config,
+    add_vehicle,
+    shift_log_add,
+    shift_log_add_many,
+    set_storage_backend,
+    shift_sketches,
+    average_speed_to_fourth_gear,
+    MODELS,
+)
+from models.storage import (
+    SegmentLog,
+    SqliteBackend,
+    commit_entries,
+    BufferedBackend,
+    encode_record,
+    decode_record,
+)
+from tests.helpers import open_test_database
+
+
+class TestStorageBackends(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.segment_dir = os.path.join(directory, "segments")
+        self.db = open_test_database(
+            make_database(os.path.join(directory, "automatic.db"))
+        )
+        preload_config()
+        add_vehicle("ABC12345", "Toyota", 2010, "Car")
+        add_vehicle("VAN12345", "Ford", 2015, "Van")
+        self.day = datetime.datetime(2024, 3, 4, 12)
+        self.backend = None
+
+    def tearDown(self):
+        set_storage_backend(None)
+        if self.backend is not None:
+            self.backend.close()
+        shift_sketches.clear()
+        self.db.close()
+
+    def use_backend(self, **options):
+        self.backend = BufferedBackend(self.segment_dir, **options)
+        set_storage_backend(self.backend)
+        return self.backend
+
+    def entries(self, count: int) -> list:
+        row = {
+            "vehicle_ref": 1,
+            "gear_from": 3,
+            "gear_to": 4,
+            "error": False,
+            "error_code": 0,
+            "expected_speed": 40,
+        }
+        return [
+            (2, dict(row, gear_speed=30 + i, date_timestamp=self.day))
+            for i in range(count)
+        ]
+
+    def test_record_round_trip(self):
+        entries = self.entries(2)
+        line = encode_record(7, entries)
+        self.assertEqual(decode_record(line), (7, entries))
+        with self.assertRaises(ValueError):
+            decode_record(line[:-5])
+        with self.assertRaises(ValueError):
+            decode_record(line.replace(b"30", b"31"))
+
+    def test_sqlite_backend(self):
+        set_storage_backend(SqliteBackend())
+        shift_log_add("ABC12345", 42, 3, 4)
+        self.assertEqual(TransmissionLog.select().count(), 1)
+
+    def test_acknowledge_then_group_commit(self):
+        backend = self.use_backend(commit_interval=60)
+        results = shift_log_add_many(
+            [
+                ("ABC12345", 42, 3, 4, self.day),
+                ("VAN12345", 20, 3, 4, self.day),
+                ("UNKNOWN", 20, 3, 4, self.day),
+            ]
+        )
+        self.assertEqual([result["logged"] for result in results], [True, True, False])
+        shift_log_add("VAN12345", 26, 3, 4)
+        # Acknowledged and in the segment log, not committed yet
+        self.assertEqual((len(backend), backend.written), (3, 3))
+        self.assertEqual(TransmissionLog.select().count(), 0)
+        self.assertEqual(len(backend.segments.segments()), 1)
+        backend.flush(timeout=5)
+        self.assertEqual(len(backend), 0)
+        self.assertAlmostEqual(average_speed_to_fourth_gear(), 88 / 3)
+        self.assertEqual(StorageCheckpoint.get().sequence, 3)
+
+    def test_backpressure(self):
+        backend = self.use_backend(capacity=4, commit_size=2, commit_interval=60)
+        backend.write(self.entries(11))
+        backend.flush(timeout=5)
+        speeds = [
+            log.gear_speed
+            for log in TransmissionLog.select().order_by(TransmissionLog.pk)
+        ]
+        self.assertEqual(speeds, list(range(30, 41)))
+        self.assertEqual(backend.committed, 11)
+
+    def test_segments_rotate_and_truncate(self):
+        backend = self.use_backend(commit_interval=60, segment_bytes=1)
+        for entries in (self.entries(2), self.entries(3)):
+            backend.write(entries)
+        self.assertEqual([first for first, _ in backend.segments.segments()], [1, 3])
+        backend.flush(timeout=5)
+        # Both segments are closed and committed
+        self.assertEqual(backend.segments.segments(), [])
+        backend.write(self.entries(1))
+        self.assertEqual([first for first, _ in backend.segments.segments()], [6])
+
+    def test_recovery(self):
+        # A crash after committing entries 1-2 and acknowledging 3-5, with a
+        # torn write at the end of the segment
+        StorageCheckpoint.create(name="shift_log", sequence=2)
+        segments = SegmentLog(self.segment_dir)
+        segments.append(1, self.entries(3))
+        segments.append(4, self.entries(2))
+        segments.close()
+        with open(segments.path(1), "ab") as segment:
+            segment.write(encode_record(6, self.entries(1))[:20])
+        backend = self.use_backend(commit_interval=60)
+        self.assertEqual(backend.recovered, 3)
+        self.assertEqual((backend.written, backend.committed), (5, 5))
+        speeds = [log.gear_speed for log in TransmissionLog.select()]
+        self.assertEqual(sorted(speeds), [30, 31, 32])
+        self.assertEqual(backend.segments.segments(), [])
+        backend.close()
+        # Nothing is replayed twice
+        self.backend = self.use_backend(commit_interval=60)
+        self.assertEqual(self.backend.recovered, 0)
+        self.assertEqual(TransmissionLog.select().count(), 3)
+
+    def test_failed_group_commit(self):
+        entries = self.entries(3)
+        # Without the checkpoint table the commit fails after the rows
+        self.db.drop_tables([StorageCheckpoint])
+        with self.assertRaises(DatabaseError):
+            commit_entries("shift_log", entries, 3, 100)
+        self.assertEqual(
+            (TransmissionLog.select().count(), len(shift_sketches)), (0, 0)
+        )
+        self.db.create_tables([StorageCheckpoint])
+        commit_entries("shift_log", entries, 3, 100)
+        self.assertEqual(
+            (TransmissionLog.select().count(), len(shift_sketches)), (3, 3)
+        )
+
+    def test_close_commits_pending(self):
+        backend = self.use_backend(commit_interval=60)
+        backend.write(self.entries(3))
+        backend.close()
+        self.backend = None
+        self.assertEqual(TransmissionLog.select().count(), 3)
+        with self.assertRaises(ValueError):
+            backend.write(self.entries(1))
+
+    def test_requires_database_file(self):
+        memory_db = make_database(":memory:")
+        memory_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+        try:
+            with self.assertRaises(ValueError):
+                BufferedBackend(self.segment_dir)
+        finally:
+            self.db.bind(MODELS, bind_refs=False, bind_backrefs=False)